@@ -158,8 +158,19 @@ class ProcessVideoURL(DVAQuery):
         }
 
 
+def retrieval_arguments(retriever_pk, n, filters=None):
+    """
+    Arguments of perform_retrieval, filters restrict results by entry metadata inside the retriever
+    e.g. {"video_id__in": [1, 2], "type": "D", "frame_index__gte": 100}
+    """
+    arguments = {'count': n, 'retriever_pk': retriever_pk}
+    if filters:
+        arguments['search_arguments'] = {'filters': filters}
+    return arguments
+
+
 class FindSimilarImages(DVAQuery):
-    def __init__(self, query_image_path, indexer_pk, retriever_pk, n=20):
+    def __init__(self, query_image_path, indexer_pk, retriever_pk, n=20, filters=None):
         super(FindSimilarImages, self).__init__()
         self.query_image_path = query_image_path
         self.query_json = {
@@ -173,7 +184,7 @@ class FindSimilarImages(DVAQuery):
                         'target': 'query',
                         'map': [
                             {'operation': 'perform_retrieval',
-                             'arguments': {'count': n, 'retriever_pk': retriever_pk}
+                             'arguments': retrieval_arguments(retriever_pk, n, filters)
                              }
                         ]
                     }
@@ -184,8 +195,37 @@ class FindSimilarImages(DVAQuery):
         }
 
 
+class FindSimilarToStored(DVAQuery):
+    """
+    Search with the stored vector of an already indexed frame or region, no image is uploaded or indexed.
+    """
+    def __init__(self, retriever_pk, frame_pk=None, detection_pk=None, indexer_pk=None, n=20, filters=None):
+        """
+        :param indexer_pk: indexer whose stored vector is used, by default the indexer of the retriever
+        """
+        super(FindSimilarToStored, self).__init__()
+        arguments = retrieval_arguments(retriever_pk, n, filters)
+        arguments['target'] = 'stored_vector'
+        if detection_pk:
+            arguments['detection_pk'] = detection_pk
+        else:
+            arguments['frame_pk'] = frame_pk
+        if indexer_pk:
+            # not "indexer_pk" which would route the retrieval to the indexer queue
+            arguments['stored_indexer_pk'] = indexer_pk
+        self.query_json = {
+            'process_type': constants.QUERY,
+            'image_data_b64': '',
+            'map': [
+                {'operation': 'perform_retrieval',
+                 'arguments': arguments
+                 }
+            ]
+        }
+
+
 class DetectAndFindSimilarImages(DVAQuery):
-    def __init__(self, query_image_path, detector_pk, indexer_pk, retriever_pk, n=20):
+    def __init__(self, query_image_path, detector_pk, indexer_pk, retriever_pk, n=20, filters=None):
         super(DetectAndFindSimilarImages, self).__init__()
         self.query_image_path = query_image_path
         self.query_json = {
@@ -203,7 +243,7 @@ class DetectAndFindSimilarImages(DVAQuery):
                               'target': 'query',
                               'map': [
                                   {'operation': 'perform_retrieval',
-                                   'arguments': {'count': n, 'retriever_pk': retriever_pk}
+                                   'arguments': retrieval_arguments(retriever_pk, n, filters)
                                    }
                               ]
                           }
@@ -49,11 +49,12 @@ class VisualSearchResults(object):
                 pass
 
     def visualize(self):
-        print "Query Image"
-        with open('temp.png', 'w') as f:
-            f.write(base64.decodestring(self.query.query_json['image_data_b64']))
-            f.close()
-        display(Image("temp.png", width=300))
+        if self.query.query_json['image_data_b64']:
+            print "Query Image"
+            with open('temp.png', 'w') as f:
+                f.write(base64.decodestring(self.query.query_json['image_data_b64']))
+                f.close()
+            display(Image("temp.png", width=300))
         print self.description
         print "Results"
         for rank, r in self.similar_images:
@@ -5,7 +5,7 @@ from sklearn.cluster import KMeans
 import logging
 import sys
 from collections import namedtuple
-from .utils import iterate_splits, predict_cluster
+from .utils import iterate_splits, predict_cluster, predict_clusters
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.WARNING)
@@ -516,6 +516,44 @@ class LOPQModel(object):
 
         return LOPQCode(coarse_codes, fine_codes)
 
+    def predict_batch(self, X):
+        """
+        Compute both coarse and fine codes for a matrix of datapoints at once.
+
+        :param ndarray X:
+            an NxD matrix of points to code
+
+        :returns ndarray:
+            an Nx2 array of coarse codes
+        :returns ndarray:
+            an NxM array of fine codes
+        """
+        X = np.atleast_2d(X)
+        split_size = X.shape[1] / self.num_coarse_splits
+        coarse_codes = []
+        fine_codes = []
+        for split in xrange(self.num_coarse_splits):
+            C, R, mu, subC = self.get_split_parameters(split)
+            cx = X[:, split * split_size:(split + 1) * split_size]
+
+            # Assign coarse clusters
+            clusters = predict_clusters(cx, C)
+            coarse_codes.append(clusters)
+
+            # Project residuals to the local frame of each assigned cluster
+            residuals = cx - C[clusters]
+            px = np.zeros(residuals.shape)
+            for cluster in np.unique(clusters):
+                members = clusters == cluster
+                px[members] = np.dot(residuals[members] - mu[cluster], R[cluster].T)
+
+            # Compute subquantizer codes
+            sub_size = split_size / self.num_fine_splits
+            for sub_split in xrange(self.num_fine_splits):
+                fine_codes.append(predict_clusters(px[:, sub_split * sub_size:(sub_split + 1) * sub_size], subC[sub_split]))
+
+        return np.column_stack(coarse_codes), np.column_stack(fine_codes)
+
     def predict_coarse(self, x):
         """
         Compute the coarse codes for a datapoint.
@@ -220,6 +220,20 @@ class LOPQSearcherBase(object):
         """
         raise NotImplementedError()
 
+    def get_code_arrays(self):
+        """
+        Retrieve all codes in the search index as arrays, e.g. to save the index and
+        restore it later with add_code_arrays.
+
+        :returns ndarray coarse:
+            an (N, 2) array of coarse codes
+        :returns ndarray fine:
+            an (N, M) array of fine codes
+        :returns ndarray ids:
+            an array of N ids
+        """
+        raise NotImplementedError()
+
     def get_cell(self, cell):
         """
         Retrieve a cell bucket from the index.
@@ -276,6 +290,223 @@ class LOPQSearcher(LOPQSearcherBase):
         return self.index[cell]
 
 
+class LOPQSearcherArray(LOPQSearcherBase):
+    def __init__(self, model):
+        """
+        Create an LOPQSearcher instance that encapsulates retrieving and ranking
+        with LOPQ. Requires an LOPQModel instance. This class stores the fine codes
+        of each cell as a contiguous array with a parallel array of ids, and ranks
+        retrieved items with vectorized lookups into per-cell distance tables
+        (asymmetric distance computation) instead of a Python loop per item.
+
+        :param LOPQModel model:
+            the model for indexing and ranking
+        """
+        self.model = model
+        self.fine_dtype = np.uint8 if model.subquantizer_clusters <= 256 else np.uint16
+        self.index = {}
+        self.pending = defaultdict(list)
+        self.size = 0
+
+    def add_codes(self, codes, ids=None):
+        """
+        Add LOPQ codes into the search index.
+
+        :param iterable codes:
+            an iterable of LOPQ code tuples
+        :param iterable ids:
+            an optional iterable of ids for each code;
+            defaults to the index of the code tuple if not provided
+        """
+        codes = list(codes)
+        if len(codes) == 0:
+            return
+        coarse = np.array([c[0] for c in codes])
+        fine = np.array([c[1] for c in codes])
+        if ids is None:
+            ids = np.arange(len(codes))
+        else:
+            ids = np.array(list(ids)[:len(codes)])
+        self.add_code_arrays(coarse, fine, ids)
+
+    def add_code_arrays(self, coarse, fine, ids):
+        """
+        Add LOPQ codes given as arrays into the search index.
+
+        :param ndarray coarse:
+            an (N, 2) array of coarse codes
+        :param ndarray fine:
+            an (N, M) array of fine codes
+        :param ndarray ids:
+            an array of N ids
+        """
+        coarse, fine, ids = np.atleast_2d(coarse), np.atleast_2d(fine), np.asarray(ids)
+        if coarse.shape[0] == 0:
+            return
+        order = np.lexsort((coarse[:, 1], coarse[:, 0]))
+        coarse, fine, ids = coarse[order], fine[order].astype(self.fine_dtype), ids[order]
+        starts = np.concatenate([[0], np.flatnonzero(np.any(coarse[1:] != coarse[:-1], axis=1)) + 1])
+        ends = np.concatenate([starts[1:], [coarse.shape[0]]])
+        for start, end in zip(starts, ends):
+            cell = tuple(int(c) for c in coarse[start])
+            self.pending[cell].append((ids[start:end], fine[start:end]))
+        self.size += coarse.shape[0]
+
+    def get_cell_arrays(self, cell):
+        """
+        Retrieve the ids and fine codes of a cell bucket, codes added since the last
+        retrieval of the cell are consolidated into its contiguous arrays.
+
+        :param tuple cell:
+            a cell tuple
+
+        :returns ndarray ids:
+            the ids of items in this cell bucket
+        :returns ndarray fine:
+            the (n, M) fine codes of items in this cell bucket
+        """
+        chunks = self.pending.pop(cell, None)
+        if chunks:
+            if cell in self.index:
+                chunks.insert(0, self.index[cell])
+            self.index[cell] = (np.concatenate([c[0] for c in chunks]),
+                                np.ascontiguousarray(np.concatenate([c[1] for c in chunks])))
+        if cell in self.index:
+            return self.index[cell]
+        return np.zeros(0, dtype=np.int64), np.zeros((0, self.model.M), dtype=self.fine_dtype)
+
+    def get_code_arrays(self):
+        """
+        Retrieve all codes in the search index as arrays, e.g. to save the index and
+        restore it later with add_code_arrays.
+
+        :returns ndarray coarse:
+            an (N, 2) array of coarse codes
+        :returns ndarray fine:
+            an (N, M) array of fine codes
+        :returns ndarray ids:
+            an array of N ids
+        """
+        cells = sorted(set(self.index.keys()) | set(self.pending.keys()))
+        coarse, fine, ids = [np.zeros((0, 2), dtype=np.int32)], [np.zeros((0, self.model.M), dtype=self.fine_dtype)], \
+            [np.zeros(0, dtype=np.int64)]
+        for cell in cells:
+            cell_ids, cell_fine = self.get_cell_arrays(cell)
+            coarse.append(np.tile(np.array(cell, dtype=np.int32), (len(cell_ids), 1)))
+            fine.append(cell_fine)
+            ids.append(cell_ids)
+        return np.concatenate(coarse), np.concatenate(fine), np.concatenate(ids)
+
+    def get_cell(self, cell):
+        """
+        Retrieve a cell bucket from the index.
+
+        :param tuple cell:
+            a cell tuple
+
+        :returns list:
+            the list of index items in this cell bucket
+        """
+        ids, fine = self.get_cell_arrays(cell)
+        return [(item_id, (cell, tuple(f))) for item_id, f in zip(ids.tolist(), fine.tolist())]
+
+    def get_distance_table(self, x, cell, memoized_subquant_dists):
+        """
+        Return the (M, subquantizer_clusters) table of squared distances of the query projected
+        into the local space of the cell to each subquantizer cluster, memoized per coarse cluster.
+        """
+        d0, d1 = memoized_subquant_dists
+        c0, c1 = cell
+        if c0 not in d0:
+            d0[c0] = np.array(self.model.get_subquantizer_distances(x, cell, coarse_split=0))
+        if c1 not in d1:
+            d1[c1] = np.array(self.model.get_subquantizer_distances(x, cell, coarse_split=1))
+        return np.vstack([d0[c0], d1[c1]])
+
+    def search_arrays(self, x, quota=10, limit=None):
+        """
+        Return the ids and distances of the euclidean distance ranked results, along with
+        the number of cells traversed to fill the quota.
+
+        :param ndarray x:
+            a query vector
+        :param int quota:
+            the number of desired results to rank
+        :param int limit:
+            the number of desired results to return - defaults to quota
+
+        :returns ndarray ids:
+            the ids of ranked results
+        :returns ndarray dists:
+            the distances of ranked results
+        :returns ndarray positions:
+            an array of (cell position, row) pairs locating each result in the returned cells
+        :returns list cells:
+            the list of (cell, ids, fine codes) of retrieved cells
+        :returns int visited:
+            the number of cells visited in the query
+        """
+        if limit is None:
+            limit = quota
+        cells = []
+        retrieved = 0
+        visited = 0
+        for _, cell in multisequence(x, self.model.Cs):
+            ids, fine = self.get_cell_arrays(cell)
+            visited += 1
+            if len(ids):
+                cells.append((cell, ids, fine))
+                retrieved += len(ids)
+            if retrieved >= quota:
+                break
+
+        subquantizers = np.arange(self.model.M)
+        memoized_subquant_dists = [{}, {}]
+        dists = np.concatenate([self.get_distance_table(x, cell, memoized_subquant_dists)[subquantizers, fine].sum(axis=1)
+                                for cell, _, fine in cells]) if cells else np.zeros(0)
+        cell_positions = np.repeat(np.arange(len(cells)), [len(ids) for _, ids, _ in cells])
+        rows = np.concatenate([np.arange(len(ids)) for _, ids, _ in cells]) if cells else np.zeros(0, dtype=np.int64)
+
+        k = min(limit, len(dists))
+        if k < len(dists):
+            top = np.argpartition(dists, k - 1)[:k]
+        else:
+            top = np.arange(len(dists))
+        top = top[np.argsort(dists[top], kind='mergesort')]
+        positions = np.column_stack([cell_positions[top], rows[top]])
+        ids = np.array([cells[c][1][r] for c, r in positions])
+        return ids, dists[top], positions, cells, visited
+
+    def search(self, x, quota=10, limit=None, with_dists=False):
+        """
+        Return euclidean distance ranked results, along with the number of cells
+        traversed to fill the quota.
+
+        :param ndarray x:
+            a query vector
+        :param int quota:
+            the number of desired results to rank
+        :param int limit:
+            the number of desired results to return - defaults to quota
+        :param bool with_dists:
+            boolean indicating whether result items should be returned with their distance
+
+        :returns list results:
+            the list of ranked results
+        :returns int visited:
+            the number of cells visited in the query
+        """
+        ids, dists, positions, cells, visited = self.search_arrays(x, quota, limit)
+        codes = [(cells[c][0], tuple(cells[c][2][r].tolist())) for c, r in positions]
+        if with_dists:
+            Result = namedtuple('Result', ['id', 'code', 'dist'])
+            results = [Result(i, code, d) for i, code, d in zip(ids.tolist(), codes, dists.tolist())]
+        else:
+            Result = namedtuple('Result', ['id', 'code'])
+            results = [Result(i, code) for i, code in zip(ids.tolist(), codes)]
+        return results, visited
+
+
 class LOPQSearcherLMDB(LOPQSearcherBase):
     def __init__(self, model, lmdb_path, id_lambda=int):
         """
@@ -45,6 +45,22 @@ def predict_cluster(x, centroids):
     return ((x - centroids) ** 2).sum(axis=1).argmin(axis=0)
 
 
+def predict_clusters(X, centroids):
+    """
+    Given a matrix of N vectors of dimension D and a matrix of centroids of dimension VxD,
+    return the ids of the closest cluster for each vector
+
+    :params np.array X:
+        the NxD data to assign
+    :params np.array centroids:
+        a matrix of cluster centroids
+    :returns np.array:
+        N cluster assignments
+    """
+    dists = (centroids ** 2).sum(axis=1) - 2 * np.dot(X, centroids.T)
+    return dists.argmin(axis=1)
+
+
 def load_xvecs(filename, base_type='f', max_num=None):
     """
     A helper to read in sift1m binary dataset. This parses the
@@ -174,8 +190,11 @@ def compute_codes_parallel(data, model, num_procs=4):
     :returns iterable:
         an iterable of computed codes in the input order
     """
+    from .model import LOPQCode
+
     def compute_partition(data):
-        return [model.predict(d) for d in data]
+        coarse, fine = model.predict_batch(data)
+        return [LOPQCode(tuple(c), tuple(f)) for c, f in zip(coarse.tolist(), fine.tolist())]
 
     N = len(data)
     partitions = [data[a:b] for a, b in get_chunk_ranges(N, num_procs)]
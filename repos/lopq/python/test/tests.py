@@ -10,7 +10,7 @@ from sklearn.model_selection import train_test_split
 
 sys.path.insert(1, os.path.abspath('..'))
 from lopq.model import LOPQModel, eigenvalue_allocation, accumulate_covariance_estimators, compute_rotations_from_accumulators
-from lopq.search import LOPQSearcher, LOPQSearcherLMDB
+from lopq.search import LOPQSearcher, LOPQSearcherArray, LOPQSearcherLMDB
 from lopq.eval import compute_all_neighbors, get_cell_histogram, get_recall
 
 ########################################
@@ -118,6 +118,16 @@ def test_reconstruction():
     assert_true(np.allclose(expected, r))
 
 
+def test_predict_batch():
+    m = make_random_model()
+    data = np.random.RandomState(7).rand(50, 8)
+    coarse, fine = m.predict_batch(data)
+    for i, x in enumerate(data):
+        codes = m.predict(x)
+        assert_equal(tuple(coarse[i]), codes.coarse)
+        assert_equal(tuple(fine[i]), codes.fine)
+
+
 def test_oxford5k():
 
     random_state = 40
@@ -246,6 +256,42 @@ def test_searcher():
     searcher_instance_battery(searcher, q)
 
 
+def test_searcher_array():
+    data = pkl.load(open(relpath('./testdata/test_searcher_data.pkl')))
+    m = LOPQModel.load_proto(relpath('./testdata/random_test_model.lopq'))
+
+    q = np.ones(8)
+
+    # Test add_data
+    searcher = LOPQSearcherArray(m)
+    searcher.add_data(data)
+    searcher_instance_battery(searcher, q)
+
+    # Test add_codes
+    searcher = LOPQSearcherArray(m)
+    codes = [m.predict(x) for x in data]
+    searcher.add_codes(codes)
+    searcher_instance_battery(searcher, q)
+
+    # Test ranking matches the dict based searcher
+    reference = LOPQSearcher(m)
+    reference.add_codes(codes)
+    for quota in [5, 20, 50]:
+        expected, _ = reference.search(q, quota=quota, with_dists=True)
+        retrieved, _ = searcher.search(q, quota=quota, with_dists=True)
+        assert_true(np.allclose([r.dist for r in expected], [r.dist for r in retrieved]))
+        assert_equal(set(r.id for r in expected), set(r.id for r in retrieved))
+
+    # Test restoring the index from its code arrays
+    restored = LOPQSearcherArray(m)
+    restored.add_code_arrays(*searcher.get_code_arrays())
+    assert_equal(restored.size, len(codes))
+    for quota in [5, 20, 50]:
+        expected, _ = searcher.search(q, quota=quota, with_dists=True)
+        retrieved, _ = restored.search(q, quota=quota, with_dists=True)
+        assert_equal([r.id for r in expected], [r.id for r in retrieved])
+
+
 def test_searcher_lmdb():
     import shutil
 
@@ -1,8 +1,10 @@
 from __future__ import absolute_import
 
 import os
+from multiprocessing.pool import ThreadPool
 
 from celery import Celery
+from celery.concurrency.base import BasePool, apply_target
 from kombu.common import Broadcast
 
 # set the default Django settings module for the 'celery' program.
@@ -35,3 +37,25 @@ app.autodiscover_tasks(lambda: settings.INSTALLED_APPS)
 @app.task(bind=True)
 def debug_task(self):
     print('Request: {0!r}'.format(self.request))
+
+
+class ThreadTaskPool(BasePool):
+    """
+    Runs tasks in threads of the worker process, used by model workers (-P dva.celery:ThreadTaskPool) so that
+    concurrent query tasks share the loaded models and their calls can be batched by ModelServer.
+    """
+    body_can_be_buffer = True
+    signal_safe = False
+
+    def on_start(self):
+        self._pool = ThreadPool(self.limit)
+
+    def on_stop(self):
+        self._pool.close()
+        self._pool.join()
+
+    def on_apply(self, target, args=None, kwargs=None, callback=None, accept_callback=None, **_):
+        return self._pool.apply_async(apply_target, (target, args or (), kwargs or {}, callback, accept_callback))
+
+    def _get_info(self):
+        return {'max-concurrency': self.limit, 'threads': self.limit}
@@ -241,10 +241,13 @@ GLOBAL_MODEL_FLASK_SERVER_PORT = 8989
 GLOBAL_MODEL = 'qglobal_model'  # if a model specific queue does not exists then this is where the task ends up
 GLOBAL_RETRIEVER = 'qglobal_retriever' # if a retriever specific queue does not exists then the task ends up here
 DEFAULT_REDUCER_TIMEOUT_SECONDS = 60 # Reducer tasks checks every 60 seconds if map tasks are finished.
+# Reducer of a sharded retrieval checks this often if the shard tasks are finished, they usually take well below 1s
+SHARD_MERGE_POLL_SECONDS = float(os.environ.get('SHARD_MERGE_POLL_SECONDS', 0.2))
 
 TASK_NAMES_TO_QUEUE = {
     "perform_process_monitoring":Q_REDUCER,
     "perform_training_set_creation":Q_EXTRACTOR,
+    "perform_index_compaction":Q_EXTRACTOR,
     "perform_region_import":Q_EXTRACTOR,
     "perform_model_import":Q_EXTRACTOR,
     "perform_video_segmentation":Q_EXTRACTOR,
@@ -259,6 +262,7 @@ TASK_NAMES_TO_QUEUE = {
     "perform_stream_capture": Q_STREAMER,
     "perform_training": Q_TRAINER,
     "perform_reduce": Q_REDUCER,
+    "perform_retrieval_merge": Q_REDUCER,
     "perform_video_decode_lambda": Q_LAMBDA
 }
 
@@ -282,7 +286,7 @@ RESTARTABLE_TASKS = {
 }
 
 
-NON_PROCESSING_TASKS = {'perform_training','perform_training_set_creation','perform_deletion', 'perform_export'}
+NON_PROCESSING_TASKS = {'perform_training','perform_training_set_creation','perform_index_compaction','perform_deletion', 'perform_export'}
 
 # Is the code running on kubernetes?
 KUBE_MODE = 'KUBE_MODE' in os.environ
@@ -297,3 +301,35 @@ MAX_TASK_ATTEMPTS = 5
 # FAISS
 ENABLE_FAISS = 'DISABLE_FAISS' not in os.environ
 
+# Retrieval result cache, entries expire after TTL and least recently used entries are evicted above max entries
+ENABLE_RETRIEVAL_CACHE = 'DISABLE_RETRIEVAL_CACHE' not in os.environ
+RETRIEVAL_CACHE_TTL_SECONDS = int(os.environ.get('RETRIEVAL_CACHE_TTL_SECONDS', 600))
+RETRIEVAL_CACHE_MAX_ENTRIES = int(os.environ.get('RETRIEVAL_CACHE_MAX_ENTRIES', 10000))
+# Query feature cache keyed by indexer and image content, in redis and in a bounded per process LRU
+ENABLE_FEATURE_CACHE = 'DISABLE_FEATURE_CACHE' not in os.environ
+FEATURE_CACHE_TTL_SECONDS = int(os.environ.get('FEATURE_CACHE_TTL_SECONDS', 86400))
+FEATURE_CACHE_LOCAL_MAX_ENTRIES = int(os.environ.get('FEATURE_CACHE_LOCAL_MAX_ENTRIES', 1000))
+# Retrievers without a persisted index periodically snapshot their state to MEDIA_ROOT/retrievers/ for warm starts,
+# HNSW graphs are persisted at most this often
+ENABLE_RETRIEVER_SNAPSHOTS = 'DISABLE_RETRIEVER_SNAPSHOTS' not in os.environ
+RETRIEVER_SNAPSHOT_INTERVAL_SECONDS = int(os.environ.get('RETRIEVER_SNAPSHOT_INTERVAL_SECONDS', 600))
+# Rows of deleted index entries are tombstoned in loaded retrievers and dropped by a background compaction once
+# they exceed this fraction of the retriever
+RETRIEVER_COMPACTION_FRACTION = float(os.environ.get('RETRIEVER_COMPACTION_FRACTION', 0.2))
+# Index entries which fail to load (e.g. files not synced yet) are retried by this many refreshes, then skipped
+RETRIEVER_LOAD_MAX_ATTEMPTS = int(os.environ.get('RETRIEVER_LOAD_MAX_ATTEMPTS', 5))
+# The deletion feed keeps the primary keys of this many most recently deleted index entries, retrievers which fall
+# further behind check every loaded index entry instead
+RETRIEVER_DELETION_FEED_MAX = int(os.environ.get('RETRIEVER_DELETION_FEED_MAX', 100000))
+# The scheduler periodically launches perform_index_compaction for vector stores with at least this many completed
+# index entries still stored as individual .npy files (0 disables it)
+INDEX_COMPACTION_MIN_ENTRIES = int(os.environ.get('INDEX_COMPACTION_MIN_ENTRIES', 100))
+INDEX_COMPACTION_INTERVAL_MINUTES = int(os.environ.get('INDEX_COMPACTION_INTERVAL_MINUTES', 60))
+# Model workers run tasks in this many threads (1 runs them inline), concurrent query-time model calls are then
+# combined into batches of up to max batch size collected for at most max wait milliseconds
+MODEL_SERVING_THREADS = int(os.environ.get('MODEL_SERVING_THREADS', 1))
+MODEL_SERVING_MAX_BATCH_SIZE = int(os.environ.get('MODEL_SERVING_MAX_BATCH_SIZE', 16))
+MODEL_SERVING_MAX_WAIT_MS = float(os.environ.get('MODEL_SERVING_MAX_WAIT_MS', 10))
+# Approximate memory budget per process for loaded models and retrievers, least recently used ones are evicted
+# once it is exceeded (0 disables eviction)
+MODEL_RESIDENCY_BUDGET_MB = int(os.environ.get('MODEL_RESIDENCY_BUDGET_MB', 0))
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.3 on 2018-06-02 10:12
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dvaapp', '0023_auto_20180601_0338'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='indexentries',
+            name='columns_file_name',
+            field=models.CharField(blank=True, default='', max_length=100),
+        ),
+    ]
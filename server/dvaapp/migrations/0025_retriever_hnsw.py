@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.3 on 2018-06-04 09:31
+from __future__ import unicode_literals
+
+import django.contrib.postgres.fields.jsonb
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dvaapp', '0024_indexentries_columns_file_name'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='retriever',
+            name='arguments',
+            field=django.contrib.postgres.fields.jsonb.JSONField(blank=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name='retriever',
+            name='algorithm',
+            field=models.CharField(choices=[('L', 'LOPQ'), ('E', 'Exact'), ('F', 'FAISS'), ('H', 'HNSW')], db_index=True, default='E', max_length=1),
+        ),
+    ]
@@ -8,11 +8,15 @@ from django.contrib.auth.models import User
 from django.contrib.postgres.fields import JSONField
 from django.conf import settings
 from django.utils import timezone
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
 from dvaclient import constants
 from . import fs
+from dva.in_memory import redis_client
 
 try:
     import numpy as np
+    from dvalib import vector_store
 except ImportError:
     pass
 from uuid import UUID
@@ -319,21 +323,25 @@ class TrainedModel(models.Model):
 
 class Retriever(models.Model):
     """
-    Here Exact is an L2 Flat retriever
+    Here Exact is an L2 Flat retriever and HNSW a graph based approximate retriever over indexer vectors
     """
     EXACT = 'E'
     LOPQ = 'L'
     FAISS = 'F'
+    HNSW = 'H'
     MODES = (
         (LOPQ, 'LOPQ'),
         (EXACT, 'Exact'),
         (FAISS, 'FAISS'),
+        (HNSW, 'HNSW'),
     )
     algorithm = models.CharField(max_length=1, choices=MODES, db_index=True, default=EXACT)
     name = models.CharField(max_length=200, default="")
     indexer_shasum = models.CharField(max_length=40, null=True)
     approximator_shasum = models.CharField(max_length=40, null=True)
     source_filters = JSONField()
+    # algorithm parameters e.g. M, ef_construction, ef_search for HNSW and shards for sharded (scatter-gather) retrieval
+    arguments = JSONField(blank=True, null=True)
     created = models.DateTimeField('date created', auto_now_add=True)
 
 
@@ -517,8 +525,12 @@ class QueryRegionResults(models.Model):
 
 
 class IndexEntries(models.Model):
+    DELETIONS_KEY = "index_entries_deleted_pks"
+    # number of primary keys trimmed from the head of the deletion feed, offsets into the feed count them
+    DELETIONS_TRIMMED_KEY = "index_entries_deleted_trimmed"
     video = models.ForeignKey(Video)
     features_file_name = models.CharField(max_length=100)
+    columns_file_name = models.CharField(max_length=100, default="", blank=True)
     entries = JSONField(blank=True, null=True)
     metadata = JSONField(blank=True, null=True)
     algorithm = models.CharField(max_length=100)
@@ -542,6 +554,12 @@ class IndexEntries(models.Model):
         else:
             return "{}/{}/indexes/{}".format(settings.MEDIA_ROOT, self.video_id, self.features_file_name)
 
+    def columns_path(self, media_root=None):
+        if not (media_root is None):
+            return "{}/{}/indexes/{}".format(media_root, self.video_id, self.columns_file_name)
+        else:
+            return "{}/{}/indexes/{}".format(settings.MEDIA_ROOT, self.video_id, self.columns_file_name)
+
     def load_index(self, media_root=None):
         if media_root is None:
             media_root = settings.MEDIA_ROOT
@@ -552,15 +570,68 @@ class IndexEntries(models.Model):
         if not os.path.isdir(index_dir):
             os.mkdir(index_dir)
         dirnames = {}
-        if self.features_file_name.strip():
+        if self.metadata and self.metadata.get('vector_store', None):
+            vectors = self.load_from_vector_store(media_root)
+        elif self.features_file_name.strip():
             fs.ensure(self.npy_path(media_root=''), dirnames, media_root)
             if self.features_file_name.endswith('.npy'):
-                vectors = np.load(self.npy_path(media_root))
+                vectors = np.load(self.npy_path(media_root), mmap_mode='r')
+            elif self.features_file_name.endswith('.npz'):
+                # binary approximation codes e.g. coarse and fine LOPQ codes
+                with np.load(self.npy_path(media_root)) as codes:
+                    vectors = {k: codes[k] for k in codes.files}
             else:
                 vectors = self.npy_path(media_root)
         else:
             vectors = None
-        return vectors, self.entries
+        return vectors, self.load_entries(media_root)
+
+    def load_entries(self, media_root=None):
+        """
+        Returns entry metadata as a dict of columnar arrays if stored in a sidecar file, otherwise the list of
+        entry dicts stored by older versions.
+        """
+        if self.columns_file_name:
+            fs.ensure(self.columns_path(media_root=''), {}, media_root)
+            with np.load(self.columns_path(media_root)) as columns:
+                return {k: columns[k] for k in columns.files}
+        return self.entries
+
+    def load_from_vector_store(self, media_root):
+        """
+        Returns a zero-copy memory-mapped slice of the consolidated shard the vectors were compacted into.
+        """
+        location = self.metadata['vector_store']
+        shard_path = "/vectors/{}/{}".format(location['store'], location['shard'])
+        local_path = "{}{}".format(media_root.rstrip('/'), shard_path)
+        required_size = (location['offset'] + location['count']) * location['dimensions'] * 4
+        if os.path.isfile(local_path) and os.path.getsize(local_path) < required_size:
+            # shards are append-only, a shorter local copy was synced before this entry was compacted
+            os.remove(local_path)
+        fs.ensure(shard_path, {}, media_root)
+        return vector_store.load_shard_slice(local_path, location['offset'], location['count'],
+                                             location['dimensions'])
+
+
+# appends ARGV[1] to the list KEYS[1] and trims it to the last ARGV[2] items, trimmed items are counted in KEYS[2]
+APPEND_DELETION_SCRIPT = """
+local excess = redis.call('RPUSH', KEYS[1], ARGV[1]) - tonumber(ARGV[2])
+if excess > 0 then
+    redis.call('LTRIM', KEYS[1], excess, -1)
+    redis.call('INCRBY', KEYS[2], excess)
+end
+"""
+
+
+@receiver(post_delete, sender=IndexEntries)
+def index_entries_deleted(sender, instance, **kwargs):
+    """
+    Append the primary key to the deletion feed, retrievers (which only pull entries above their high water mark)
+    read the feed from their last offset and tombstone loaded entries. Also fires for entries removed by cascading
+    deletes e.g. when a video is deleted. Only the last RETRIEVER_DELETION_FEED_MAX primary keys are kept.
+    """
+    redis_client.eval(APPEND_DELETION_SCRIPT, 2, IndexEntries.DELETIONS_KEY, IndexEntries.DELETIONS_TRIMMED_KEY,
+                      instance.pk, settings.RETRIEVER_DELETION_FEED_MAX)
 
 
 class Tube(models.Model):
@@ -645,6 +716,7 @@ class SystemState(models.Model):
     process_stats = JSONField(blank=True, null=True)
     worker_stats = JSONField(blank=True, null=True)
     redis_stats = JSONField(blank=True, null=True)
+    cache_stats = JSONField(blank=True, null=True)
     queues = JSONField(blank=True, null=True)
     hosts = JSONField(blank=True, null=True)
 
@@ -1,25 +1,48 @@
 import logging
 from django.conf import settings
+from ..models import TrainedModel
 
 try:
     from dvalib import analyzer
 except ImportError:
     logging.warning("Could not import analyzer assuming running in front-end mode")
+from .serving import ModelServer
+from .residency import ResidentModels
 
 
 class Analyzers(object):
     _analyzers = {}
+    _name_to_model = {}
 
     @classmethod
     def load_analyzer(self,da):
-        da.ensure()
-        if da.name not in Analyzers._analyzers:
-            aroot = "{}/models/".format(settings.MEDIA_ROOT)
-            if da.name == 'crnn':
-                Analyzers._analyzers[da.name] = analyzer.CRNNAnnotator(aroot + "{}/crnn.pth".format(da.uuid))
-            elif da.name == 'tagger':
-                Analyzers._analyzers[da.name] = analyzer.OpenImagesAnnotator(aroot + "{}/open_images.ckpt".format(da.uuid))
-            elif da.algorithm == 'location_net':
-                Analyzers._analyzers[da.name] = analyzer.LocationNet(aroot + "{}/".format(da.uuid),epoch=da.argumets['epoch'])
-            else:
-                raise ValueError,"analyzer by id {} not found".format(da.pk)
\ No newline at end of file
+        with ModelServer.load_lock:
+            da.ensure()
+            if da.name not in Analyzers._analyzers:
+                aroot = "{}/models/".format(settings.MEDIA_ROOT)
+                if da.name == 'crnn':
+                    Analyzers._analyzers[da.name] = analyzer.CRNNAnnotator(aroot + "{}/crnn.pth".format(da.uuid))
+                elif da.name == 'tagger':
+                    Analyzers._analyzers[da.name] = analyzer.OpenImagesAnnotator(aroot + "{}/open_images.ckpt".format(da.uuid))
+                elif da.algorithm == 'location_net':
+                    Analyzers._analyzers[da.name] = analyzer.LocationNet(aroot + "{}/".format(da.uuid),epoch=da.argumets['epoch'])
+                else:
+                    raise ValueError,"analyzer by id {} not found".format(da.pk)
+            ResidentModels.use("analyzer_{}".format(da.pk), Analyzers._analyzers, da.name,
+                               lambda: ResidentModels.model_bytes(da))
+            return Analyzers._analyzers[da.name]
+
+    @classmethod
+    def get_analyzer(cls,analyzer_name):
+        if analyzer_name not in Analyzers._name_to_model:
+            Analyzers._name_to_model[analyzer_name] = TrainedModel.objects.get(name=analyzer_name,
+                                                                              model_type=TrainedModel.ANALYZER)
+        return cls.load_analyzer(Analyzers._name_to_model[analyzer_name])
+
+    @classmethod
+    def apply_query_batch(cls,analyzer_name,paths):
+        """
+        Analysis of query images, concurrent queries to the same analyzer are batched together by ModelServer.
+        """
+        return ModelServer.serve(('analyzer', analyzer_name),
+                                 lambda batch: cls.get_analyzer(analyzer_name).apply_batch(batch), paths)
@@ -1,14 +1,16 @@
 import logging, uuid, json
+from collections import defaultdict
 from django.conf import settings
 
 try:
-    from dvalib import approximator
+    from dvalib import approximator, retriever
     import numpy as np
 except ImportError:
     np = None
     logging.warning("Could not import indexer / clustering assuming running in front-end mode")
 
 from ..models import TrainedModel, IndexEntries
+from .residency import ResidentModels
 
 
 class Approximators(object):
@@ -55,35 +57,47 @@ class Approximators(object):
                 Approximators._index_approximator[di.pk] = approximator.FAISSApproximator(di.name, model_dirname)
             else:
                 raise ValueError,"unknown approximator type {}".format(di.pk)
+        # retrievers keep a reference to their approximator, an evicted one is freed along with them
+        ResidentModels.use("approximator_{}".format(di.pk), Approximators._index_approximator, di.pk,
+                           lambda: ResidentModels.model_bytes(di), release=lambda approx: None)
         return Approximators._index_approximator[di.pk]
 
     @classmethod
-    def approximate_queryset(cls,approx,da,queryset,event_id):
+    def approximate_queryset(cls,approx,da,queryset,event_id,bulk=True):
+        if da.algorithm == "FAISS" and bulk:
+            return cls.approximate_queryset_bulk(approx,da,queryset,event_id)
         new_approx_indexes = []
         for index_entry in queryset:
             uid = str(uuid.uuid1()).replace('-', '_')
             approx_ind = IndexEntries()
             vectors, entries = index_entry.load_index()
             if da.algorithm == 'LOPQ':
-                for i, e in enumerate(entries):
-                    e['codes'] = approx.approximate(vectors[i, :])
-                approx_ind.entries = entries
-                approx_ind.features_file_name = ""
+                coarse, fine = approx.approximate_batch(np.atleast_2d(vectors).reshape((index_entry.count, -1)))
+                feat_fname = "{}/{}/indexes/{}.npz".format(settings.MEDIA_ROOT, index_entry.video_id, uid)
+                with open(feat_fname, 'w') as featfile:
+                    np.savez(featfile, coarse=coarse.astype(np.uint16),
+                             fine=fine.astype(np.uint8 if approx.model.subquantizer_clusters <= 256 else np.uint16))
+                approx_ind.features_file_name = "{}.npz".format(uid)
             elif da.algorithm == 'PCA':
-                # TODO optimize this by doing matmul rather than calling for each entry
-                approx_vectors = np.array([approx.approximate(vectors[i, :]) for i, e in enumerate(entries)])
+                approx_vectors = approx.approximate_batch(vectors)
                 feat_fname = "{}/{}/indexes/{}.npy".format(settings.MEDIA_ROOT, index_entry.video_id, uid)
                 with open(feat_fname, 'w') as featfile:
                     np.save(featfile, approx_vectors)
                 approx_ind.features_file_name = "{}.npy".format(uid)
-                approx_ind.entries = entries
             elif da.algorithm == "FAISS":
                 feat_fname = "{}/{}/indexes/{}.index".format(settings.MEDIA_ROOT, index_entry.video_id, uid)
                 approx.approximate_batch(np.atleast_2d(vectors.squeeze()),feat_fname)
                 approx_ind.features_file_name = "{}.index".format(uid)
-                approx_ind.entries = entries
             else:
                 raise NotImplementedError("unknown approximation algorithm {}".format(da.algorithm))
+            if isinstance(entries, dict):
+                # each index entry gets its own copy of the columns since importing rewrites primary keys in place
+                columns_fname = "{}/{}/indexes/{}.columns.npz".format(settings.MEDIA_ROOT, index_entry.video_id, uid)
+                with open(columns_fname, 'w') as columns:
+                    np.savez(columns, **entries)
+                approx_ind.columns_file_name = "{}.columns.npz".format(uid)
+            else:
+                approx_ind.entries = entries
             approx_ind.indexer_shasum = index_entry.indexer_shasum
             approx_ind.approximator_shasum = da.shasum
             approx_ind.count = index_entry.count
@@ -96,3 +110,47 @@ class Approximators(object):
             approx_ind.event_id = event_id
             new_approx_indexes.append(approx_ind)
         IndexEntries.objects.bulk_create(new_approx_indexes, batch_size=100)
+
+    @classmethod
+    def approximate_queryset_bulk(cls,approx,da,queryset,event_id):
+        """
+        Stream all index entries of the task into a single FAISS index file per video (and frames / regions),
+        rather than cloning the trained index and writing a file for every index entry.
+        """
+        groups = defaultdict(list)
+        for index_entry in queryset:
+            if index_entry.count > 0:
+                groups[(index_entry.video_id, index_entry.indexer_shasum, index_entry.contains_frames,
+                        index_entry.contains_detections)].append(index_entry)
+        new_approx_indexes = []
+        for (video_id, indexer_shasum, contains_frames, contains_detections), index_entries in groups.items():
+            uid = str(uuid.uuid1()).replace('-', '_')
+            entries_list = []
+
+            def vector_batches():
+                for index_entry in index_entries:
+                    vectors, entries = index_entry.load_index()
+                    entries_list.append(entries)
+                    yield np.atleast_2d(vectors.squeeze())
+
+            feat_fname = "{}/{}/indexes/{}.index".format(settings.MEDIA_ROOT, video_id, uid)
+            count = approx.approximate_stream(vector_batches(), feat_fname)
+            columns_fname = "{}/{}/indexes/{}.columns.npz".format(settings.MEDIA_ROOT, video_id, uid)
+            with open(columns_fname, 'w') as columns:
+                np.savez(columns, **retriever.concatenate_entry_columns(entries_list))
+            approx_ind = IndexEntries()
+            approx_ind.features_file_name = "{}.index".format(uid)
+            approx_ind.columns_file_name = "{}.columns.npz".format(uid)
+            approx_ind.indexer_shasum = indexer_shasum
+            approx_ind.approximator_shasum = da.shasum
+            approx_ind.count = count
+            approx_ind.approximate = True
+            approx_ind.detection_name = '{}_subset_by_{}'.format('regions' if contains_detections else 'frames',
+                                                                 event_id)
+            approx_ind.contains_detections = contains_detections
+            approx_ind.contains_frames = contains_frames
+            approx_ind.video_id = video_id
+            approx_ind.algorithm = da.name
+            approx_ind.event_id = event_id
+            new_approx_indexes.append(approx_ind)
+        IndexEntries.objects.bulk_create(new_approx_indexes, batch_size=100)
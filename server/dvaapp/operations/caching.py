@@ -0,0 +1,154 @@
+import logging, json, hashlib, time, io
+from collections import OrderedDict
+from django.conf import settings
+from dva.in_memory import redis_client
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+    logging.warning("Could not import numpy assuming running in front-end mode")
+
+CACHE_STATS_KEY = "/cache/stats"
+
+
+def record(cache_name, hits, misses):
+    if hits or misses:
+        pipe = redis_client.pipeline()
+        pipe.hincrby(CACHE_STATS_KEY, "{}_hits".format(cache_name), hits)
+        pipe.hincrby(CACHE_STATS_KEY, "{}_misses".format(cache_name), misses)
+        pipe.execute()
+
+
+def get_cache_stats():
+    """
+    Hit / miss counters of all caches e.g. {"retrieval_hits": 10, "retrieval_misses": 2}, recorded in SystemState.
+    """
+    return {k: int(v) for k, v in redis_client.hgetall(CACHE_STATS_KEY).items()}
+
+
+class RetrievalResultCache(object):
+    """
+    Caches ranked results of a query vector in redis keyed by retriever, index version, digest of the query vector
+    quantized to float16, count and search arguments (e.g. nprobe). The index version changes whenever the set of
+    index entries loaded by the retriever changes, hence stale results are never returned and simply expire.
+    """
+    name = "retrieval"
+    lru_key = "/cache/retrieval/lru"
+
+    @classmethod
+    def get_key(cls, retriever_key, version, vector, count, search_arguments=None):
+        digest = hashlib.sha1(np.ascontiguousarray(vector, dtype=np.float16).tobytes()).hexdigest()
+        arguments = json.dumps(search_arguments, sort_keys=True) if search_arguments else ""
+        return "/cache/retrieval/{}/{}/{}/{}/{}".format("_".join(str(k) for k in retriever_key if k is not None),
+                                                       version, digest, count, arguments)
+
+    @classmethod
+    def get_many(cls, keys):
+        values = redis_client.mget(keys) if keys else []
+        now = time.time()
+        hits = [k for k, v in zip(keys, values) if v is not None]
+        if hits:
+            pipe = redis_client.pipeline()
+            for k in hits:
+                pipe.execute_command('ZADD', cls.lru_key, now, k)
+            pipe.execute()
+        record(cls.name, len(hits), len(keys) - len(hits))
+        return [None if v is None else json.loads(v) for v in values]
+
+    @classmethod
+    def set_many(cls, items):
+        """
+        :param items: list of (key, results)
+        """
+        now = time.time()
+        pipe = redis_client.pipeline()
+        for k, results in items:
+            pipe.set(k, json.dumps(results, default=lambda v: v.item()), ex=settings.RETRIEVAL_CACHE_TTL_SECONDS)
+            pipe.execute_command('ZADD', cls.lru_key, now, k)
+        pipe.zcard(cls.lru_key)
+        size = pipe.execute()[-1]
+        if size > settings.RETRIEVAL_CACHE_MAX_ENTRIES:
+            cls.evict(size - settings.RETRIEVAL_CACHE_MAX_ENTRIES)
+
+    @classmethod
+    def evict(cls, count):
+        """
+        Evict the least recently used entries, including entries that already expired.
+        """
+        keys = redis_client.zrange(cls.lru_key, 0, count - 1)
+        if keys:
+            pipe = redis_client.pipeline()
+            pipe.delete(*keys)
+            pipe.zrem(cls.lru_key, *keys)
+            pipe.execute()
+
+
+class FeatureCache(object):
+    """
+    Content addressed cache of query features keyed by (indexer shasum, sha1 of image bytes). Lookups first check a
+    bounded in-process LRU and then redis, a hit skips loading the indexer entirely.
+    """
+    name = "features"
+    _local = OrderedDict()
+
+    @classmethod
+    def get_key(cls, indexer_shasum, image_path):
+        with open(image_path, "rb") as fh:
+            digest = hashlib.sha1(fh.read()).hexdigest()
+        return "/cache/features/{}/{}".format(indexer_shasum, digest)
+
+    @classmethod
+    def get(cls, key):
+        if key in cls._local:
+            vector = cls._local.pop(key)
+            cls._local[key] = vector
+        else:
+            data = redis_client.get(key)
+            vector = None if data is None else np.load(io.BytesIO(data))
+            if vector is not None:
+                cls.set_local(key, vector)
+        record(cls.name, int(vector is not None), int(vector is None))
+        return vector
+
+    @classmethod
+    def set(cls, key, vector):
+        s = io.BytesIO()
+        np.save(s, vector)
+        redis_client.set(key, s.getvalue(), ex=settings.FEATURE_CACHE_TTL_SECONDS)
+        cls.set_local(key, vector)
+
+    @classmethod
+    def get_many(cls, keys):
+        """
+        Lookup of several keys with a single MGET for those missing from the in-process LRU.
+        """
+        vectors = {k: cls._local[k] for k in keys if k in cls._local}
+        for k in vectors:
+            cls._local[k] = cls._local.pop(k)
+        remote = [k for k in keys if k not in vectors]
+        for k, data in zip(remote, redis_client.mget(remote) if remote else []):
+            if data is not None:
+                vectors[k] = np.load(io.BytesIO(data))
+                cls.set_local(k, vectors[k])
+        record(cls.name, len(vectors), len(keys) - len(vectors))
+        return [vectors.get(k) for k in keys]
+
+    @classmethod
+    def set_many(cls, items):
+        """
+        :param items: list of (key, vector) stored with a single redis pipeline
+        """
+        pipe = redis_client.pipeline()
+        for key, vector in items:
+            s = io.BytesIO()
+            np.save(s, vector)
+            pipe.set(key, s.getvalue(), ex=settings.FEATURE_CACHE_TTL_SECONDS)
+            cls.set_local(key, vector)
+        pipe.execute()
+
+    @classmethod
+    def set_local(cls, key, vector):
+        cls._local[key] = vector
+        while len(cls._local) > settings.FEATURE_CACHE_LOCAL_MAX_ENTRIES:
+            cls._local.popitem(last=False)
@@ -0,0 +1,84 @@
+import logging
+from django.conf import settings
+from django.db.models import Q, Count
+
+try:
+    from dvalib import vector_store
+    import numpy as np
+except ImportError:
+    np = None
+    logging.warning("Could not import vector store assuming running in front-end mode")
+
+from ..models import IndexEntries
+from .. import fs
+
+
+class VectorStores(object):
+    _stores = {}
+
+    @classmethod
+    def get_store_name(cls, indexer_shasum, approximator_shasum=None):
+        if approximator_shasum:
+            return "{}_{}".format(indexer_shasum, approximator_shasum)
+        return indexer_shasum
+
+    @classmethod
+    def get_store(cls, store_name):
+        if store_name not in VectorStores._stores:
+            dirname = "{}/vectors/{}".format(settings.MEDIA_ROOT, store_name)
+            VectorStores._stores[store_name] = vector_store.ShardedVectorStore(dirname)
+        return VectorStores._stores[store_name]
+
+    @classmethod
+    def get_compaction_candidates(cls, min_entries):
+        """
+        (indexer_shasum, approximator_shasum) of the stores with at least min_entries completed index entries whose
+        vectors are still stored as individual .npy files.
+        """
+        queryset = IndexEntries.objects.filter(count__gt=0, event__completed=True, features_file_name__endswith='.npy')
+        queryset = queryset.filter(Q(metadata__isnull=True) | ~Q(metadata__has_key='vector_store'))
+        queryset = queryset.filter(Q(approximate=False) | Q(approximator_shasum__isnull=False))
+        counts = queryset.values('indexer_shasum', 'approximator_shasum').annotate(entries=Count('pk'))
+        return [(c['indexer_shasum'], c['approximator_shasum']) for c in counts if c['entries'] >= min_entries]
+
+    @classmethod
+    def compact(cls, indexer_shasum, approximator_shasum=None):
+        """
+        Copy vectors of completed index entries that are still stored as individual .npy files into the
+        consolidated shards of the store for (indexer, approximator). The per-event .npy files are left in place
+        since export, sync and training continue to read them.
+        :return: number of index entries compacted
+        """
+        store_name = cls.get_store_name(indexer_shasum, approximator_shasum)
+        store = cls.get_store(store_name)
+        queryset = IndexEntries.objects.filter(indexer_shasum=indexer_shasum, count__gt=0, event__completed=True)
+        if approximator_shasum:
+            queryset = queryset.filter(approximator_shasum=approximator_shasum)
+        else:
+            queryset = queryset.filter(approximate=False)
+        compacted = 0
+        shards = set()
+        with store:
+            for di in queryset.order_by('pk').iterator():
+                if (di.metadata and di.metadata.get('vector_store', None)) or \
+                        not di.features_file_name.endswith('.npy'):
+                    continue
+                vectors, _ = di.load_index()
+                vectors = np.atleast_2d(vectors).reshape((-1, vectors.shape[-1]))
+                if vectors.shape[0] != di.count:
+                    logging.warning("Skipping {} with {} vectors for {} entries".format(di.pk, vectors.shape[0],
+                                                                                        di.count))
+                    continue
+                location = store.append(vectors)
+                location['store'] = store_name
+                metadata = di.metadata if di.metadata else {}
+                metadata['vector_store'] = location
+                di.metadata = metadata
+                di.save(update_fields=['metadata'])
+                shards.add(location['shard'])
+                compacted += 1
+        if settings.ENABLE_CLOUDFS:
+            for shard in shards:
+                fs.upload_file_to_remote("/vectors/{}/{}".format(store_name, shard), cache=False)
+        logging.info("Compacted {} index entries into {} shard(s) of {}".format(compacted, len(shards), store_name))
+        return compacted
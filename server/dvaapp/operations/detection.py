@@ -1,5 +1,7 @@
 import logging
 from ..models import TrainedModel
+from .serving import ModelServer
+from .residency import ResidentModels
 try:
     from dvalib import detector
 except ImportError:
@@ -11,22 +13,37 @@ class Detectors(object):
 
     @classmethod
     def load_detector(cls,cd):
-        cd.ensure()
-        if cd.pk not in Detectors._detectors:
-            if cd.detector_type == TrainedModel.TFD:
-                Detectors._detectors[cd.pk] = detector.TFDetector(model_path=cd.get_model_path(),
-                                                                  class_index_to_string=
-                                                                  cd.arguments['class_index_to_string'])
-            elif cd.detector_type == TrainedModel.YOLO:
-                    # class_names = {k: v for k, v in json.loads(self.class_names)}
-                    # args = {'root_dir': model_dir,
-                    #         'detector_pk': self.pk,
-                    #         'class_names':{i: k for k, i in class_names.items()}
-                    #         }
-                Detectors._detectors[cd.pk] = detector.YOLODetector(cd.get_yolo_args())
-            elif cd.name == 'face':
-                Detectors._detectors[cd.pk] = detector.FaceDetector()
-            elif cd.name == 'textbox':
-                Detectors._detectors[cd.pk] = detector.TextBoxDetector(model_path=cd.get_model_path())
-            else:
-                raise ValueError,"{}".format(cd.pk)
\ No newline at end of file
+        with ModelServer.load_lock:
+            cd.ensure()
+            if cd.pk not in Detectors._detectors:
+                if cd.detector_type == TrainedModel.TFD:
+                    Detectors._detectors[cd.pk] = detector.TFDetector(model_path=cd.get_model_path(),
+                                                                      class_index_to_string=
+                                                                      cd.arguments['class_index_to_string'])
+                elif cd.detector_type == TrainedModel.YOLO:
+                        # class_names = {k: v for k, v in json.loads(self.class_names)}
+                        # args = {'root_dir': model_dir,
+                        #         'detector_pk': self.pk,
+                        #         'class_names':{i: k for k, i in class_names.items()}
+                        #         }
+                    Detectors._detectors[cd.pk] = detector.YOLODetector(cd.get_yolo_args())
+                elif cd.name == 'face':
+                    Detectors._detectors[cd.pk] = detector.FaceDetector()
+                elif cd.name == 'textbox':
+                    Detectors._detectors[cd.pk] = detector.TextBoxDetector(model_path=cd.get_model_path())
+                else:
+                    raise ValueError,"{}".format(cd.pk)
+            model = Detectors._detectors[cd.pk]
+            if model.session is None:
+                logging.info("loading detection model")
+                model.load()
+            ResidentModels.use("detector_{}".format(cd.pk), Detectors._detectors, cd.pk,
+                               lambda: ResidentModels.model_bytes(cd))
+        return model
+
+    @classmethod
+    def detect_query_batch(cls,cd,paths):
+        """
+        Detections in query images, concurrent queries to the same detector are batched together by ModelServer.
+        """
+        return ModelServer.serve(('detector', cd.pk), lambda batch: cls.load_detector(cd).detect_batch(batch), paths)
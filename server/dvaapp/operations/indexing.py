@@ -1,4 +1,5 @@
-import logging, json, uuid, tempfile, os
+import logging, json, uuid, os
+from collections import OrderedDict
 from PIL import Image
 from django.conf import settings
 
@@ -9,7 +10,10 @@ except ImportError:
     np = None
     logging.warning("Could not import indexer / clustering assuming running in front-end mode")
 
-from ..models import IndexEntries, TrainedModel
+from ..models import IndexEntries, TrainedModel, Frame, Region
+from .caching import FeatureCache
+from .serving import ModelServer
+from .residency import ResidentModels
 
 
 class Indexers(object):
@@ -17,21 +21,35 @@ class Indexers(object):
     _shasum_to_index = {}
     _name_to_index = {}
     _session = None
+    _entry_offsets = {}
+    # regions cropped in memory are indexed in batches, bounding the number of decoded frames referenced by crops
+    CROP_BATCH_SIZE = 256
+    DECODED_FRAMES = 8
 
     @classmethod
-    def get_index_by_name(cls,name):
+    def get_indexer_by_name(cls,name):
         if name not in Indexers._name_to_index:
             di = TrainedModel.objects.get(name=name,model_type=TrainedModel.INDEXER)
             Indexers._name_to_index[name] = di
         else:
             di = Indexers._name_to_index[name]
+        return di
+
+    @classmethod
+    def get_index_by_name(cls,name):
+        di = cls.get_indexer_by_name(name)
         return cls.get_index(di),di
-    
+
     @classmethod
-    def get_index_by_pk(cls,pk):
+    def get_indexer_by_pk(cls,pk):
         di = TrainedModel.objects.get(pk=pk)
         if di.model_type != TrainedModel.INDEXER:
             raise ValueError("Model {} id: {} is not an Indexer".format(di.name,di.pk))
+        return di
+
+    @classmethod
+    def get_index_by_pk(cls,pk):
+        di = cls.get_indexer_by_pk(pk)
         return cls.get_index(di),di
     
     @classmethod
@@ -45,87 +63,214 @@ class Indexers(object):
 
     @classmethod
     def get_index(cls,di):
-        di.ensure()
-        if di.pk not in Indexers._visual_indexer:
-            iroot = "{}/models/".format(settings.MEDIA_ROOT)
-            if di.name == 'inception':
-                Indexers._visual_indexer[di.pk] = indexer.InceptionIndexer(iroot + "{}/network.pb".format(di.uuid))
-            elif di.name == 'facenet':
-                Indexers._visual_indexer[di.pk] = indexer.FacenetIndexer(iroot + "{}/facenet.pb".format(di.uuid))
-            elif di.algorithm == 'vgg':
-                Indexers._visual_indexer[di.pk] = indexer.VGGIndexer(iroot + "{}/{}".format(di.uuid,di.files[0]['filename']))
+        with ModelServer.load_lock:
+            di.ensure()
+            if di.pk not in Indexers._visual_indexer:
+                iroot = "{}/models/".format(settings.MEDIA_ROOT)
+                if di.name == 'inception':
+                    Indexers._visual_indexer[di.pk] = indexer.InceptionIndexer(iroot + "{}/network.pb".format(di.uuid))
+                elif di.name == 'facenet':
+                    Indexers._visual_indexer[di.pk] = indexer.FacenetIndexer(iroot + "{}/facenet.pb".format(di.uuid))
+                elif di.algorithm == 'vgg':
+                    Indexers._visual_indexer[di.pk] = indexer.VGGIndexer(iroot + "{}/{}".format(di.uuid,di.files[0]['filename']))
+                else:
+                    raise ValueError,"unregistered indexer with id {}".format(di.pk)
+            ResidentModels.use("indexer_{}".format(di.pk), Indexers._visual_indexer, di.pk,
+                               lambda: ResidentModels.model_bytes(di))
+            return Indexers._visual_indexer[di.pk]
+
+    @classmethod
+    def index_query_paths(cls,di,image_paths):
+        """
+        Features of query images, concurrent queries to the same indexer are batched together by ModelServer.
+        """
+        return ModelServer.serve(('indexer', di.pk), lambda paths: cls.get_index(di).index_paths(paths), image_paths)
+
+    @classmethod
+    def apply_cached(cls,di,image_path):
+        """
+        Features of a query image, served from FeatureCache when the same image was indexed by the same indexer.
+        """
+        if not settings.ENABLE_FEATURE_CACHE:
+            return cls.index_query_paths(di, [image_path])[0]
+        key = FeatureCache.get_key(di.shasum if di.shasum else di.uuid, image_path)
+        vector = FeatureCache.get(key)
+        if vector is None:
+            vector = cls.index_query_paths(di, [image_path])[0]
+            FeatureCache.set(key, vector)
+        return vector
+
+    @classmethod
+    def apply_cached_batch(cls,di,image_paths):
+        """
+        Features of several query images (e.g. query regions) in the same order, images missing from FeatureCache are
+        indexed together with index_paths i.e. in batches for indexers that support batching.
+        """
+        if not image_paths:
+            return []
+        if not settings.ENABLE_FEATURE_CACHE:
+            return cls.index_query_paths(di, image_paths)
+        keys = [FeatureCache.get_key(di.shasum if di.shasum else di.uuid, path) for path in image_paths]
+        vectors = FeatureCache.get_many(keys)
+        missing = [i for i, vector in enumerate(vectors) if vector is None]
+        if missing:
+            features = cls.index_query_paths(di, [image_paths[i] for i in missing])
+            for i, vector in zip(missing, features):
+                vectors[i] = vector
+            FeatureCache.set_many([(keys[i], vectors[i]) for i in missing])
+        return vectors
+
+    @classmethod
+    def get_entry_offsets(cls,index_entry,key):
+        """
+        Map from frame / detection primary key to the row of its vector in the index entry, cached per process.
+        """
+        if (index_entry.pk, key) not in cls._entry_offsets:
+            entries = index_entry.load_entries()
+            if isinstance(entries, dict):
+                keys = entries.get(key, [])
             else:
-                raise ValueError,"unregistered indexer with id {}".format(di.pk)
-        return Indexers._visual_indexer[di.pk]
+                keys = [e.get(key, -1) for e in entries]
+            cls._entry_offsets[(index_entry.pk, key)] = {int(k): i for i, k in enumerate(keys) if k >= 0}
+        return cls._entry_offsets[(index_entry.pk, key)]
+
+    @classmethod
+    def get_stored_vector(cls,indexer_shasum,frame_pk=None,detection_pk=None):
+        """
+        Vector of an already indexed frame or region read from its index entry, hence queries by an existing frame
+        or region need neither the image nor the indexer.
+        """
+        if detection_pk:
+            pk, key, video_id = int(detection_pk), 'detection_primary_key', Region.objects.get(pk=detection_pk).video_id
+            index_entries = IndexEntries.objects.filter(contains_detections=True)
+        else:
+            pk, key, video_id = int(frame_pk), 'frame_primary_key', Frame.objects.get(pk=frame_pk).video_id
+            index_entries = IndexEntries.objects.filter(contains_frames=True)
+        index_entries = index_entries.filter(indexer_shasum=indexer_shasum, approximate=False, video_id=video_id,
+                                             count__gt=0).order_by('-pk')
+        for index_entry in index_entries:
+            offsets = cls.get_entry_offsets(index_entry, key)
+            if pk in offsets:
+                vectors, _ = index_entry.load_index()
+                vectors = np.atleast_2d(vectors).reshape((-1, vectors.shape[-1]))
+                return np.array(vectors[offsets[pk]])
+        raise ValueError("{} {} is not indexed by indexer {}".format(key, pk, indexer_shasum))
+
+    @classmethod
+    def get_frame_image(cls,frame_path,frames):
+        """
+        Decoded RGB array of a frame, the most recently used frames are kept so that each is decoded once.
+        """
+        if frame_path in frames:
+            frames[frame_path] = frames.pop(frame_path)
+        else:
+            frames[frame_path] = np.asarray(Image.open(frame_path).convert('RGB'))
+            if len(frames) > cls.DECODED_FRAMES:
+                frames.popitem(last=False)
+        return frames[frame_path]
+
+    @classmethod
+    def index_crops(cls,visual_index,crops,writer,timings):
+        """
+        :param crops: dict from position in the queryset to cropped array, features are written as they are streamed
+        """
+        positions = sorted(crops)
+        for chunk, features in visual_index.stream_images([crops[k] for k in positions], timings):
+            writer.put([positions[k] for k in chunk], features)
 
     @classmethod
     def index_queryset(cls,di,visual_index,event,target,queryset, cloud_paths=False):
-        visual_index.load()
-        temp_root = tempfile.mkdtemp()
-        entries, paths, images = [], [], {}
-        for i, df in enumerate(queryset):
-            if target == 'frames':
-                entry = {'frame_index': df.frame_index,
-                         'frame_primary_key': df.pk,
-                         'video_primary_key': event.video_id,
-                         'index': i,
-                         'type': 'frame'}
-                if cloud_paths:
-                    paths.append(df.path('{}://{}'.format(settings.CLOUD_FS_PREFIX,settings.MEDIA_BUCKET)))
-                else:
-                    paths.append(df.path())
-            elif target == 'regions':
-                entry = {
-                    'frame_index': df.frame.frame_index,
-                    'detection_primary_key': df.pk,
-                    'frame_primary_key': df.frame.pk,
-                    'video_primary_key': event.video_id,
-                    'index': i,
-                    'type': df.region_type
-                }
-                if df.full_frame:
-                    paths.append(df.frame_path())
-                elif df.materialized:
-                    paths.append(df.path())
+        """
+        Frames, full frame and materialized regions are indexed from their files. Other regions are cropped as
+        numpy slices of their decoded frame and passed to the indexer in memory via index_images. Features are
+        streamed from the indexer in batches and written to the index file by a background FeatureWriter, time
+        spent in each stage is logged once done.
+        """
+        count = len(queryset)
+        if not count:
+            return
+        uid = str(uuid.uuid1()).replace('-','_')
+        dirnames = ['{}/{}/'.format(settings.MEDIA_ROOT,event.video_id),
+                    '{}/{}/indexes/'.format(settings.MEDIA_ROOT,event.video_id)]
+        for dirname in dirnames:
+            if not os.path.isdir(dirname):
+                try:
+                    os.mkdir(dirname)
+                except:
+                    logging.exception("error creating {}".format(dirname))
+                    pass
+        feat_fname = "{}/{}/indexes/{}.npy".format(settings.MEDIA_ROOT,event.video_id,uid)
+        timings = indexer.StageTimings(di.name)
+        writer = indexer.FeatureWriter(feat_fname, count, timings)
+        entries, paths, crops, frames = [], {}, {}, OrderedDict()
+        # the model is shared with query-time batches of ModelServer in threaded model workers
+        model_lock = ModelServer.model_lock(('indexer', di.pk))
+        model_lock.acquire()
+        try:
+            visual_index.load()
+            for i, df in enumerate(queryset):
+                if target == 'frames':
+                    entry = {'frame_index': df.frame_index,
+                             'frame_primary_key': df.pk,
+                             'video_primary_key': event.video_id,
+                             'index': i,
+                             'type': 'frame'}
+                    if cloud_paths:
+                        paths[i] = df.path('{}://{}'.format(settings.CLOUD_FS_PREFIX,settings.MEDIA_BUCKET))
+                    else:
+                        paths[i] = df.path()
+                elif target == 'regions':
+                    entry = {
+                        'frame_index': df.frame.frame_index,
+                        'detection_primary_key': df.pk,
+                        'frame_primary_key': df.frame.pk,
+                        'video_primary_key': event.video_id,
+                        'index': i,
+                        'type': df.region_type
+                    }
+                    if df.full_frame:
+                        paths[i] = df.frame_path()
+                    elif df.materialized:
+                        paths[i] = df.path()
+                    else:
+                        with timings.time('crop'):
+                            crops[i] = indexer.crop_image(cls.get_frame_image(df.frame_path(), frames), df.x, df.y,
+                                                          df.w, df.h)
+                        if len(crops) >= cls.CROP_BATCH_SIZE:
+                            cls.index_crops(visual_index, crops, writer, timings)
+                            crops = {}
                 else:
-                    frame_path = df.frame_path()
-                    if frame_path not in images:
-                        images[frame_path] = Image.open(frame_path)
-                    img2 = images[frame_path].crop((df.x, df.y, df.x + df.w, df.y + df.h))
-                    region_path = df.path(temp_root=temp_root)
-                    img2.save(region_path)
-                    paths.append(region_path)
-            else:
-                raise ValueError,"{} target not configured".format(target)
-            entries.append(entry)
-        if entries:
+                    raise ValueError,"{} target not configured".format(target)
+                entries.append(entry)
             logging.info(paths)  # adding temporary logging to check whether s3:// paths are being correctly used.
             # TODO Ensure that "full frame"/"regions" are not repeatedly indexed.
-            features = visual_index.index_paths(paths)
-            uid = str(uuid.uuid1()).replace('-','_')
-            dirnames = ['{}/{}/'.format(settings.MEDIA_ROOT,event.video_id),
-                        '{}/{}/indexes/'.format(settings.MEDIA_ROOT,event.video_id)]
-            for dirname in dirnames:
-                if not os.path.isdir(dirname):
-                    try:
-                        os.mkdir(dirname)
-                    except:
-                        logging.exception("error creating {}".format(dirname))
-                        pass
-            feat_fname = "{}/{}/indexes/{}.npy".format(settings.MEDIA_ROOT,event.video_id,uid)
-            with open(feat_fname, 'w') as feats:
-                np.save(feats, np.array(features))
-            i = IndexEntries()
-            i.video_id = event.video_id
-            i.count = len(entries)
-            i.contains_detections = target == "regions"
-            i.contains_frames = target == "frames"
-            i.detection_name = '{}_subset_by_{}'.format(target,event.pk)
-            i.algorithm = di.name
-            i.indexer = di
-            i.indexer_shasum = di.shasum
-            i.entries = entries
-            i.features_file_name = feat_fname.split('/')[-1]
-            i.event_id = event.pk
-            i.source_filter_json = event.arguments
-            i.save()
+            if crops:
+                cls.index_crops(visual_index, crops, writer, timings)
+            if paths:
+                positions = sorted(paths)
+                for chunk, features in visual_index.stream_paths([paths[k] for k in positions], timings):
+                    writer.put([positions[k] for k in chunk], features)
+            writer.close()
+        except:
+            writer.abort()
+            raise
+        finally:
+            model_lock.release()
+        timings.log()
+        columns_fname = "{}/{}/indexes/{}.columns.npz".format(settings.MEDIA_ROOT,event.video_id,uid)
+        with open(columns_fname, 'w') as columns:
+            np.savez(columns, **retriever.entries_to_columns(entries))
+        i = IndexEntries()
+        i.video_id = event.video_id
+        i.count = len(entries)
+        i.contains_detections = target == "regions"
+        i.contains_frames = target == "frames"
+        i.detection_name = '{}_subset_by_{}'.format(target,event.pk)
+        i.algorithm = di.name
+        i.indexer = di
+        i.indexer_shasum = di.shasum
+        i.features_file_name = feat_fname.split('/')[-1]
+        i.columns_file_name = columns_fname.split('/')[-1]
+        i.event_id = event.pk
+        i.source_filter_json = event.arguments
+        i.save()
@@ -0,0 +1,114 @@
+import logging, os, threading, gc
+from collections import OrderedDict
+from django.conf import settings
+from dva.in_memory import redis_client
+from .caching import CACHE_STATS_KEY
+from .serving import ModelServer
+
+
+def directory_bytes(dirname):
+    """
+    Size of the files of a model on disk, used as an estimate of the memory taken by the loaded model.
+    """
+    total = 0
+    for root, _, filenames in os.walk(dirname):
+        for filename in filenames:
+            total += os.path.getsize(os.path.join(root, filename))
+    return total
+
+
+def close_session(model):
+    """
+    Release an evicted model by closing its TF session. Models of a threaded model worker might still be running
+    a call in another thread, their sessions are left to be closed by garbage collection instead.
+    """
+    session = getattr(model, 'session', None)
+    if session is not None and hasattr(session, 'close') and not ModelServer.enabled():
+        session.close()
+
+
+class ResidentModels(object):
+    """
+    Per process registry of the models and retrievers held in the class level dicts of Indexers, Detectors,
+    Analyzers, Approximators and Retrievers. Every use is recorded, once the approximate resident size of all
+    registered entries exceeds MODEL_RESIDENCY_BUDGET_MB the least recently used ones are released and removed
+    from their dict, the next use loads them again. Hits, loads and evictions of each model are counted in the
+    cache stats e.g. {"model_indexer_3_hits": 10, "model_indexer_3_loads": 1, "model_indexer_3_evictions": 0}.
+    """
+    _entries = OrderedDict()
+    _model_bytes = {}
+    _lock = threading.RLock()
+
+    @classmethod
+    def model_bytes(cls, dm):
+        """
+        :param dm: TrainedModel, estimated by the size of its files which is computed once per process
+        """
+        if dm.uuid not in cls._model_bytes:
+            cls._model_bytes[dm.uuid] = directory_bytes("{}/models/{}".format(settings.MEDIA_ROOT, dm.uuid))
+        return cls._model_bytes[dm.uuid]
+
+    @classmethod
+    def use(cls, name, owner, key, size, release=close_session):
+        """
+        Record a use of owner[key], loads are uses of a model not registered yet (or replaced in owner since).
+        :param name: name of the model in the stats e.g. "indexer_3"
+        :param owner: dict holding the model under key
+        :param size: function returning the approximate resident bytes of the model, evaluated on every use
+        :param release: called with the model when it is evicted, before it is removed from owner
+        """
+        with cls._lock:
+            entry = cls._entries.pop(name, None)
+            hit = entry is not None and entry['model'] is owner[key]
+            if not hit:
+                entry = {'owner': owner, 'key': key, 'model': owner[key]}
+            entry['release'] = release
+            entry['bytes'] = size()
+            cls._entries[name] = entry
+            evicted = cls.enforce_budget(name)
+        cls.record(name, hit, evicted)
+
+    @classmethod
+    def enforce_budget(cls, current):
+        """
+        Evict least recently used entries other than current until the registered entries fit the budget.
+        """
+        budget = settings.MODEL_RESIDENCY_BUDGET_MB * 1024 * 1024
+        total = sum(entry['bytes'] for entry in cls._entries.values())
+        evicted = []
+        if not budget or total <= budget:
+            return evicted
+        for name in list(cls._entries):
+            if total <= budget:
+                break
+            if name == current:
+                continue
+            entry = cls._entries.pop(name)
+            total -= entry['bytes']
+            cls.evict(name, entry)
+            evicted.append(name)
+        if evicted:
+            gc.collect()
+        if total > budget:
+            logging.warning("{} alone takes {:.1f} MB, above the budget of {} MB".format(
+                current, total / 1e6, settings.MODEL_RESIDENCY_BUDGET_MB))
+        return evicted
+
+    @classmethod
+    def evict(cls, name, entry):
+        owner, key, model = entry['owner'], entry['key'], entry['model']
+        if owner.get(key) is model:
+            try:
+                entry['release'](model)
+            except Exception:
+                logging.exception("Could not release {}".format(name))
+            del owner[key]
+        logging.info("Evicted {} ({:.1f} MB)".format(name, entry['bytes'] / 1e6))
+
+    @classmethod
+    def record(cls, name, hit, evicted):
+        pipe = redis_client.pipeline()
+        pipe.hincrby(CACHE_STATS_KEY, "model_{}_{}".format(name, "hits" if hit else "loads"), 1)
+        for evicted_name in evicted:
+            pipe.hincrby(CACHE_STATS_KEY, "model_{}_evictions".format(evicted_name), 1)
+        pipe.execute()
@@ -1,6 +1,12 @@
-import logging
+import logging, json, hashlib, os, time, threading, inspect
+from django.conf import settings
+from django.db import connection
+from django.db.models import Q, F
+from dva.in_memory import redis_client
 from .approximation import Approximators
 from .indexing import Indexers
+from .caching import RetrievalResultCache
+from .residency import ResidentModels
 try:
     from dvalib import indexer, retriever
     import numpy as np
@@ -9,132 +15,600 @@ except ImportError:
     logging.warning("Could not import indexer / clustering assuming running in front-end mode")
 
 
-from ..models import IndexEntries,QueryResults,Region,Retriever, QueryRegionResults
+from ..models import IndexEntries,QueryResults,Region,Retriever, QueryRegionResults, QueryRegion
+
+# returns the end offset of the deletion feed (list KEYS[1] with KEYS[2] items trimmed from its head), whether items
+# after offset ARGV[1] were trimmed and otherwise these items
+READ_DELETIONS_SCRIPT = """
+local trimmed = tonumber(redis.call('GET', KEYS[2]) or '0')
+local size = redis.call('LLEN', KEYS[1])
+local offset = tonumber(ARGV[1])
+if offset < trimmed then
+    return {trimmed + size, 1, {}}
+end
+return {trimmed + size, 0, redis.call('LRANGE', KEYS[1], offset - trimmed, -1)}
+"""
 
 
 class Retrievers(object):
     _visual_retriever = {}
     _retriever_object = {}
-    _index_count = 0
+    _index_state = {}
+    _locks = {}
+    SHARD_RESULTS_EXPIRE_SECONDS = 3600
 
     @classmethod
-    def get_retriever(cls,retriever_pk):
-        if retriever_pk not in cls._visual_retriever:
+    def get_shard_count(cls, dr):
+        """
+        Number of shards the index entries of a retriever are partitioned into by video_id, set via
+        Retriever.arguments e.g. {"shards": 4}. Each shard is served from its own queue q_retriever_<pk>_<shard>,
+        launched by LAUNCH_BY_NAME_retriever_<name>_<shard> (or _all for every shard of the retriever).
+        """
+        return int(dr.arguments.get('shards', 1)) if dr.arguments else 1
+
+    @classmethod
+    def get_index_dirname(cls, key):
+        """
+        Directory of persisted indexes and snapshots of a retriever (shard) under MEDIA_ROOT/retrievers/
+        """
+        if key[1] is None:
+            return "{}/retrievers/{}".format(settings.MEDIA_ROOT, key[0])
+        return "{}/retrievers/{}_{}".format(settings.MEDIA_ROOT, key[0], key[1])
+
+    @classmethod
+    def get_retriever(cls,retriever_pk,shard=None):
+        key = (retriever_pk, shard)
+        if key not in cls._visual_retriever:
             dr = Retriever.objects.get(pk=retriever_pk)
-            cls._retriever_object[retriever_pk] = dr
-            if dr.algorithm == Retriever.EXACT and dr.approximator_shasum and dr.approximator_shasum.strip():
-                approximator, da = Approximators.get_approximator_by_shasum(dr.approximator_shasum)
-                da.ensure()
-                approximator.load()
-                cls._visual_retriever[retriever_pk] = retriever.BaseRetriever(name=dr.name,approximator=approximator)
-            elif dr.algorithm == Retriever.EXACT:
-                cls._visual_retriever[retriever_pk] = retriever.BaseRetriever(name=dr.name)
-            elif dr.algorithm == Retriever.FAISS and dr.approximator_shasum is None:
-                di = Indexers.get_indexer_by_shasum(dr.indexer_shasum)
-                cls._visual_retriever[retriever_pk] = retriever.FaissFlatRetriever(name=dr.name,
-                                                                                   components=di.arguments['components'])
-            elif dr.algorithm == Retriever.FAISS:
-                approximator, da = Approximators.get_approximator_by_shasum(dr.approximator_shasum)
-                da.ensure()
-                approximator.load()
-                cls._visual_retriever[retriever_pk] = retriever.FaissApproximateRetriever(name=dr.name,
-                                                                                          approximator=approximator)
-            elif dr.algorithm == Retriever.LOPQ:
-                approximator, da = Approximators.get_approximator_by_shasum(dr.approximator_shasum)
-                da.ensure()
-                approximator.load()
-                cls._visual_retriever[retriever_pk] = retriever.LOPQRetriever(name=dr.name,
-                                                                              approximator=approximator)
+            cls._retriever_object[key] = dr
+            cls._visual_retriever[key] = cls.create_retriever(dr, key)
+            cls._index_state[key] = cls.create_index_state()
+            if key not in cls._locks:
+                cls._locks[key] = threading.RLock()
+            cls.warm_start(key)
+            cls.restore_snapshot(key)
+        name = "retriever_{}".format(retriever_pk) if shard is None else "retriever_{}_{}".format(retriever_pk, shard)
+        ResidentModels.use(name, cls._visual_retriever, key, cls._visual_retriever[key].resident_bytes,
+                           release=lambda visual_index: cls.release(key, visual_index))
+        return cls._visual_retriever[key], cls._retriever_object[key]
 
-            else:
-                raise ValueError,"{} not valid retriever algorithm".format(dr.algorithm)
-        return cls._visual_retriever[retriever_pk], cls._retriever_object[retriever_pk]
+    @classmethod
+    def create_retriever(cls, dr, key):
+        index_dirname = cls.get_index_dirname(key)
+        if dr.algorithm == Retriever.EXACT and dr.approximator_shasum and dr.approximator_shasum.strip():
+            approximator, da = Approximators.get_approximator_by_shasum(dr.approximator_shasum)
+            da.ensure()
+            approximator.load()
+            visual_index = retriever.BaseRetriever(name=dr.name,approximator=approximator)
+        elif dr.algorithm == Retriever.EXACT:
+            visual_index = retriever.BaseRetriever(name=dr.name)
+        elif dr.algorithm == Retriever.FAISS and dr.approximator_shasum is None:
+            di = Indexers.get_indexer_by_shasum(dr.indexer_shasum)
+            visual_index = retriever.FaissFlatRetriever(name=dr.name, components=di.arguments['components'])
+        elif dr.algorithm == Retriever.FAISS:
+            approximator, da = Approximators.get_approximator_by_shasum(dr.approximator_shasum)
+            da.ensure()
+            approximator.load()
+            visual_index = retriever.FaissApproximateRetriever(name=dr.name, approximator=approximator,
+                                                               index_dirname=index_dirname)
+        elif dr.algorithm == Retriever.HNSW:
+            di = Indexers.get_indexer_by_shasum(dr.indexer_shasum)
+            arguments = dr.arguments if dr.arguments else {}
+            visual_index = retriever.HNSWRetriever(name=dr.name,
+                                                   components=di.arguments['components'],
+                                                   M=arguments.get('M', 32),
+                                                   ef_construction=arguments.get('ef_construction', 40),
+                                                   ef_search=arguments.get('ef_search', 64),
+                                                   index_dirname=index_dirname,
+                                                   persist_interval=settings.RETRIEVER_SNAPSHOT_INTERVAL_SECONDS)
+        elif dr.algorithm == Retriever.LOPQ:
+            approximator, da = Approximators.get_approximator_by_shasum(dr.approximator_shasum)
+            da.ensure()
+            approximator.load()
+            visual_index = retriever.LOPQRetriever(name=dr.name,
+                                                   approximator=approximator)
+        else:
+            raise ValueError,"{} not valid retriever algorithm".format(dr.algorithm)
+        return visual_index
+
+    @classmethod
+    def create_index_state(cls):
+        # deletions before this offset of the deletion feed are found by warm_start / restore_snapshot
+        return {'high_water_mark': 0, 'pending': set(), 'failures': {}, 'version': None,
+                'deletions': cls.read_deletions(None)[0],
+                'snapshot_ts': 0, 'snapshot_size': 0, 'compacting': False, 'compactions': 0}
+
+    @classmethod
+    def release(cls, key, visual_index):
+        """
+        Called when the retriever is evicted by ResidentModels, its state is saved (snapshot or persisted index)
+        so that loading it again is a warm start.
+        """
+        with cls._locks[key]:
+            state = cls._index_state[key]
+            if settings.ENABLE_RETRIEVER_SNAPSHOTS and visual_index.snapshots and \
+                    len(visual_index.loaded_entries) != state['snapshot_size']:
+                cls.write_snapshot(key)
+            visual_index.persist(force=True)
+            visual_index.close()
+            del cls._retriever_object[key]
+            del cls._index_state[key]
+
+    @classmethod
+    def warm_start(cls, key):
+        """
+        Register index entries already in a persisted index (FAISS on-disk inverted lists, HNSW graph), only their
+        entry metadata is loaded. Rows of index entries deleted since are tombstoned.
+        :param key: (retriever primary key, shard)
+        """
+        visual_index = cls._visual_retriever[key]
+        keys = list(getattr(visual_index, 'persisted_pending', []))
+        if not keys:
+            return
+        counts = dict(visual_index.persisted_entries)
+        index_entries = {di.pk: di for di in IndexEntries.objects.filter(pk__in=keys)}
+        for pk in keys:
+            start_index = visual_index.findex
+            entries = index_entries[pk].load_entries() if pk in index_entries else [{}] * counts[pk]
+            visual_index.load_index(None, entries, key=pk)
+            visual_index.loaded_entries[pk] = indexer.IndexRange(start=start_index, end=visual_index.findex-1)
+        cls.delete_entries(key, [pk for pk in keys if pk not in index_entries])
+        logging.info("Warm started retriever {} with {} index entries".format(key, len(keys)))
+
+    @classmethod
+    def get_snapshot_signature(cls, key):
+        """
+        A snapshot is only restored by a retriever with the same algorithm, models, source filters and sharding.
+        """
+        dr = cls._retriever_object[key]
+        return hashlib.sha1(json.dumps([dr.algorithm, dr.indexer_shasum, dr.approximator_shasum, dr.source_filters,
+                                        key[1], cls.get_shard_count(dr)], sort_keys=True)).hexdigest()
+
+    @classmethod
+    def restore_snapshot(cls, key):
+        """
+        Restore the index, entry metadata and loaded entries saved by write_snapshot, the next refresh only loads
+        index entries newer than the snapshot. Rows of index entries deleted since the snapshot are tombstoned.
+        """
+        visual_index = cls._visual_retriever[key]
+        path = "{}/snapshot.npz".format(cls.get_index_dirname(key))
+        if not (settings.ENABLE_RETRIEVER_SNAPSHOTS and visual_index.snapshots and os.path.isfile(path)):
+            return
+        try:
+            arrays = retriever.load_snapshot(path)
+        except Exception:
+            logging.exception("Could not read snapshot {}".format(path))
+            return
+        if str(arrays['signature']) != cls.get_snapshot_signature(key):
+            logging.info("Snapshot {} was created for a different retriever configuration, ignoring".format(path))
+            return
+        visual_index.restore_snapshot(arrays)
+        state = cls._index_state[key]
+        state['high_water_mark'] = int(arrays['high_water_mark'])
+        state['pending'] = set(arrays['pending'].tolist())
+        state['snapshot_ts'], state['snapshot_size'] = time.time(), len(visual_index.loaded_entries)
+        cls.delete_missing_entries(key)
+        logging.info("Restored retriever {} with {} index entries from {}".format(key, state['snapshot_size'],
+                                                                                  path))
+
+    @classmethod
+    def remove_snapshot(cls, key):
+        path = "{}/snapshot.npz".format(cls.get_index_dirname(key))
+        if os.path.isfile(path):
+            os.remove(path)
+
+    @classmethod
+    def write_snapshot(cls, key):
+        visual_index = cls._visual_retriever[key]
+        state = cls._index_state[key]
+        index_dirname = cls.get_index_dirname(key)
+        if not os.path.isdir(index_dirname):
+            os.makedirs(index_dirname)
+        arrays = visual_index.snapshot_arrays()
+        arrays['signature'] = np.array(cls.get_snapshot_signature(key))
+        arrays['high_water_mark'] = np.array(state['high_water_mark'], dtype=np.int64)
+        arrays['pending'] = np.array(sorted(state['pending']), dtype=np.int64)
+        retriever.write_snapshot("{}/snapshot.npz".format(index_dirname), arrays)
+        state['snapshot_ts'], state['snapshot_size'] = time.time(), len(visual_index.loaded_entries)
+        logging.info("Wrote snapshot of retriever {} with {} index entries".format(key, state['snapshot_size']))
+
+    @classmethod
+    def delete_entries(cls, key, index_entry_pks):
+        """
+        Tombstone rows of deleted index entries, they are excluded from results without rebuilding the retriever.
+        """
+        visual_index = cls._visual_retriever[key]
+        rows = visual_index.delete(index_entry_pks)
+        if rows:
+            cls._index_state[key]['version'] = None
+            logging.info("Tombstoned {} rows of deleted index entries in retriever {}, {:.1%} of rows are "
+                         "tombstoned".format(rows, key, visual_index.deleted_fraction()))
+        return rows
+
+    @classmethod
+    def delete_missing_entries(cls, key):
+        """
+        Tombstone loaded index entries which no longer exist, used when the deletion feed cannot be followed.
+        """
+        loaded = cls._visual_retriever[key].loaded_entries.keys()
+        if loaded:
+            existing = set(IndexEntries.objects.filter(pk__in=loaded).values_list('pk', flat=True))
+            cls.delete_entries(key, [pk for pk in loaded if pk not in existing])
+
+    @classmethod
+    def read_deletions(cls, offset):
+        """
+        :param offset: offset into the deletion feed, None only returns its end
+        :return: (end offset, whether primary keys after offset were trimmed, primary keys after offset)
+        """
+        if offset is None:
+            pipe = redis_client.pipeline()
+            pipe.get(IndexEntries.DELETIONS_TRIMMED_KEY)
+            pipe.llen(IndexEntries.DELETIONS_KEY)
+            trimmed, size = pipe.execute()
+            return int(trimmed or 0) + size, False, []
+        end, trimmed, deleted = redis_client.eval(READ_DELETIONS_SCRIPT, 2, IndexEntries.DELETIONS_KEY,
+                                                  IndexEntries.DELETIONS_TRIMMED_KEY, offset)
+        return end, bool(trimmed), [int(pk) for pk in deleted]
+
+    @classmethod
+    def follow_deletions(cls, key):
+        """
+        Read primary keys of index entries deleted since the last refresh from the deletion feed (a redis list
+        appended to by the post_delete signal of IndexEntries) and tombstone the loaded ones. The feed is trimmed
+        to its last RETRIEVER_DELETION_FEED_MAX items, a retriever which fell further behind checks all its entries.
+        """
+        state = cls._index_state[key]
+        end, trimmed, deleted = cls.read_deletions(state['deletions'])
+        if end < state['deletions']:
+            logging.warning("Deletion feed was reset, checking all index entries loaded by {}".format(key))
+            cls.delete_missing_entries(key)
+        elif trimmed:
+            logging.warning("Deletion feed was trimmed past the offset of {}, checking all its index "
+                            "entries".format(key))
+            cls.delete_missing_entries(key)
+        elif deleted:
+            cls.delete_entries(key, deleted)
+        state['deletions'] = end
 
     @classmethod
-    def refresh_index(cls, dr):
+    def compact(cls, key):
         """
-        :param index_name:
+        Physically drop tombstoned rows, runs in a background thread started by refresh_index. The compacted index
+        is built without holding the lock of the retriever so that searches proceed meanwhile, under the lock rows
+        loaded or tombstoned since the compaction started are carried over and the compacted index is swapped in.
+        """
+        state = cls._index_state[key]
+        try:
+            start = time.time()
+            with cls._locks[key]:
+                visual_index = cls._visual_retriever[key]
+                compaction = visual_index.start_compaction()
+            if compaction is None:
+                return
+            visual_index.build_compaction(compaction)
+            with cls._locks[key]:
+                if cls._visual_retriever.get(key) is not visual_index:
+                    logging.info("Retriever {} was released during compaction, discarding it".format(key))
+                    return
+                rows = visual_index.finish_compaction(compaction)
+                visual_index.persist()
+                state['compactions'] += 1
+            logging.info("Compacted retriever {}, dropped {} rows in {:.2f}s".format(key, rows, time.time() - start))
+        except Exception:
+            logging.exception("Could not compact retriever {}".format(key))
+        finally:
+            state['compacting'] = False
+            # the thread has its own database connection which Django only closes at the end of requests / tasks
+            connection.close()
+
+    @classmethod
+    def rebuild(cls, key):
+        """
+        Rebuild a retriever which cannot be compacted in place from its live index entries, runs in a background
+        thread started by refresh_index while the current retriever keeps serving searches. Index entries deleted
+        during the rebuild are tombstoned by the next refresh, the deletion feed is followed from where it was when
+        the rebuild started. If the rebuild fails the retriever is dropped and loaded again on its next use.
+        """
+        with cls._locks[key]:
+            dr, current, state = cls._retriever_object[key], cls._visual_retriever[key], cls._index_state[key]
+        try:
+            start = time.time()
+            visual_index, rebuilt_state = cls.create_retriever(dr, key), cls.create_index_state()
+            cls.update_index(dr, key[1], visual_index, rebuilt_state)
+            with cls._locks[key]:
+                if cls._visual_retriever.get(key) is not current:
+                    logging.info("Retriever {} was released during rebuild, discarding it".format(key))
+                    visual_index.close()
+                    return
+                current.close()
+                cls.remove_snapshot(key)
+                rebuilt_state['compactions'] = state['compactions'] + 1
+                cls._visual_retriever[key], cls._index_state[key] = visual_index, rebuilt_state
+            logging.info("Rebuilt retriever {} with {} index entries in {:.2f}s".format(
+                key, len(visual_index.loaded_entries), time.time() - start))
+        except Exception:
+            logging.exception("Could not rebuild retriever {}".format(key))
+            with cls._locks[key]:
+                if cls._visual_retriever.get(key) is current:
+                    current.close()
+                    del cls._visual_retriever[key], cls._retriever_object[key], cls._index_state[key]
+        finally:
+            state['compacting'] = False
+            connection.close()
+
+    @classmethod
+    def refresh_index(cls, dr, shard=None):
+        """
+        Incrementally load index entries added since the last refresh and tombstone deleted ones. Once more than
+        RETRIEVER_COMPACTION_FRACTION of rows are tombstoned they are dropped by a background compaction, retrievers
+        which cannot be compacted in place (FAISS inverted lists, LOPQ) are rebuilt in the background instead.
+        While a rebuild runs index entries added since are not loaded, the rebuilt retriever loads them.
+        :param dr: Retriever
+        :param shard: shard served by this worker, None when the retriever is not sharded
         :return:
         """
-        # This has a BUG where total count of index entries remains unchanged
         # TODO: Waiting for https://github.com/celery/celery/issues/3620 to be resolved to enabel ASYNC index updates
-        # TODO improve this by either having a seperate broadcast queues or using last update timestampl
-        last_count = cls._index_count
-        current_count = IndexEntries.objects.count()
-        visual_index = cls._visual_retriever[dr.pk]
-        if last_count == 0 or last_count != current_count or len(visual_index.loaded_entries) == 0:
-            # update the count
-            cls._index_count = current_count
-            cls.update_index(dr)
+        key = (dr.pk, shard)
+        cls.follow_deletions(key)
+        visual_index = cls._visual_retriever[key]
+        state = cls._index_state[key]
+        if visual_index.deleted_fraction() > settings.RETRIEVER_COMPACTION_FRACTION and not state['compacting']:
+            state['compacting'] = True
+            if visual_index.compaction:
+                compaction = threading.Thread(target=cls.compact, args=(key,))
+            else:
+                logging.info("Retriever {} cannot be compacted in place, rebuilding".format(key))
+                if getattr(visual_index, 'index_dirname', None):
+                    # the on-disk index is only written by the process holding its lock
+                    visual_index.release_persisted()
+                compaction = threading.Thread(target=cls.rebuild, args=(key,))
+            compaction.daemon = True
+            compaction.start()
+        if state['compacting'] and not visual_index.compaction:
+            return
+        cls.update_index(dr, shard)
 
     @classmethod
-    def update_index(cls,dr):
+    def update_index(cls,dr,shard=None,visual_index=None,state=None):
+        """
+        Only entries with primary key above the high water mark, or whose events had not completed during
+        a previous refresh, are queried. Hence the cost of a refresh does not grow with the catalog.
+        A shard only loads entries of videos with video_id % shards == shard.
+        :param visual_index: retriever being rebuilt and its state, by default the loaded retriever of the shard
+        """
         source_filters = dr.source_filters.copy()
-        # Only select entries with completed events, otherwise indexes might not be synced or complete.
-        source_filters['event__completed'] = True
         if dr.indexer_shasum:
             source_filters['indexer_shasum'] = dr.indexer_shasum
         if dr.approximator_shasum:
             source_filters['approximator_shasum'] = dr.approximator_shasum
         else:
             source_filters['approximator_shasum'] = None # Required otherwise approximate index entries are selected
-        index_entries = IndexEntries.objects.filter(**source_filters)
-        visual_index = cls._visual_retriever[dr.pk]
+        if visual_index is None:
+            visual_index, state = cls._visual_retriever[(dr.pk, shard)], cls._index_state[(dr.pk, shard)]
+        index_entries = IndexEntries.objects.filter(**source_filters).filter(
+            Q(pk__gt=state['high_water_mark']) | Q(pk__in=state['pending']))
+        if shard is not None:
+            index_entries = index_entries.annotate(retriever_shard=F('video_id') % cls.get_shard_count(dr)).filter(
+                retriever_shard=shard)
+        index_entries = index_entries.select_related('event').order_by('pk')
+        loaded = len(visual_index.loaded_entries)
         for index_entry in index_entries:
+            state['high_water_mark'] = max(state['high_water_mark'], index_entry.pk)
+            # Only select entries with completed events, otherwise indexes might not be synced or complete.
+            if index_entry.event is None or index_entry.event.errored:
+                state['pending'].discard(index_entry.pk)
+                continue
+            elif not index_entry.event.completed:
+                state['pending'].add(index_entry.pk)
+                continue
+            state['pending'].discard(index_entry.pk)
             if index_entry.pk not in visual_index.loaded_entries and index_entry.count > 0:
-                if visual_index.algorithm == "LOPQ":
-                    vectors, entries = index_entry.load_index()
-                    logging.info("loading approximate index {}".format(index_entry.pk))
-                    start_index = len(visual_index.entries)
-                    visual_index.load_index(entries=entries)
-                    visual_index.loaded_entries[index_entry.pk] = indexer.IndexRange(start=start_index,
-                                                                                     end=len(visual_index.entries)-1)
-                elif visual_index.algorithm == 'FAISS':
-                    index_file_path, entries = index_entry.load_index()
-                    logging.info("loading FAISS index {}".format(index_entry.pk))
-                    start_index = visual_index.findex
-                    visual_index.load_index(index_file_path,entries)
-                    visual_index.loaded_entries[index_entry.pk] = indexer.IndexRange(start=start_index,
-                                                                                     end=visual_index.findex-1)
-                else:
-                    vectors, entries = index_entry.load_index()
-                    logging.info("Starting {} in {} with shape {}".format(index_entry.video_id, visual_index.name,
-                                                                          vectors.shape))
-                    try:
-                        start_index = visual_index.findex
-                        visual_index.load_index(vectors, entries)
-                        visual_index.loaded_entries[index_entry.pk] = indexer.IndexRange(start=start_index,
-                                                                                         end=visual_index.findex-1)
-                    except:
-                        logging.info("ERROR Failed to load {} vectors shape {} entries {}".format(
-                            index_entry.video_id,vectors.shape,len(entries)))
+                try:
+                    cls.load_entry(visual_index, index_entry)
+                except (IOError, OSError, ValueError) as e:
+                    # e.g. files of the index entry are not synced yet, it is retried by the next refreshes
+                    failures = state['failures'].get(index_entry.pk, 0) + 1
+                    if failures < settings.RETRIEVER_LOAD_MAX_ATTEMPTS:
+                        logging.warning("Failed to load index entry {} into {} ({}), attempt {} of {}".format(
+                            index_entry.pk, visual_index.name, e, failures, settings.RETRIEVER_LOAD_MAX_ATTEMPTS))
+                        state['failures'][index_entry.pk] = failures
+                        state['pending'].add(index_entry.pk)
                     else:
-                        logging.info("finished {} in {}".format(index_entry.pk,visual_index.name))
+                        logging.exception("Giving up loading index entry {} into {} after {} attempts".format(
+                            index_entry.pk, visual_index.name, failures))
+                        state['failures'].pop(index_entry.pk, None)
+                else:
+                    state['failures'].pop(index_entry.pk, None)
+        visual_index.persist()
+        if state['version'] is None or len(visual_index.loaded_entries) != loaded:
+            state['version'] = hashlib.sha1(",".join(str(k) for k in sorted(visual_index.loaded_entries))).hexdigest()
+        if settings.ENABLE_RETRIEVER_SNAPSHOTS and visual_index.snapshots and \
+                visual_index is cls._visual_retriever.get((dr.pk, shard)) and \
+                len(visual_index.loaded_entries) != state['snapshot_size'] and \
+                time.time() - state['snapshot_ts'] > settings.RETRIEVER_SNAPSHOT_INTERVAL_SECONDS:
+            cls.write_snapshot((dr.pk, shard))
 
     @classmethod
-    def retrieve(cls,event,retriever_pk,vector,count,region=None):
-        index_retriever,dr = cls.get_retriever(retriever_pk)
-        cls.refresh_index(dr)
+    def load_entry(cls, visual_index, index_entry):
+        if visual_index.algorithm == "LOPQ":
+            codes, entries = index_entry.load_index()
+            logging.info("loading approximate index {}".format(index_entry.pk))
+            start_index = len(visual_index.entries)
+            visual_index.load_index(codes, entries)
+            visual_index.loaded_entries[index_entry.pk] = indexer.IndexRange(start=start_index,
+                                                                             end=len(visual_index.entries)-1)
+        elif visual_index.algorithm == 'FAISS':
+            index_file_path, entries = index_entry.load_index()
+            logging.info("loading FAISS index {}".format(index_entry.pk))
+            start_index = visual_index.findex
+            visual_index.load_index(index_file_path,entries,key=index_entry.pk)
+            visual_index.loaded_entries[index_entry.pk] = indexer.IndexRange(start=start_index,
+                                                                             end=visual_index.findex-1)
+        else:
+            vectors, entries = index_entry.load_index()
+            logging.info("Starting {} in {} with shape {}".format(index_entry.video_id, visual_index.name,
+                                                                  vectors.shape))
+            start_index = visual_index.findex
+            visual_index.load_index(vectors, entries, key=index_entry.pk)
+            visual_index.loaded_entries[index_entry.pk] = indexer.IndexRange(start=start_index,
+                                                                             end=visual_index.findex-1)
+            logging.info("finished {} in {}".format(index_entry.pk,visual_index.name))
+
+    @classmethod
+    def get_stored_vector(cls, args):
+        """
+        Query vector of an existing frame (frame_pk) or region (detection_pk) for a "stored_vector" retrieval, by
+        default the indexer of the retriever is used unless index / stored_indexer_pk is specified.
+        """
+        if 'stored_indexer_pk' in args:
+            indexer_shasum = Indexers.get_indexer_by_pk(args['stored_indexer_pk']).shasum
+        elif 'index' in args:
+            indexer_shasum = Indexers.get_indexer_by_name(args['index']).shasum
+        else:
+            indexer_shasum = Retriever.objects.get(pk=args['retriever_pk']).indexer_shasum
+        return Indexers.get_stored_vector(indexer_shasum, args.get('frame_pk', None), args.get('detection_pk', None))
+
+    @classmethod
+    def retrieve(cls,event,retriever_pk,vector,count,region=None,search_arguments=None,shard=None):
+        regions = None if region is None else [region, ]
+        return cls.retrieve_batch(event,retriever_pk,np.atleast_2d(vector),count,regions,search_arguments,shard)
+
+    @classmethod
+    def retrieve_batch(cls,event,retriever_pk,vectors,count,regions=None,search_arguments=None,shard=None):
+        """
+        Answer a matrix of query vectors (one row per query / query region) with a single nearest_batch call.
+        :param regions: optional list of query regions aligned with rows of vectors
+        :param search_arguments: optional retriever specific search parameters e.g. {"ef_search": 128} for HNSW
+        or {"filters": {"video_id__in": [1, 2], "type": "D"}} to restrict results by entry metadata
+        :param shard: when set only the shard is searched and its top-k lists are stored for merge_shard_results
+        """
+        index_retriever,dr = cls.get_retriever(retriever_pk,shard)
+        with cls._locks[(retriever_pk, shard)]:
+            cls.refresh_index(dr,shard)
+            index_retriever = cls._visual_retriever[(retriever_pk, shard)]
+            batch_results = cls.nearest_batch(index_retriever,(dr.pk,shard),vectors,count,search_arguments)
         # TODO: figure out a better way to store numpy arrays
-        results = index_retriever.nearest(vector=vector,n=count)
-        # TODO: optimize this using batching
-        for rank,r in enumerate(results):
-            qr = QueryRegionResults() if region else QueryResults()
-            if region:
-                qr.query_region = region
-            qr.query = event.parent_process
-            qr.retrieval_event_id = event.pk
-            if 'detection_primary_key' in r:
-                dd = Region.objects.get(pk=r['detection_primary_key'])
-                qr.detection = dd
-                qr.frame_id = dd.frame_id
-            else:
-                qr.frame_id = r['frame_primary_key']
-            qr.video_id = r['video_primary_key']
-            qr.algorithm = dr.algorithm
-            qr.rank = r.get('rank',rank)
-            qr.distance = r.get('dist',rank)
-            qr.save()
+        if shard is not None:
+            cls.store_shard_results(event, shard, batch_results, regions)
+        else:
+            cls.save_results(event, dr, batch_results, regions)
+        return 0
+
+    @classmethod
+    def check_search_arguments(cls, index_retriever, search_arguments):
+        """
+        Search arguments are passed as keyword arguments to nearest_batch of the retriever, unknown ones are
+        rejected with the arguments the retriever accepts.
+        """
+        supported = [a for a in inspect.getargspec(index_retriever.nearest_batch).args
+                     if a not in ('self', 'matrix', 'n')]
+        unsupported = sorted(set(search_arguments) - set(supported))
+        if unsupported:
+            raise ValueError("Search arguments {} are not supported by retriever {} ({}), supported arguments are "
+                             "{}".format(unsupported, index_retriever.name, index_retriever.algorithm, supported))
+
+    @classmethod
+    def nearest_batch(cls, index_retriever, key, vectors, count, search_arguments=None):
+        """
+        Serve query vectors from RetrievalResultCache when possible, only the misses are searched.
+        """
+        search_arguments = search_arguments if search_arguments else {}
+        cls.check_search_arguments(index_retriever, search_arguments)
+        if not settings.ENABLE_RETRIEVAL_CACHE:
+            return index_retriever.nearest_batch(vectors,n=count,**search_arguments)
+        version = cls._index_state[key]['version']
+        cache_keys = [RetrievalResultCache.get_key(key, version, v, count, search_arguments) for v in vectors]
+        batch_results = RetrievalResultCache.get_many(cache_keys)
+        misses = [i for i, results in enumerate(batch_results) if results is None]
+        if misses:
+            for i, results in zip(misses, index_retriever.nearest_batch(vectors[misses],n=count,**search_arguments)):
+                batch_results[i] = results
+            RetrievalResultCache.set_many([(cache_keys[i], batch_results[i]) for i in misses])
+        return batch_results
+
+    @classmethod
+    def store_shard_results(cls, event, shard, batch_results, regions=None):
+        """
+        The scatter event (parent of the shard tasks) identifies the query, results expire if never merged.
+        """
+        payload = {'results': batch_results, 'regions': [r.pk for r in regions] if regions else None}
+        redis_client.set("/retrieval/{}/shards/{}".format(event.parent_id, shard),
+                         json.dumps(payload, default=lambda v: v.item()), ex=cls.SHARD_RESULTS_EXPIRE_SECONDS)
+
+    @classmethod
+    def merge_shard_results(cls, event, retriever_pk, scatter_event_id, shards, count):
+        """
+        Merge the per-shard top-k lists of every query / query region by distance into the final top-k.
+        Shards whose task failed or whose results expired are skipped.
+        """
+        dr = Retriever.objects.get(pk=retriever_pk)
+        merged = {}
+        order = []
+        for shard in range(shards):
+            key = "/retrieval/{}/shards/{}".format(scatter_event_id, shard)
+            payload = redis_client.get(key)
+            if payload is None:
+                logging.warning("Results of shard {} for {} are missing".format(shard, scatter_event_id))
+                continue
+            payload = json.loads(payload)
+            regions = payload['regions'] if payload['regions'] else [None, ] * len(payload['results'])
+            for region_pk, results in zip(regions, payload['results']):
+                if region_pk not in merged:
+                    merged[region_pk] = []
+                    order.append(region_pk)
+                merged[region_pk].extend(results)
+            redis_client.delete(key)
+        batch_results = []
+        for region_pk in order:
+            results = sorted(merged[region_pk], key=lambda r: r['dist'])[:count]
+            for rank, r in enumerate(results):
+                r['rank'] = rank + 1
+            batch_results.append(results)
+        regions = None
+        if order and order[0] is not None:
+            region_objects = QueryRegion.objects.in_bulk(order)
+            regions = [region_objects[pk] for pk in order]
+        cls.save_results(event, dr, batch_results, regions)
+        return 0
+
+    @classmethod
+    def save_results(cls, event, dr, batch_results, regions=None):
+        """
+        Store ranked results of each query / query region as QueryResults / QueryRegionResults.
+        """
+        # Region entries created by older versions may lack the frame primary key, fetch those in one query
+        missing_frames = {r['detection_primary_key'] for results in batch_results for r in results
+                          if 'detection_primary_key' in r and 'frame_primary_key' not in r}
+        region_to_frame = dict(Region.objects.filter(pk__in=missing_frames).values_list('pk','frame_id')) \
+            if missing_frames else {}
+        query_results = []
+        query_region_results = []
+        for qindex, results in enumerate(batch_results):
+            region = regions[qindex] if regions else None
+            for rank,r in enumerate(results):
+                qr = QueryRegionResults() if region else QueryResults()
+                if region:
+                    qr.query_region = region
+                qr.query = event.parent_process
+                qr.retrieval_event_id = event.pk
+                if 'detection_primary_key' in r:
+                    qr.detection_id = r['detection_primary_key']
+                    qr.frame_id = r.get('frame_primary_key', region_to_frame.get(r['detection_primary_key']))
+                else:
+                    qr.frame_id = r['frame_primary_key']
+                qr.video_id = r['video_primary_key']
+                qr.algorithm = dr.algorithm
+                qr.rank = r.get('rank',rank)
+                qr.distance = r.get('dist',rank)
+                if region:
+                    query_region_results.append(qr)
+                else:
+                    query_results.append(qr)
+        if query_results:
+            QueryResults.objects.bulk_create(query_results, batch_size=1000)
+        if query_region_results:
+            QueryRegionResults.objects.bulk_create(query_region_results, batch_size=1000)
         event.parent_process.results_available = True
         event.parent_process.save()
-        return 0
\ No newline at end of file
+        return 0
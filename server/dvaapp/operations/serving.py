@@ -0,0 +1,59 @@
+import logging, threading
+from django.conf import settings
+
+try:
+    from dvalib.serving import MicroBatcher
+except ImportError:
+    logging.warning("Could not import serving assuming running in front-end mode")
+
+
+class ModelServer(object):
+    """
+    Query-time model calls of a model worker running tasks in threads (MODEL_SERVING_THREADS > 1, see ThreadTaskPool
+    in dva/celery.py). Concurrent calls to the same model are combined by a MicroBatcher per model into one batched
+    forward pass of up to MODEL_SERVING_MAX_BATCH_SIZE items, waiting at most MODEL_SERVING_MAX_WAIT_MS for other
+    calls. With a single thread calls are run directly.
+    """
+    _batchers = {}
+    _model_locks = {}
+    _lock = threading.Lock()
+    # guards creating and loading models shared by the threads of the worker
+    load_lock = threading.RLock()
+
+    @classmethod
+    def enabled(cls):
+        return settings.MODEL_SERVING_THREADS > 1
+
+    @classmethod
+    def model_lock(cls, key):
+        """
+        Lock serializing every call to the model identified by key, taken by its MicroBatcher for each batch and by
+        tasks calling the model directly (e.g. indexing a video) since calls share the model's input pipeline.
+        """
+        with cls._lock:
+            if key not in cls._model_locks:
+                cls._model_locks[key] = threading.RLock()
+            return cls._model_locks[key]
+
+    @classmethod
+    def locked(cls, key, apply_batch, items):
+        with cls.model_lock(key):
+            return apply_batch(items)
+
+    @classmethod
+    def serve(cls, key, apply_batch, items):
+        """
+        :param key: identifies the model e.g. ('indexer', pk), apply_batch of the first call with a key is used
+        :param apply_batch: function from a list of items to a list of results
+        :param items: list of items of this call
+        :return: list of results for items
+        """
+        if not cls.enabled():
+            return apply_batch(items)
+        with cls._lock:
+            if key not in cls._batchers:
+                cls._batchers[key] = MicroBatcher(lambda batch: cls.locked(key, apply_batch, batch),
+                                                  settings.MODEL_SERVING_MAX_BATCH_SIZE,
+                                                  settings.MODEL_SERVING_MAX_WAIT_MS / 1000.0,
+                                                  name="_".join(str(k) for k in key))
+        return cls._batchers[key].submit(items)
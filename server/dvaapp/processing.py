@@ -68,6 +68,8 @@ def get_model_specific_queue_name(operation, args):
         queue_name = "q_detector_{}".format(args['detector_pk'])
     elif 'indexer_pk' in args:
         queue_name = "q_indexer_{}".format(args['indexer_pk'])
+    elif 'retriever_pk' in args and 'shard' in args:
+        queue_name = "q_retriever_{}_{}".format(args['retriever_pk'], args['shard'])
     elif 'retriever_pk' in args:
         queue_name = "q_retriever_{}".format(args['retriever_pk'])
     elif 'analyzer_pk' in args:
@@ -294,6 +296,35 @@ def process_next(dt, inject_filters=None, custom_next_tasks=None, sync=True, lau
     return launched
 
 
+def scatter_retrieval(dt, shards):
+    """
+    Fan out a retrieval task as one perform_retrieval task per index shard of the retriever, the reducer polls the
+    shard tasks every SHARD_MERGE_POLL_SECONDS and then launches perform_retrieval_merge which merges their top-k
+    lists into QueryResults.
+    :param dt: retrieval TEvent
+    :param shards: number of shards
+    :return: launched celery task ids
+    """
+    launched = []
+    for shard in range(shards):
+        args = {k: v for k, v in dt.arguments.items() if k not in {'map', 'reduce'}}
+        args['shard'] = shard
+        if args.get('target', 'query') == 'query':
+            args['vector_key'] = args.get('vector_key', dt.parent_id)
+        launched += launch_tasks({'operation': 'perform_retrieval', 'arguments': args,
+                                  'task_group_id': dt.task_group_id}, dt, None, None, 'scatter')
+    merge_task = {'operation': 'perform_retrieval_merge', 'task_group_id': dt.task_group_id,
+                  'arguments': {'retriever_pk': dt.arguments['retriever_pk'], 'count': dt.arguments.get('count', 20),
+                                'scatter_event': dt.pk, 'shards': shards}}
+    next_task = TEvent.objects.create(video=dt.video, operation="perform_reduce",
+                                      arguments={'reduce_target': 'root', 'map': [merge_task, ],
+                                                 'timeout': settings.SHARD_MERGE_POLL_SECONDS}, parent=dt,
+                                      task_group_id=dt.task_group_id, parent_process_id=dt.parent_process_id,
+                                      queue=settings.Q_REDUCER)
+    launched.append(app.send_task(next_task.operation, args=[next_task.pk, ], queue=settings.Q_REDUCER).id)
+    return launched
+
+
 def mark_as_completed(start):
     start.completed = True
     if start.start_ts:
@@ -323,7 +354,8 @@ class DVAPQLProcess(object):
             self.process.user = user
         if j['process_type'] == DVAPQL.QUERY:
             image_data = None
-            if j['image_data_b64'].strip():
+            # Queries by an existing frame / region (perform_retrieval with target stored_vector) have no image
+            if j.get('image_data_b64', None) and j['image_data_b64'].strip():
                 image_data = base64.decodestring(j['image_data_b64'])
                 j['image_data_b64'] = None
             self.process.process_type = DVAPQL.QUERY
@@ -6,6 +6,10 @@ from models import Video, Frame, Region, DVAPQL, QueryResults, TEvent, IndexEntr
 import os, json, glob
 from collections import defaultdict
 from django.conf import settings
+try:
+    import numpy as np
+except ImportError:
+    pass
 
 
 class UserSerializer(serializers.HyperlinkedModelSerializer):
@@ -506,12 +510,19 @@ class VideoImporter(object):
             di.created = i['created']
             di.event_id = self.event_to_pk[i['event']]
             di.features_file_name = i['features_file_name']
-            if 'entries_file_name' in i:
+            di.columns_file_name = i.get('columns_file_name', '')
+            if di.columns_file_name:
+                self.import_entry_columns('{}/indexes/{}'.format(self.root, di.columns_file_name))
+                entries = []
+            elif 'entries_file_name' in i:
                 entries = json.load(file('{}/indexes/{}'.format(self.root, i['entries_file_name'])))
             else:
                 entries = i['entries']
             di.detection_name = i['detection_name']
             di.metadata = i.get('metadata', {})
+            if di.metadata:
+                # shard locations refer to the exporting deployment's vector store
+                di.metadata.pop('vector_store', None)
             transformed = []
             for entry in entries:
                 entry['video_primary_key'] = self.video.pk
@@ -520,9 +531,22 @@ class VideoImporter(object):
                 if 'frame_primary_key' in entry:
                     entry['frame_primary_key'] = self.frame_to_pk[entry['frame_primary_key']]
                 transformed.append(entry)
-            di.entries = transformed
+            di.entries = None if di.columns_file_name else transformed
             di.save()
 
+    def import_entry_columns(self, path):
+        with np.load(path) as columns:
+            columns = {k: columns[k] for k in columns.files}
+        columns['frame_primary_key'] = np.array([self.frame_to_pk[k] if k >= 0 else -1
+                                                 for k in columns['frame_primary_key'].tolist()], dtype=np.int64)
+        columns['detection_primary_key'] = np.array([self.region_to_pk[k] if k >= 0 else -1
+                                                     for k in columns['detection_primary_key'].tolist()],
+                                                    dtype=np.int64)
+        columns['video_primary_key'] = np.zeros(len(columns['index']), dtype=np.int32)
+        columns['video_primary_key_values'] = np.array([str(self.video.pk)], dtype=np.str_)
+        with open(path, 'w') as fh:
+            np.savez(fh, **columns)
+
     def bulk_import_frames(self):
         frame_regions = defaultdict(list)
         frames = []
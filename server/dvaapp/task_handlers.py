@@ -1,8 +1,10 @@
 from django.conf import settings
 from .operations import indexing, detection, analysis, approximation
+from .operations.serving import ModelServer
 import io
 import logging
 import tempfile
+import shutil
 from . import task_shared
 from . import models
 from dva.in_memory import redis_client
@@ -16,15 +18,15 @@ except ImportError:
 def handle_perform_indexing(start):
     json_args = start.arguments
     target = json_args.get('target', 'frames')
+    # The indexer is only loaded when needed, query features might be served from FeatureCache
     if 'index' in json_args:
-        index_name = json_args['index']
-        visual_index, di = indexing.Indexers.get_index_by_name(index_name)
+        di = indexing.Indexers.get_indexer_by_name(json_args['index'])
     else:
-        visual_index, di = indexing.Indexers.get_index_by_pk(json_args['indexer_pk'])
+        di = indexing.Indexers.get_indexer_by_pk(json_args['indexer_pk'])
     sync = True
     if target == 'query':
         local_path = task_shared.download_and_get_query_path(start)
-        vector = visual_index.apply(local_path)
+        vector = indexing.Indexers.apply_cached(di, local_path)
         # TODO: figure out a better way to store numpy arrays.
         s = io.BytesIO()
         np.save(s, vector)
@@ -32,22 +34,29 @@ def handle_perform_indexing(start):
         sync = False
     elif target == 'query_regions':
         queryset, target = task_shared.build_queryset(args=start.arguments)
-        region_paths = task_shared.download_and_get_query_region_path(start, queryset)
-        for i, dr in enumerate(queryset):
-            local_path = region_paths[i]
-            vector = visual_index.apply(local_path)
+        regions = list(queryset)
+        region_paths = task_shared.download_and_get_query_region_path(start, regions)
+        # all regions of the query are indexed together and their vectors written with one pipeline / bulk_create
+        vectors = indexing.Indexers.apply_cached_batch(di, region_paths)
+        pipe = redis_client.pipeline()
+        region_vectors = []
+        for dr, vector in zip(regions, vectors):
             s = io.BytesIO()
             np.save(s, vector)
             # can be replaced by Redis instead of using DB
-            redis_client.hset(start.pk, dr.pk, s.getvalue())
-            _ = models.QueryRegionIndexVector.objects.create(vector=s.getvalue(), event=start, query_region=dr)
+            pipe.hset(start.pk, dr.pk, s.getvalue())
+            region_vectors.append(models.QueryRegionIndexVector(vector=s.getvalue(), event=start, query_region=dr))
+        pipe.execute()
+        models.QueryRegionIndexVector.objects.bulk_create(region_vectors, 1000)
         sync = False
     elif target == 'regions':
+        visual_index = indexing.Indexers.get_index(di)
         # For regions simply download/ensure files exists.
         queryset, target = task_shared.build_queryset(args=start.arguments, video_id=start.video_id)
         task_shared.ensure_files(queryset, target)
         indexing.Indexers.index_queryset(di, visual_index, start, target, queryset)
     elif target == 'frames':
+        visual_index = indexing.Indexers.get_index(di)
         queryset, target = task_shared.build_queryset(args=start.arguments, video_id=start.video_id)
         if visual_index.cloud_fs_support and settings.ENABLE_CLOUDFS and (not settings.KUBE_MODE):
             # TODO Re-enable this in Kube Mode when issues with GCS are resolved.
@@ -72,7 +81,7 @@ def handle_perform_index_approximation(start):
         raise ValueError("Could not find approximator {}".format(args))
     if args['target'] == 'index_entries':
         queryset, target = task_shared.build_queryset(args, start.video_id, start.parent_process_id)
-        approximation.Approximators.approximate_queryset(approx, da, queryset, start.pk)
+        approximation.Approximators.approximate_queryset(approx, da, queryset, start.pk, bulk=args.get('bulk', True))
     else:
         raise ValueError("Target {} not allowed, only index_entries are allowed".format(args['target']))
     return True
@@ -92,28 +101,26 @@ def handle_perform_detection(start):
     else:
         detector_name = args['detector']
         cd = models.TrainedModel.objects.get(name=detector_name, model_type=models.TrainedModel.DETECTOR)
-    detection.Detectors.load_detector(cd)
-    detector = detection.Detectors._detectors[cd.pk]
-    if detector.session is None:
-        logging.info("loading detection model")
-        detector.load()
+    detector = detection.Detectors.load_detector(cd)
     if query_flow:
         local_path = task_shared.download_and_get_query_path(start)
-        frame_detections_list.append((None, detector.detect(local_path)))
+        frame_detections_list.append((None, detection.Detectors.detect_query_batch(cd, [local_path])[0]))
     else:
         if 'target' not in args:
             args['target'] = 'frames'
         dv = models.Video.objects.get(id=video_id)
         queryset, target = task_shared.build_queryset(args, video_id, start.parent_process_id)
         task_shared.ensure_files(queryset, target)
-        for k in queryset:
-            if target == 'frames':
-                local_path = k.path()
-            elif target == 'regions':
-                local_path = k.frame_path()
-            else:
-                raise NotImplementedError("Invalid target:{}".format(target))
-            frame_detections_list.append((k, detector.detect(local_path)))
+        # the detector is shared with query-time batches of ModelServer in threaded model workers
+        with ModelServer.model_lock(('detector', cd.pk)):
+            for k in queryset:
+                if target == 'frames':
+                    local_path = k.path()
+                elif target == 'regions':
+                    local_path = k.frame_path()
+                else:
+                    raise NotImplementedError("Invalid target:{}".format(target))
+                frame_detections_list.append((k, detector.detect(local_path)))
     for df, detections in frame_detections_list:
         for d in detections:
             dd = models.QueryRegion() if query_flow else models.Region()
@@ -152,10 +159,7 @@ def handle_perform_analysis(start):
     video_id = start.video_id
     args = start.arguments
     analyzer_name = args['analyzer']
-    if analyzer_name not in analysis.Analyzers._analyzers:
-        da = models.TrainedModel.objects.get(name=analyzer_name, model_type=models.TrainedModel.ANALYZER)
-        analysis.Analyzers.load_analyzer(da)
-    analyzer = analysis.Analyzers._analyzers[analyzer_name]
+    analyzer = analysis.Analyzers.get_analyzer(analyzer_name)
     regions_batch = []
     queryset, target = task_shared.build_queryset(args, video_id, start.parent_process_id)
     query_path = None
@@ -168,6 +172,7 @@ def handle_perform_analysis(start):
         task_shared.ensure_files(queryset, target)
     image_data = {}
     source_regions = []
+    paths = []
     temp_root = tempfile.mkdtemp()
     for i, f in enumerate(queryset):
         if query_regions_paths:
@@ -209,13 +214,21 @@ def handle_perform_analysis(start):
                 path = f.path()
             else:
                 raise NotImplementedError
-        object_name, text, metadata, _ = analyzer.apply(path)
+        paths.append(path)
+        regions_batch.append(a)
+    # regions are analyzed together, analyzers supporting batching run them in batches of analyzer.batch_size
+    if query_regions_paths or query_path:
+        annotations = analysis.Analyzers.apply_query_batch(analyzer_name, paths)
+    else:
+        with ModelServer.model_lock(('analyzer', analyzer_name)):
+            annotations = analyzer.apply_batch(paths)
+    for a, (object_name, text, metadata, _) in zip(regions_batch, annotations):
         a.region_type = models.Region.ANNOTATION
         a.object_name = object_name
         a.text = text
         a.metadata = metadata
         a.event_id = task_id
-        regions_batch.append(a)
+    shutil.rmtree(temp_root)
     if query_regions_paths or query_path:
         models.QueryRegion.objects.bulk_create(regions_batch, 1000)
     else:
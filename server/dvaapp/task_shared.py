@@ -293,6 +293,8 @@ def ensure_files(queryset, target):
     elif target == 'indexes':
         for k in queryset:
             ensure(k.npy_path(media_root=''), dirnames)
+            if k.columns_file_name:
+                ensure(k.columns_path(media_root=''), dirnames)
     else:
         raise NotImplementedError
 
@@ -342,7 +344,12 @@ def import_frame_regions_json(regions_json, video, event_id):
 
 def get_sync_paths(dirname, task_id):
     if dirname == 'indexes':
-        f = [k.npy_path(media_root="") for k in IndexEntries.objects.filter(event_id=task_id) if k.features_file_name]
+        f = []
+        for k in IndexEntries.objects.filter(event_id=task_id):
+            if k.features_file_name:
+                f.append(k.npy_path(media_root=""))
+            if k.columns_file_name:
+                f.append(k.columns_path(media_root=""))
     elif dirname == 'frames':
         f = [k.path(media_root="") for k in Frame.objects.filter(event_id=task_id)]
     elif dirname == 'segments':
@@ -8,11 +8,13 @@ from django.conf import settings
 from dva.celery import app
 from . import models
 from .operations.retrieval import Retrievers
+from .operations.compaction import VectorStores
+from .operations import caching
 from .operations.decoding import VideoDecoder
 from .operations.dataset import DatasetCreator
 from .operations.training import train_lopq, train_faiss
 from .operations.livestreaming import LivestreamCapture
-from .processing import process_next, mark_as_completed
+from .processing import process_next, mark_as_completed, scatter_retrieval, DVAPQLProcess
 from . import global_model_retriever
 from . import task_handlers
 from dva.in_memory import redis_client
@@ -156,6 +158,43 @@ def perform_index_approximation(task_id):
     return next_ids
 
 
+@app.task(track_started=True, name="perform_index_compaction")
+def perform_index_compaction(task_id):
+    dt = get_and_check_task(task_id)
+    if dt is None:
+        return 0
+    args = dt.arguments
+    VectorStores.compact(args['indexer_shasum'], args.get('approximator_shasum', None))
+    next_ids = process_next(dt)
+    mark_as_completed(dt)
+    return next_ids
+
+
+@app.task(track_started=True, name="schedule_index_compaction")
+def schedule_index_compaction():
+    """
+    This task is used by the scheduler to launch perform_index_compaction for vector stores with at least
+    INDEX_COMPACTION_MIN_ENTRIES uncompacted index entries, unless a compaction of the store is already pending.
+    :return:
+    """
+    pending = set()
+    for dt in models.TEvent.objects.filter(operation="perform_index_compaction", completed=False, errored=False,
+                                           created__gt=timezone.now() - timedelta(days=1)):
+        pending.add((dt.arguments['indexer_shasum'], dt.arguments.get('approximator_shasum', None)))
+    for indexer_shasum, approximator_shasum in VectorStores.get_compaction_candidates(
+            settings.INDEX_COMPACTION_MIN_ENTRIES):
+        if (indexer_shasum, approximator_shasum) in pending:
+            continue
+        p = DVAPQLProcess()
+        p.create_from_json({'process_type': models.DVAPQL.PROCESS,
+                            'map': [{'operation': 'perform_index_compaction',
+                                     'arguments': {'indexer_shasum': indexer_shasum,
+                                                   'approximator_shasum': approximator_shasum}}]})
+        p.launch()
+        logging.info("Launched compaction of vector store {} in process {}".format(
+            VectorStores.get_store_name(indexer_shasum, approximator_shasum), p.process.pk))
+
+
 @app.task(track_started=True, name="perform_transformation")
 def perform_transformation(task_id):
     """
@@ -197,21 +236,48 @@ def perform_retrieval(task_id):
         return 0
     args = dt.arguments
     target = args.get('target', 'query')  # by default target is query
+    shard = args.get('shard', None)
+    if shard is None:
+        shards = Retrievers.get_shard_count(models.Retriever.objects.get(pk=args.get('retriever_pk', 20)))
+        if shards > 1:
+            scatter_retrieval(dt, shards)
+            mark_as_completed(dt)
+            return 0
     if target == 'query':
-        vector = np.load(io.BytesIO(redis_client.get(dt.parent_id)))
-        Retrievers.retrieve(dt, args.get('retriever_pk', 20), vector, args.get('count', 20))
+        vector = np.load(io.BytesIO(redis_client.get(args.get('vector_key', dt.parent_id))))
+        Retrievers.retrieve(dt, args.get('retriever_pk', 20), vector, args.get('count', 20),
+                            search_arguments=args.get('search_arguments', None), shard=shard)
+    elif target == 'stored_vector':
+        Retrievers.retrieve(dt, args.get('retriever_pk', 20), Retrievers.get_stored_vector(args),
+                            args.get('count', 20), search_arguments=args.get('search_arguments', None), shard=shard)
     elif target == 'query_region_index_vectors':
         queryset, target = task_shared.build_queryset(args=args)
-        for dr in queryset:
-            vector = np.load(io.BytesIO(dr.vector))
-            Retrievers.retrieve(dt, args.get('retriever_pk', 20), vector, args.get('count', 20),
-                                region=dr.query_region)
+        vectors, regions = [], []
+        for dr in queryset.select_related('query_region'):
+            vectors.append(np.atleast_2d(np.load(io.BytesIO(dr.vector))))
+            regions.append(dr.query_region)
+        if vectors:
+            Retrievers.retrieve_batch(dt, args.get('retriever_pk', 20), np.vstack(vectors), args.get('count', 20),
+                                      regions=regions, search_arguments=args.get('search_arguments', None),
+                                      shard=shard)
     else:
         raise NotImplementedError(target)
     mark_as_completed(dt)
     return 0
 
 
+@app.task(track_started=True, name="perform_retrieval_merge")
+def perform_retrieval_merge(task_id):
+    dt = get_and_check_task(task_id)
+    if dt is None:
+        return 0
+    args = dt.arguments
+    Retrievers.merge_shard_results(dt, args['retriever_pk'], args['scatter_event'], args['shards'],
+                                   args.get('count', 20))
+    mark_as_completed(dt)
+    return 0
+
+
 @app.task(track_started=True, name="perform_dataset_extraction")
 def perform_dataset_extraction(task_id):
     dt = get_and_check_task(task_id)
@@ -681,6 +747,7 @@ def monitor_system():
                      'pending_tasks': models.TEvent.objects.filter(started=False).count(),
                      'completed_tasks': models.TEvent.objects.filter(started=True, completed=True).count()}
     _ = models.SystemState.objects.create(redis_stats=redis_client.info(),
+                                          cache_stats=caching.get_cache_stats(),
                                           process_stats=process_stats,
                                           worker_stats=worker_stats)
 
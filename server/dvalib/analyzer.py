@@ -54,7 +54,7 @@ class OpenImagesAnnotator(BaseAnnotator):
         self.session = None
         self.label_set = 'open_images_tags'
         self.graph_def = None
-        self.input_image = None
+        self.input_images = None
         self.predictions = None
         self.num_classes = 6012
         self.top_n = 25
@@ -80,20 +80,31 @@ class OpenImagesAnnotator(BaseAnnotator):
             config.gpu_options.per_process_gpu_memory_fraction = self.gpu_fraction
             g = tf.Graph()
             with g.as_default():
-                self.input_image = tf.placeholder(tf.string)
-                processed_image = inception_preprocess(self.input_image)
+                # a batch of encoded images, each decoded and resized separately since their sizes differ
+                self.input_images = tf.placeholder(tf.string, shape=[None])
+                processed_images = tf.map_fn(lambda image: inception_preprocess(image)[0], self.input_images,
+                                             dtype=tf.float32)
                 with slim.arg_scope(inception.inception_v3_arg_scope()):
-                    logits, end_points = inception.inception_v3(processed_image, num_classes=self.num_classes, is_training=False)
+                    logits, end_points = inception.inception_v3(processed_images, num_classes=self.num_classes, is_training=False)
                 self.predictions = end_points['multi_predictions'] = tf.nn.sigmoid(logits, name='multi_predictions')
                 saver = tf_saver.Saver()
                 self.session = tf.InteractiveSession(config=config)
                 saver.restore(self.session, self.network_path)
 
     def apply(self,image_path):
+        return self.apply_batch([image_path])[0]
+
+    def apply_batch(self,image_paths):
         if self.session is None:
             self.load()
-        img_data = tf.gfile.FastGFile(image_path).read()
-        predictions_eval = np.squeeze(self.session.run(self.predictions, {self.input_image: img_data}))
+        annotations = []
+        for start in range(0, len(image_paths), self.batch_size):
+            images = [tf.gfile.FastGFile(path).read() for path in image_paths[start:start + self.batch_size]]
+            predictions = self.session.run(self.predictions, {self.input_images: images})
+            annotations.extend(self.annotate(predictions_eval) for predictions_eval in predictions)
+        return annotations
+
+    def annotate(self,predictions_eval):
         results = {self.label_dict.get(self.labelmap[idx], 'unknown'):predictions_eval[idx]
                    for idx in predictions_eval.argsort()[-self.top_n:][::-1]}
         labels = [t for t,v in results.iteritems() if v > 0.1]
@@ -141,6 +152,27 @@ class CRNNAnnotator(BaseAnnotator):
         sim_pred = self.converter.decode(preds.data, preds_size.data, raw=False)
         return self.object_name,sim_pred,{},None
 
+    def apply_batch(self,image_paths):
+        if self.session is None:
+            self.load()
+        annotations = []
+        for start in range(0, len(image_paths), self.batch_size):
+            chunk = image_paths[start:start + self.batch_size]
+            if len(chunk) == 1:
+                annotations.append(self.apply(chunk[0]))
+                continue
+            # every image is resized to 100x32 by the transformer hence they can be stacked into one batch
+            images = torch.stack([self.transformer(Image.open(path).convert('L')) for path in chunk])
+            if self.cuda:
+                images = images.cuda()
+            preds = self.session(Variable(images))
+            _, preds = preds.max(2)
+            preds = preds.transpose(1, 0).contiguous().view(-1)
+            preds_size = Variable(torch.IntTensor([preds.size(0) // len(chunk)] * len(chunk)))
+            sim_preds = self.converter.decode(preds.data, preds_size.data, raw=False)
+            annotations.extend((self.object_name,sim_pred,{},None) for sim_pred in sim_preds)
+        return annotations
+
 
 class LocationNet(BaseAnnotator):
 
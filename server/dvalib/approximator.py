@@ -58,11 +58,28 @@ class LOPQApproximator(BaseApproximator):
         codes = self.model.predict(vector)
         return codes.coarse, codes.fine
 
+    def approximate_batch(self, vectors, num_procs=1):
+        """
+        Transform and encode a matrix of vectors in one pass, when num_procs > 1 the matrix is split into chunks
+        encoded in separate processes.
+        :return: (N, 2) array of coarse codes and (N, M) array of fine codes aligned with rows of vectors
+        """
+        pca_vectors = self.get_pca_matrix(vectors)
+        if num_procs > 1:
+            codes = list(compute_codes_parallel(pca_vectors, self.model, num_procs))
+            return np.array([c.coarse for c in codes]), np.array([c.fine for c in codes])
+        return self.model.predict_batch(pca_vectors)
+
     def get_pca_vector(self, vector):
         if self.model is None:
             self.load()
         return np.dot((self.pca_reduction.transform(vector) - self.mu), self.P).transpose().squeeze()
 
+    def get_pca_matrix(self, vectors):
+        if self.model is None:
+            self.load()
+        return np.dot((self.pca_reduction.transform(np.atleast_2d(vectors)) - self.mu), self.P)
+
 
 class PCAApproximator(BaseApproximator):
     """
@@ -97,6 +114,12 @@ class PCAApproximator(BaseApproximator):
         feats /= np.sqrt(self.pca_eigenvals + 1e-4)
         return feats
 
+    def approximate_batch(self, vectors):
+        if self.pca_eigenvecs is None:
+            self.load()
+        feats = np.atleast_2d(vectors).reshape((-1, self.source_components)) - self.pca_mean
+        return feats.dot(self.pca_eigenvecs) / np.sqrt(self.pca_eigenvals + 1e-4)
+
 
 class FAISSApproximator(BaseApproximator):
 
@@ -121,3 +144,19 @@ class FAISSApproximator(BaseApproximator):
         cloned_index = faiss.clone_index(self.faiss_index)
         cloned_index.add(vectors)
         faiss.write_index(cloned_index, str(output_path))
+
+    def approximate_stream(self, batches, output_path):
+        """
+        Add an iterable of vector matrices to a single clone of the trained index with ids unique across all
+        batches and write it as one file, instead of one index file per batch.
+        :return: number of vectors added
+        """
+        if self.faiss_index is None:
+            self.load()
+        cloned_index = faiss.clone_index(self.faiss_index)
+        for vectors in batches:
+            vectors = np.ascontiguousarray(np.atleast_2d(vectors), dtype=np.float32)
+            ids = np.arange(cloned_index.ntotal, cloned_index.ntotal + vectors.shape[0], dtype=np.int64)
+            cloned_index.add_with_ids(vectors, ids)
+        faiss.write_index(cloned_index, str(output_path))
+        return cloned_index.ntotal
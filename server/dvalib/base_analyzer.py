@@ -1,10 +1,16 @@
-
-
 class BaseAnnotator(object):
 
     def __init__(self):
         self.label_set = None
-        pass
+        # maximum number of images per batch for annotators overriding apply_batch
+        self.batch_size = 32
 
     def apply(self,image_path):
         pass
+
+    def apply_batch(self,image_paths):
+        """
+        :param image_paths: list of image paths
+        :return: list of (object_name, text, metadata, labels) in the same order, by default apply is called per path
+        """
+        return [self.apply(path) for path in image_paths]
@@ -7,5 +7,12 @@ class BaseDetector(object):
     def detect(self,path):
         pass
 
+    def detect_batch(self,paths):
+        """
+        :param paths: list of image paths
+        :return: list of detections of each image, by default detect is called per path
+        """
+        return [self.detect(path) for path in paths]
+
     def load(self):
         pass
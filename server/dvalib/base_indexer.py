@@ -1,4 +1,165 @@
-import logging
+import os, logging, tempfile, shutil, time, threading, multiprocessing
+import numpy as np
+from Queue import Queue
+from collections import defaultdict
+from contextlib import contextmanager
+from PIL import Image
+
+
+def crop_image(image, x, y, w, h):
+    """
+    Crop a decoded HxWx3 array as a numpy slice (no copy), like PIL Image.crop parts of the box outside of the image
+    are filled with zeros in which case the crop is a copy.
+    """
+    height, width = image.shape[:2]
+    x0, y0, x1, y1 = max(x, 0), max(y, 0), min(x + w, width), min(y + h, height)
+    if (x0, y0, x1, y1) == (x, y, x + w, y + h):
+        return image[y:y + h, x:x + w]
+    crop = np.zeros((max(h, 0), max(w, 0)) + image.shape[2:], dtype=image.dtype)
+    if x1 > x0 and y1 > y0:
+        crop[y0 - y:y1 - y, x0 - x:x1 - x] = image[y0:y1, x0:x1]
+    return crop
+
+
+def index_images_as_files(indexer, images):
+    """
+    Fallback for indexers without an in-memory input path, images are written as PNG files to a temporary directory
+    which is removed once they are indexed.
+    """
+    temp_root = tempfile.mkdtemp()
+    try:
+        paths = []
+        for i, image in enumerate(images):
+            paths.append("{}/{}.png".format(temp_root, i))
+            Image.fromarray(np.ascontiguousarray(image)).save(paths[-1])
+        return indexer.index_paths(paths)
+    finally:
+        shutil.rmtree(temp_root)
+
+
+def stream_in_chunks(index, items, batch_size, timings=None):
+    """
+    Index items (paths or decoded arrays) batch_size at a time with index (e.g. indexer.index_paths), yielding
+    (positions, features) for each chunk so that the caller can consume them before all items are indexed.
+    """
+    for start in range(0, len(items), batch_size):
+        chunk_start = time.time()
+        features = index(items[start:start + batch_size])
+        if timings is not None:
+            timings.add('session', time.time() - chunk_start)
+            timings.count += len(features)
+        yield range(start, start + len(features)), features
+
+
+class StageTimings(object):
+    """
+    Wall time spent in each stage of indexing (e.g. crop, session, postprocess, write). The share of session time
+    spent waiting on the input pipeline is estimated from the traced runs added with sample.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.seconds = defaultdict(float)
+        self.count = 0
+        self.sampled_session = 0.0
+        self.sampled_input_wait = 0.0
+        self.start = time.time()
+
+    def add(self, stage, seconds):
+        self.seconds[stage] += seconds
+
+    @contextmanager
+    def time(self, stage):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.seconds[stage] += time.time() - start
+
+    def sample(self, session_seconds, input_wait_seconds):
+        self.sampled_session += session_seconds
+        self.sampled_input_wait += input_wait_seconds
+
+    def summary(self):
+        elapsed = time.time() - self.start
+        stages = ", ".join("{} {:.2f}s".format(stage, seconds) for stage, seconds in
+                           sorted(self.seconds.items(), key=lambda kv: -kv[1]))
+        message = "{} indexed {} images in {:.2f}s ({:.1f} images/s), {}".format(
+            self.name, self.count, elapsed, self.count / elapsed if elapsed else 0.0, stages)
+        if self.sampled_session:
+            message += ", ~{:.0%} of session time waiting on input".format(
+                self.sampled_input_wait / self.sampled_session)
+        return message
+
+    def log(self):
+        logging.info(self.summary())
+
+
+class FeatureWriter(object):
+    """
+    Writes chunks of features into a .npy file from a background thread so that writing overlaps with indexing of
+    the next chunks. The file is memory-mapped and created with the shape of the first chunk's features once it
+    arrives, count is the total number of features.
+    """
+
+    def __init__(self, path, count, timings=None, depth=4):
+        self.path = path
+        self.count = count
+        self.timings = timings
+        self.written = 0
+        self.error = None
+        self.features = None
+        self.queue = Queue(maxsize=depth)
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def put(self, positions, features):
+        if self.error is not None:
+            raise self.error
+        self.queue.put((positions, features))
+
+    def run(self):
+        while True:
+            chunk = self.queue.get()
+            if chunk is None:
+                break
+            if self.error is not None:
+                continue
+            try:
+                start = time.time()
+                positions, features = chunk
+                if self.features is None:
+                    first = np.asarray(features[0])
+                    self.features = np.lib.format.open_memmap(self.path, mode='w+', dtype=first.dtype,
+                                                              shape=(self.count,) + first.shape)
+                for position, feature in zip(positions, features):
+                    self.features[position] = feature
+                self.written += len(positions)
+                if self.timings is not None:
+                    self.timings.add('write', time.time() - start)
+            except Exception as e:
+                self.error = e
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+        if self.written != self.count:
+            raise ValueError("{} features written to {}, expected {}".format(self.written, self.path, self.count))
+        self.features.flush()
+        self.features = None
+
+    def abort(self):
+        """
+        Stop the writer thread and remove the partially written file.
+        """
+        self.queue.put(None)
+        self.thread.join()
+        self.features = None
+        if os.path.isfile(self.path):
+            os.remove(self.path)
 
 
 class BaseIndexer(object):
@@ -7,8 +168,15 @@ class BaseIndexer(object):
         self.net = None
         self.support_batching = False
         self.batch_size = 100
-        self.num_parallel_calls = 3
+        self.num_parallel_calls = int(os.environ.get('INDEXER_PARALLEL_CALLS', multiprocessing.cpu_count()))
+        # batches decoded and preprocessed ahead of inference, 0 disables prefetching
+        self.prefetch = int(os.environ.get('INDEXER_PREFETCH_BATCHES', 2))
+        # every n-th batch is traced to measure time spent waiting on the input pipeline, 0 disables tracing
+        self.trace_every = int(os.environ.get('INDEXER_TRACE_EVERY', 50))
         self.cloud_fs_support = False
+        # indexers with an in-memory input path accept decoded arrays in index_images without temporary files
+        self.array_support = False
+        self.pending_images = []
 
     def apply(self, path):
         raise NotImplementedError
@@ -27,4 +195,19 @@ class BaseIndexer(object):
                 features.append(self.apply(path))
         return features
 
+    def index_images(self, images):
+        """
+        :param images: list of decoded HxWx3 uint8 arrays e.g. crops of regions from a decoded frame
+        :return: list of features in the same order
+        """
+        return index_images_as_files(self, images)
+
+    def stream_paths(self, paths, timings=None):
+        """
+        :param paths: list of image paths
+        :return: generator of (positions, features) for chunks of at most batch_size paths
+        """
+        return stream_in_chunks(self.index_paths, paths, self.batch_size, timings)
 
+    def stream_images(self, images, timings=None):
+        return stream_in_chunks(self.index_images, images, self.batch_size, timings)
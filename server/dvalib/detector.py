@@ -109,14 +109,26 @@ class TFDetector(BaseDetector):
 
 
     def detect(self,image_path,min_score=0.20):
-        self.session.run(self.iterator.initializer, feed_dict={self.filenames_placeholder: [image_path,]})
-        (fname, boxes, scores, classes, num_detections) = self.session.run(
-            [self.fname,self.boxes, self.scores, self.classes, self.num_detections])
+        return self.detect_batch([image_path],min_score)[0]
+
+    def detect_batch(self,image_paths,min_score=0.20):
+        """
+        Images differ in size hence they are run one at a time, but through a single initialization of the iterator.
+        """
+        self.session.run(self.iterator.initializer, feed_dict={self.filenames_placeholder: image_paths})
+        results = []
+        for image_path in image_paths:
+            (fname, boxes, scores, classes, num_detections) = self.session.run(
+                [self.fname,self.boxes, self.scores, self.classes, self.num_detections])
+            results.append(self.to_detections(image_path, boxes, scores, classes, min_score))
+        return results
+
+    def to_detections(self,image_path,boxes,scores,classes,min_score):
         detections = []
+        plimg = PIL.Image.open(image_path)
+        frame_width, frame_height = plimg.size
+        shape = (frame_height,frame_width)
         for i, _ in enumerate(boxes[0]):
-            plimg = PIL.Image.open(image_path)
-            frame_width, frame_height = plimg.size
-            shape = (frame_height,frame_width)
             if scores[0][i] > min_score:
                 top,left = (int(boxes[0][i][0] * shape[0]), int(boxes[0][i][1] * shape[1]))
                 bot,right = (int(boxes[0][i][2] * shape[0]), int(boxes[0][i][3] * shape[1]))
@@ -168,7 +180,7 @@ class YOLODetector(BaseDetector):
             self.session = True
 
 
-class FaceDetector():
+class FaceDetector(BaseDetector):
 
     def __init__(self,session=None,gpu_fraction=None):
         self.image_size = 182
@@ -222,7 +234,7 @@ class FaceDetector():
             return aligned
 
 
-class TextBoxDetector():
+class TextBoxDetector(BaseDetector):
 
     def __init__(self,model_path,gpu_fraction=None):
         self.session = None
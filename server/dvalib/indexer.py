@@ -1,7 +1,8 @@
-import os, logging, sys
+import os, logging, sys, time, multiprocessing
 import numpy as np
-from collections import namedtuple
-from .base_indexer import BaseIndexer
+from collections import namedtuple, defaultdict
+from .base_indexer import BaseIndexer, StageTimings, FeatureWriter, stream_in_chunks, index_images_as_files, \
+    crop_image
 sys.path.append(os.path.join(os.path.dirname(__file__), "../../repos/"))  # remove once container is rebuilt
 
 if os.environ.get('PYTORCH_MODE', False):
@@ -27,43 +28,178 @@ def _parse_function(filename):
     return image_decoded, filename
 
 
-def _parse_resize_inception_function(filename):
+def _decode_png(filename):
     image_string = tf.read_file(filename)
-    image_decoded = tf.image.decode_png(image_string, channels=3)
     # Cannot use decode_image but decode_png decodes both jpeg as well as png
     # https://github.com/tensorflow/tensorflow/issues/8551
-    image_scaled = tf.image.resize_images(image_decoded, [299, 299])
-    return image_scaled, filename
+    return tf.image.decode_png(image_string, channels=3)
 
 
-def _parse_resize_vgg_function(filename):
+def _resize_inception(image, name):
+    return tf.image.resize_images(image, [299, 299]), name
+
+
+def _resize_vgg(image, name):
     """
     # TODO: Verify if image channel order and mean image subtraction is done in the imported model
-    :param filename:
-    :return:
     """
-    image_string = tf.read_file(filename)
-    image_decoded = tf.image.decode_png(image_string, channels=3)
     # First convert the range to 0-1 and then scale the image otherwise
     # https://github.com/tensorflow/tensorflow/issues/1763
-    image_ranged = tf.image.convert_image_dtype(image_decoded, dtype=tf.float32)
-    image_scaled = tf.image.resize_images(image_ranged, [224, 224])
-    return image_scaled, filename
+    image_ranged = tf.image.convert_image_dtype(image, dtype=tf.float32)
+    return tf.image.resize_images(image_ranged, [224, 224]), name
+
+
+def _scale_standardize(image, name):
+    image_scaled = tf.image.resize_images(image, [160, 160])
+    return tf.image.per_image_standardization(image_scaled), name
+
+
+def _parse_resize_inception_function(filename):
+    return _resize_inception(_decode_png(filename), filename)
+
+
+def _parse_resize_vgg_function(filename):
+    return _resize_vgg(_decode_png(filename), filename)
 
 
 def _parse_scale_standardize_function(filename):
-    image_string = tf.read_file(filename)
-    image_decoded = tf.image.decode_png(image_string, channels=3)
-    # Cannot use decode_image but decode_png decodes both jpeg as well as png
-    # https://github.com/tensorflow/tensorflow/issues/8551
-    image_scaled = tf.image.resize_images(image_decoded, [160, 160])
-    image_standardized = tf.image.per_image_standardization(image_scaled)
-    return image_standardized, filename
+    return _scale_standardize(_decode_png(filename), filename)
+
+
+def _input_pipeline(indexer, parse, preprocess, name=None):
+    """
+    Batched input pipeline fed either by file paths (read and decoded by parse) or by decoded HxWx3 uint8 arrays
+    in indexer.pending_images, e.g. regions cropped from a frame decoded once, which skip the JPEG encode, write,
+    read and decode of temporary files. Both share the preprocessing and a reinitializable iterator yielding
+    (images, names), the name of an array is its position in pending_images. Batches are prefetched so that the
+    input pipeline runs ahead of inference.
+    :return: (filenames placeholder, iterator, paths initializer, arrays initializer)
+    """
+    filenames = tf.placeholder("string", name=name)
+    paths = tf.data.Dataset.from_tensor_slices(filenames)
+    paths = paths.map(parse, num_parallel_calls=indexer.num_parallel_calls).batch(indexer.batch_size)
+    if indexer.prefetch:
+        paths = paths.prefetch(indexer.prefetch)
+
+    def pending_images():
+        for i, image in enumerate(indexer.pending_images):
+            yield image, str(i)
+
+    arrays = tf.data.Dataset.from_generator(pending_images, (tf.uint8, tf.string),
+                                            (tf.TensorShape([None, None, 3]), tf.TensorShape([])))
+    arrays = arrays.map(preprocess, num_parallel_calls=indexer.num_parallel_calls).batch(indexer.batch_size)
+    if indexer.prefetch:
+        arrays = arrays.prefetch(indexer.prefetch)
+    iterator = tf.data.Iterator.from_structure(paths.output_types, paths.output_shapes)
+    return filenames, iterator, iterator.make_initializer(paths), iterator.make_initializer(arrays)
+
+
+def _input_wait(run_metadata):
+    """
+    Seconds spent by IteratorGetNext in a traced run, i.e. waiting for the input pipeline to produce the batch.
+    """
+    wait = 0
+    for device in run_metadata.step_stats.dev_stats:
+        for node in device.node_stats:
+            if node.node_name.split('/')[-1].startswith('IteratorGetNext'):
+                wait = max(wait, node.all_end_rel_micros)
+    return wait / 1e6
 
 
+class TFIndexer(BaseIndexer):
+    """
+    Batched indexer with a tf.data input pipeline built by _input_pipeline. Reading, decoding and preprocessing of
+    the next batches (num_parallel_calls in parallel, prefetch batches ahead) overlaps with inference of the current
+    batch and features are streamed back one batch at a time.
+    """
+
+    def embedding(self):
+        raise NotImplementedError
+
+    def postprocess(self, emb):
+        """
+        :param emb: output of the embedding tensor for a single image
+        :return: feature vector
+        """
+        raise NotImplementedError
+
+    def stream_embeddings(self, timings):
+        """
+        Run the initialized input pipeline until it is exhausted, yielding names and features of each batch.
+        Every trace_every batches the run is traced to measure how long it waited on the input pipeline.
+        """
+        batch_count = 0
+        while True:
+            run_metadata = tf.RunMetadata() if self.trace_every and batch_count % self.trace_every == 0 else None
+            start = time.time()
+            try:
+                if run_metadata is None:
+                    names, emb = self.session.run([self.fname, self.embedding()])
+                else:
+                    names, emb = self.session.run([self.fname, self.embedding()],
+                                                  options=tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE),
+                                                  run_metadata=run_metadata)
+            except tf.errors.OutOfRangeError:
+                break
+            elapsed = time.time() - start
+            timings.add('session', elapsed)
+            if run_metadata is not None:
+                timings.sample(elapsed, _input_wait(run_metadata))
+            with timings.time('postprocess'):
+                features = [self.postprocess(emb[i]) for i in range(len(names))]
+            timings.count += len(names)
+            batch_count += 1
+            if batch_count % 100 == 0:
+                logging.info(
+                    "{} batches containing {} images indexed".format(batch_count, batch_count * self.batch_size))
+            yield names, features
+
+    def stream_paths(self, image_paths, timings=None):
+        if self.graph_def is None or self.session is None:
+            self.load()
+        own_timings = timings is None
+        timings = StageTimings(self.name) if own_timings else timings
+        self.session.run(self.paths_initializer, feed_dict={self.filenames_placeholder: image_paths})
+        positions = defaultdict(list)
+        for i, path in enumerate(image_paths):
+            positions[path].append(i)
+        for names, features in self.stream_embeddings(timings):
+            # a path listed more than once is indexed once per occurrence
+            yield [positions[name].pop(0) for name in names], features
+        if own_timings:
+            timings.log()
+
+    def stream_images(self, images, timings=None):
+        if self.graph_def is None or self.session is None:
+            self.load()
+        own_timings = timings is None
+        timings = StageTimings(self.name) if own_timings else timings
+        self.pending_images = images
+        self.session.run(self.arrays_initializer)
+        try:
+            for names, features in self.stream_embeddings(timings):
+                yield [int(name) for name in names], features
+        finally:
+            self.pending_images = []
+        if own_timings:
+            timings.log()
+
+    def apply_batch(self, image_paths):
+        embeddings = {}
+        for positions, features in self.stream_paths(image_paths):
+            for position, feature in zip(positions, features):
+                embeddings[image_paths[position]] = feature
+        return embeddings
+
+    def index_images(self, images):
+        features = [None] * len(images)
+        for positions, chunk in self.stream_images(images):
+            for position, feature in zip(positions, chunk):
+                features[position] = feature
+        return features
 
 
-class InceptionIndexer(BaseIndexer):
+class InceptionIndexer(TFIndexer):
     """
     Batched inception indexer
     """
@@ -82,7 +218,10 @@ class InceptionIndexer(BaseIndexer):
         self.fname = None
         self.image = None
         self.iterator = None
+        self.paths_initializer = None
+        self.arrays_initializer = None
         self.support_batching = True
+        self.array_support = True
         self.batch_size = batch_size
         self.cloud_fs_support = True
         if gpu_fraction:
@@ -94,11 +233,8 @@ class InceptionIndexer(BaseIndexer):
         if self.graph_def is None:
             logging.warning("Loading the network {} , first apply / query will be slower".format(self.name))
             with tf.variable_scope("inception_pre"):
-                self.filenames_placeholder = tf.placeholder("string", name="inception_filename")
-                dataset = tf.data.Dataset.from_tensor_slices(self.filenames_placeholder)
-                dataset = dataset.map(_parse_resize_inception_function, num_parallel_calls=self.num_parallel_calls)
-                dataset = dataset.batch(self.batch_size)
-                self.iterator = dataset.make_initializable_iterator()
+                self.filenames_placeholder, self.iterator, self.paths_initializer, self.arrays_initializer = \
+                    _input_pipeline(self, _parse_resize_inception_function, _resize_inception, "inception_filename")
             with gfile.FastGFile(self.network_path, 'rb') as f:
                 self.graph_def = tf.GraphDef()
                 self.graph_def.ParseFromString(f.read())
@@ -114,31 +250,18 @@ class InceptionIndexer(BaseIndexer):
     def apply(self, image_path):
         if self.graph_def is None or self.session is None:
             self.load()
-        self.session.run(self.iterator.initializer, feed_dict={self.filenames_placeholder: [image_path, ]})
+        self.session.run(self.paths_initializer, feed_dict={self.filenames_placeholder: [image_path, ]})
         f, pool3_features = self.session.run([self.fname, self.pool3])
         return np.atleast_2d(np.squeeze(pool3_features))
 
-    def apply_batch(self, image_paths):
-        if self.graph_def is None or self.session is None:
-            self.load()
-        self.session.run(self.iterator.initializer, feed_dict={self.filenames_placeholder: image_paths})
-        embeddings = {}
-        batch_count = 0
-        while True:
-            try:
-                f, emb = self.session.run([self.fname, self.pool3])
-                for i, fname in enumerate(f):
-                    embeddings[fname] = np.atleast_2d(np.squeeze(emb[i, :, :, :]))
-                batch_count += 1
-                if batch_count % 100 == 0:
-                    logging.info(
-                        "{} batches containing {} images indexed".format(batch_count, batch_count * self.batch_size))
-            except tf.errors.OutOfRangeError:
-                break
-        return embeddings
+    def embedding(self):
+        return self.pool3
+
+    def postprocess(self, emb):
+        return np.atleast_2d(np.squeeze(emb))
 
 
-class VGGIndexer(BaseIndexer):
+class VGGIndexer(TFIndexer):
     """
     Batched VGG indexer
     """
@@ -157,7 +280,10 @@ class VGGIndexer(BaseIndexer):
         self.fname = None
         self.image = None
         self.iterator = None
+        self.paths_initializer = None
+        self.arrays_initializer = None
         self.support_batching = True
+        self.array_support = True
         self.cloud_fs_support = True
         self.batch_size = batch_size
         if gpu_fraction:
@@ -170,11 +296,8 @@ class VGGIndexer(BaseIndexer):
             logging.warning("Loading the network {} , first apply / query will be slower".format(self.name))
             network_path = self.model_path
             with tf.variable_scope("vgg_pre"):
-                self.filenames_placeholder = tf.placeholder("string", name="vgg_filenames")
-                dataset = tf.data.Dataset.from_tensor_slices(self.filenames_placeholder)
-                dataset = dataset.map(_parse_resize_vgg_function, num_parallel_calls=self.num_parallel_calls)
-                dataset = dataset.batch(self.batch_size)
-                self.iterator = dataset.make_initializable_iterator()
+                self.filenames_placeholder, self.iterator, self.paths_initializer, self.arrays_initializer = \
+                    _input_pipeline(self, _parse_resize_vgg_function, _resize_vgg, "vgg_filenames")
             with gfile.FastGFile(network_path, 'rb') as f:
                 self.graph_def = tf.GraphDef()
                 self.graph_def.ParseFromString(f.read())
@@ -190,31 +313,18 @@ class VGGIndexer(BaseIndexer):
     def apply(self, image_path):
         if self.graph_def is None or self.session is None:
             self.load()
-        self.session.run(self.iterator.initializer, feed_dict={self.filenames_placeholder: [image_path, ]})
+        self.session.run(self.paths_initializer, feed_dict={self.filenames_placeholder: [image_path, ]})
         f, features = self.session.run([self.fname, self.conv])
         return np.atleast_2d(np.squeeze(features).sum(axis=(0, 1)))
 
-    def apply_batch(self, image_paths):
-        if self.graph_def is None or self.session is None:
-            self.load()
-        self.session.run(self.iterator.initializer, feed_dict={self.filenames_placeholder: image_paths})
-        embeddings = {}
-        batch_count = 0
-        while True:
-            try:
-                f, emb = self.session.run([self.fname, self.conv])
-                for i, fname in enumerate(f):
-                    embeddings[fname] = np.atleast_2d(np.squeeze(emb[i, :, :, :]).sum(axis=(0, 1)))
-                batch_count += 1
-                if batch_count % 100 == 0:
-                    logging.info(
-                        "{} batches containing {} images indexed".format(batch_count, batch_count * self.batch_size))
-            except tf.errors.OutOfRangeError:
-                break
-        return embeddings
+    def embedding(self):
+        return self.conv
+
+    def postprocess(self, emb):
+        return np.atleast_2d(np.squeeze(emb).sum(axis=(0, 1)))
 
 
-class FacenetIndexer(BaseIndexer):
+class FacenetIndexer(TFIndexer):
     def __init__(self, model_path, gpu_fraction=None):
         super(FacenetIndexer, self).__init__()
         self.name = "facenet"
@@ -230,7 +340,11 @@ class FacenetIndexer(BaseIndexer):
         self.image = None
         self.filenames_placeholder = None
         self.emb = None
+        self.iterator = None
+        self.paths_initializer = None
+        self.arrays_initializer = None
         self.batch_size = 32
+        self.array_support = True
         if gpu_fraction:
             self.gpu_fraction = gpu_fraction
         else:
@@ -239,11 +353,8 @@ class FacenetIndexer(BaseIndexer):
     def load(self):
         if self.graph_def is None:
             logging.warning("Loading {} , first apply / query will be slower".format(self.name))
-            self.filenames_placeholder = tf.placeholder("string")
-            dataset = tf.data.Dataset.from_tensor_slices(self.filenames_placeholder)
-            dataset = dataset.map(_parse_scale_standardize_function, num_parallel_calls=self.num_parallel_calls)
-            batched_dataset = dataset.batch(self.batch_size)
-            self.iterator = batched_dataset.make_initializable_iterator()
+            self.filenames_placeholder, self.iterator, self.paths_initializer, self.arrays_initializer = \
+                _input_pipeline(self, _parse_scale_standardize_function, _scale_standardize)
             false_phase_train = tf.constant(False)
             with gfile.FastGFile(self.network_path, 'rb') as f:
                 self.graph_def = tf.GraphDef()
@@ -261,28 +372,15 @@ class FacenetIndexer(BaseIndexer):
     def apply(self, image_path):
         if self.graph_def is None or self.session is None:
             self.load()
-        self.session.run(self.iterator.initializer, feed_dict={self.filenames_placeholder: [image_path, ]})
+        self.session.run(self.paths_initializer, feed_dict={self.filenames_placeholder: [image_path, ]})
         f, features = self.session.run([self.fname, self.emb])
         return np.atleast_2d(np.squeeze(features))
 
-    def apply_batch(self, image_paths):
-        if self.graph_def is None or self.session is None:
-            self.load()
-        self.session.run(self.iterator.initializer, feed_dict={self.filenames_placeholder: image_paths})
-        embeddings = {}
-        batch_count = 0
-        while True:
-            try:
-                f, emb = self.session.run([self.fname, self.emb])
-                for i, fname in enumerate(f):
-                    embeddings[fname] = np.atleast_2d(np.squeeze(emb[i, :, :, :]).sum(axis=(0, 1)))
-                batch_count += 1
-                if batch_count % 100 == 0:
-                    logging.info(
-                        "{} batches containing {} images indexed".format(batch_count, batch_count * self.batch_size))
-            except tf.errors.OutOfRangeError:
-                break
-        return embeddings
+    def embedding(self):
+        return self.emb
+
+    def postprocess(self, emb):
+        return np.atleast_2d(np.squeeze(emb).sum(axis=(0, 1)))
 
 
 class BaseCustomIndexer(object):
@@ -291,7 +389,8 @@ class BaseCustomIndexer(object):
         self.net = None
         self.support_batching = False
         self.batch_size = 100
-        self.num_parallel_calls = 3
+        self.num_parallel_calls = int(os.environ.get('INDEXER_PARALLEL_CALLS', multiprocessing.cpu_count()))
+        self.array_support = False
 
     def apply(self, path):
         raise NotImplementedError
@@ -299,6 +398,15 @@ class BaseCustomIndexer(object):
     def apply_batch(self, paths):
         raise NotImplementedError
 
+    def index_images(self, images):
+        return index_images_as_files(self, images)
+
+    def stream_paths(self, paths, timings=None):
+        return stream_in_chunks(self.index_paths, paths, self.batch_size, timings)
+
+    def stream_images(self, images, timings=None):
+        return stream_in_chunks(self.index_images, images, self.batch_size, timings)
+
     def index_paths(self, paths):
         batch_count = 0
         if self.support_batching:
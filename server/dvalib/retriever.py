@@ -1,13 +1,19 @@
 import numpy as np
-from scipy import spatial
 from collections import namedtuple
 import uuid
 import sys
+import os
+import json
+import time
+import fcntl
+import struct
+import zipfile
 
 import logging
+from . import vector_store
 try:
     from sklearn.decomposition import PCA
-    from lopq import LOPQModel, LOPQSearcher
+    from lopq import LOPQModel, LOPQSearcherArray
     from lopq.eval import compute_all_neighbors, get_recall
     from lopq.model import eigenvalue_allocation
     from lopq.utils import compute_codes_parallel
@@ -25,7 +31,445 @@ except ImportError:
 IndexRange = namedtuple('IndexRange',['start','end'])
 
 
+def write_snapshot(path, arrays):
+    """
+    Atomically write arrays to an uncompressed .npz file which load_snapshot can memory-map.
+    """
+    temp_path = "{}.{}.tmp".format(path, os.getpid())
+    with open(temp_path, 'wb') as fh:
+        np.savez(fh, **arrays)
+    os.rename(temp_path, path)
+
+
+def load_snapshot(path):
+    """
+    Read arrays of an uncompressed .npz file, non empty numeric arrays are memory-mapped in place from the file
+    (members of np.savez archives are stored uncompressed) rather than read into memory.
+    """
+    arrays = {}
+    with zipfile.ZipFile(path) as archive, open(path, 'rb') as fh:
+        for info in archive.infolist():
+            name = info.filename[:-4] if info.filename.endswith('.npy') else info.filename
+            fh.seek(info.header_offset)
+            name_length, extra_length = struct.unpack('<HH', fh.read(30)[26:30])
+            fh.seek(info.header_offset + 30 + name_length + extra_length)
+            version = np.lib.format.read_magic(fh)
+            if version == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(fh)
+            else:
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(fh)
+            if info.compress_type == zipfile.ZIP_STORED and len(shape) and np.prod(shape) and not dtype.hasobject:
+                arrays[name] = np.memmap(path, dtype=dtype, mode='r', offset=fh.tell(), shape=shape,
+                                         order='F' if fortran_order else 'C')
+            else:
+                arrays[name] = np.lib.format.read_array(archive.open(info))
+    return arrays
+
+
+def l2_topk(queries, index, index_norms=None, n=12, block_size=65536, mask=None):
+    """
+    Exact L2 nearest neighbours computed over fixed size blocks of the index.
+    Squared distances are computed as |q|^2 - 2 q.x + |x|^2 using precomputed row norms and a matrix product,
+    each block is reduced to its top n with argpartition and merged into a running top n. Peak memory is
+    bounded by number of queries x block_size irrespective of the size of the index.
+    :param queries: matrix with one query vector per row
+    :param index: matrix with one indexed vector per row
+    :param index_norms: optional precomputed squared L2 norms of the rows of the index
+    :param n: number of neighbours to return
+    :param block_size: number of index rows processed at a time
+    :param mask: optional boolean array over the rows of the index, excluded rows get an infinite distance
+    :return: (distances, ids) matrices with one row per query sorted by increasing euclidean distance
+    """
+    queries = np.atleast_2d(queries).astype(index.dtype, copy=False)
+    if index_norms is None:
+        index_norms = np.einsum('ij,ij->i', index, index)
+    query_norms = np.einsum('ij,ij->i', queries, queries)[:, np.newaxis]
+    rows = np.arange(queries.shape[0])[:, np.newaxis]
+    best_dist, best_ids = None, None
+    for start in range(0, index.shape[0], block_size):
+        block = index[start:start + block_size]
+        dist = query_norms - 2.0 * np.dot(queries, block.T) + index_norms[np.newaxis, start:start + block.shape[0]]
+        if mask is not None:
+            dist[:, ~mask[start:start + block.shape[0]]] = np.inf
+        k = min(n, block.shape[0])
+        if k < block.shape[0]:
+            ids = np.argpartition(dist, k - 1, axis=1)[:, :k]
+            dist = dist[rows, ids]
+        else:
+            ids = np.tile(np.arange(block.shape[0]), (queries.shape[0], 1))
+        ids = ids + start
+        if best_dist is not None:
+            dist = np.concatenate([best_dist, dist], axis=1)
+            ids = np.concatenate([best_ids, ids], axis=1)
+            if dist.shape[1] > n:
+                keep = np.argpartition(dist, n - 1, axis=1)[:, :n]
+                dist, ids = dist[rows, keep], ids[rows, keep]
+        best_dist, best_ids = dist, ids
+    if best_dist is None:
+        return np.zeros((queries.shape[0], 0)), np.zeros((queries.shape[0], 0), dtype=np.int64)
+    order = np.argsort(best_dist, axis=1)
+    best_dist, best_ids = best_dist[rows, order], best_ids[rows, order]
+    return np.sqrt(np.maximum(best_dist, 0)), best_ids
+
+
+def masked_topk(queries, index, index_norms=None, n=12, block_size=65536, mask=None):
+    """
+    l2_topk restricted to the rows selected by a boolean mask. Selective masks gather the selected rows and only
+    compute their distances, otherwise excluded rows are masked with an infinite distance during top n selection.
+    """
+    if mask is None or mask.all():
+        return l2_topk(queries, index, index_norms, n, block_size)
+    selected = np.flatnonzero(mask)
+    if len(selected) == 0:
+        return np.zeros((queries.shape[0], 0)), np.zeros((queries.shape[0], 0), dtype=np.int64)
+    elif len(selected) < 0.5 * len(mask):
+        dist, ids = l2_topk(queries, index[selected], None if index_norms is None else index_norms[selected], n,
+                            block_size)
+        return dist, selected[ids]
+    return l2_topk(queries, index, index_norms, n, block_size, mask)
+
+
+# filters selecting at most this many rows are answered by an exact search over the selected rows when the index
+# stores raw vectors (e.g. HNSW) instead of over-fetching from the graph
+FILTER_EXACT_MAX_ROWS = 20000
+# over-fetching stops at this many candidates per query, which bounds the (queries x candidates) result matrices
+FILTER_OVERFETCH_MAX_K = 4096
+
+
+def overfetch_topk(search, queries, n, mask, total, exact=None):
+    """
+    Filtered search for indexes which cannot evaluate a mask (FAISS IVF / HNSW, LOPQ), candidates are over-fetched
+    and filtered, the number of candidates starts from the expected count given the selectivity of the mask and
+    grows until n pass the mask for every query, the whole index was searched or FILTER_OVERFETCH_MAX_K candidates
+    were fetched. Past that limit the exact search is used if given, otherwise fewer than n results are returned.
+    :param search: function (queries, k) -> (distances, ids) with negative ids as padding
+    :param exact: optional function (queries, n, mask) -> (distances, ids) searching the selected rows exactly
+    :return: (distances, ids) matrices with n columns padded with -1 ids
+    """
+    selected = int(mask.sum())
+    if selected == 0 or total == 0:
+        return np.full((queries.shape[0], n), np.inf, dtype=np.float32), \
+            np.full((queries.shape[0], n), -1, dtype=np.int64)
+    max_k = max(FILTER_OVERFETCH_MAX_K, n)
+    k = min(max(4 * n, 64, 2 * n * total // selected), total, max_k)
+    while True:
+        dist, ids = search(queries, k)
+        keep = (ids >= 0) & mask[np.maximum(ids, 0)]
+        if k >= total or (keep.sum(axis=1) >= n).all():
+            break
+        if k >= max_k:
+            if exact is not None:
+                return exact(queries, n, mask)
+            break
+        k = min(4 * k, total, max_k)
+    filtered_dist = np.full((queries.shape[0], n), np.inf, dtype=np.float32)
+    filtered_ids = np.full((queries.shape[0], n), -1, dtype=np.int64)
+    for q in range(queries.shape[0]):
+        kept = np.flatnonzero(keep[q])[:n]
+        filtered_dist[q, :len(kept)] = dist[q, kept]
+        filtered_ids[q, :len(kept)] = ids[q, kept]
+    return filtered_dist, filtered_ids
+
+
+class GrowableArray(object):
+    """
+    Row buffer with amortized O(1) append, the capacity doubles whenever it is exhausted instead of
+    copying the whole array on every append.
+    """
+
+    def __init__(self, dtype=np.float32, capacity=1024):
+        self.dtype = dtype
+        self.initial_capacity = capacity
+        self.data = None
+        self.size = 0
+
+    def append(self, rows):
+        rows = np.asarray(rows, dtype=self.dtype)
+        if self.data is None:
+            self.data = np.empty((max(self.initial_capacity, rows.shape[0]),) + rows.shape[1:], dtype=self.dtype)
+        elif rows.shape[1:] != self.data.shape[1:]:
+            raise ValueError("Cannot append rows of shape {} to buffer of shape {}".format(rows.shape,
+                                                                                          self.data.shape))
+        required = self.size + rows.shape[0]
+        if required > self.data.shape[0]:
+            capacity = self.data.shape[0]
+            while capacity < required:
+                capacity *= 2
+            grown = np.empty((capacity,) + self.data.shape[1:], dtype=self.dtype)
+            grown[:self.size] = self.data[:self.size]
+            self.data = grown
+        self.data[self.size:required] = rows
+        self.size = required
+
+    def view(self):
+        """
+        :return: read-only view over the filled part of the buffer, invalidated by the next append.
+        """
+        if self.data is None:
+            return None
+        v = self.data[:self.size]
+        v.flags.writeable = False
+        return v
+
+    @property
+    def nbytes(self):
+        return 0 if self.data is None else self.data.nbytes
+
+    def __len__(self):
+        return self.size
+
+
+ENTRY_INT_COLUMNS = [('frame_index', np.int32), ('frame_primary_key', np.int64),
+                     ('detection_primary_key', np.int64), ('index', np.int32)]
+ENTRY_CATEGORICAL_COLUMNS = ['type', 'video_primary_key']
+
+
+def entries_to_columns(entries):
+    """
+    Convert a list of entry dicts into columnar arrays. Missing integer values are stored as -1, string values
+    (region type, video primary key) as int32 codes into a "<name>_values" array of the distinct values.
+    """
+    columns = {}
+    for name, dtype in ENTRY_INT_COLUMNS:
+        columns[name] = np.array([e.get(name, -1) for e in entries], dtype=dtype)
+    for name in ENTRY_CATEGORICAL_COLUMNS:
+        values = [str(e.get(name, '')) for e in entries]
+        distinct = sorted(set(values))
+        codes = {v: i for i, v in enumerate(distinct)}
+        columns[name] = np.array([codes[v] for v in values], dtype=np.int32)
+        columns['{}_values'.format(name)] = np.array(distinct, dtype=np.str_)
+    return columns
+
+
+def entry_count(entries):
+    """
+    :param entries: list of entry dicts or dict of columns
+    """
+    if entries is None:
+        return 0
+    elif isinstance(entries, dict):
+        return len(entries['index'])
+    return len(entries)
+
+
+FILTER_COLUMN_ALIASES = {'video_id': 'video_primary_key', 'frame_id': 'frame_primary_key',
+                         'detection_id': 'detection_primary_key'}
+FILTER_LOOKUPS = {'gt': np.greater, 'gte': np.greater_equal, 'lt': np.less, 'lte': np.less_equal}
+
+
+class EntryColumns(object):
+    """
+    Entry metadata held by a retriever as parallel arrays, entry dicts are only built for the returned hits.
+    """
+
+    def __init__(self):
+        self.columns = {name: GrowableArray(dtype=dtype) for name, dtype in ENTRY_INT_COLUMNS}
+        self.values = {}
+        self.codes = {}
+        for name in ENTRY_CATEGORICAL_COLUMNS:
+            self.columns[name] = GrowableArray(dtype=np.int32)
+            self.values[name] = []
+            self.codes[name] = {}
+        self.size = 0
+
+    def extend(self, entries):
+        """
+        :param entries: list of entry dicts or dict of columns as returned by entries_to_columns
+        :return: number of entries added
+        """
+        if not isinstance(entries, dict):
+            entries = entries_to_columns(entries)
+        count = entry_count(entries)
+        if count == 0:
+            return 0
+        for name, _ in ENTRY_INT_COLUMNS:
+            self.columns[name].append(entries[name])
+        for name in ENTRY_CATEGORICAL_COLUMNS:
+            remap = np.array([self.get_code(name, str(v)) for v in entries['{}_values'.format(name)]], dtype=np.int32)
+            self.columns[name].append(remap[entries[name]])
+        self.size += count
+        return count
+
+    def get_code(self, name, value):
+        if value not in self.codes[name]:
+            self.codes[name][value] = len(self.values[name])
+            self.values[name].append(value)
+        return self.codes[name][value]
+
+    def __getitem__(self, k):
+        if k < 0 or k >= self.size:
+            raise IndexError("entry {} out of range".format(k))
+        entry = {}
+        for name, _ in ENTRY_INT_COLUMNS:
+            value = int(self.columns[name].data[k])
+            if value >= 0:
+                entry[name] = value
+        for name in ENTRY_CATEGORICAL_COLUMNS:
+            value = self.values[name][self.columns[name].data[k]]
+            if value:
+                entry[name] = value
+        return entry
+
+    @property
+    def nbytes(self):
+        return sum(column.nbytes for column in self.columns.values())
+
+    def __len__(self):
+        return self.size
+
+    def mask(self, filters):
+        """
+        Boolean mask of the entries matching all filters, e.g. {"video_id__in": [1, 2], "type": "D",
+        "frame_index__gte": 100, "frame_index__lt": 200}. Supported lookups are exact, __in, __gt, __gte, __lt
+        and __lte on integer columns and exact, __in on video_id / video_primary_key and type.
+        """
+        mask = np.ones(self.size, dtype=np.bool_)
+        if self.size == 0:
+            return mask
+        for k, value in filters.items():
+            name, _, lookup = k.partition('__')
+            name = FILTER_COLUMN_ALIASES.get(name, name)
+            if name not in self.columns:
+                raise ValueError("Cannot filter on unknown column {}".format(k))
+            column = self.columns[name].data[:self.size]
+            if name in self.codes:
+                if lookup not in ('', 'in'):
+                    raise ValueError("Lookup {} is not supported on {}".format(lookup, name))
+                values = value if lookup == 'in' else [value, ]
+                mask &= np.in1d(column, [self.codes[name][str(v)] for v in values if str(v) in self.codes[name]])
+            elif lookup == '':
+                mask &= column == value
+            elif lookup == 'in':
+                mask &= np.in1d(column, value)
+            elif lookup in FILTER_LOOKUPS:
+                mask &= FILTER_LOOKUPS[lookup](column, value)
+            else:
+                raise ValueError("Lookup {} is not supported on {}".format(lookup, name))
+        return mask
+
+    def take(self, rows):
+        """
+        :param rows: sorted array of row numbers
+        :return: new EntryColumns with only the given rows, categorical codes are preserved
+        """
+        taken = EntryColumns()
+        for name in self.columns:
+            taken.columns[name].append(self.columns[name].data[rows] if self.size else [])
+        for name in ENTRY_CATEGORICAL_COLUMNS:
+            taken.values[name] = list(self.values[name])
+            taken.codes[name] = dict(self.codes[name])
+        taken.size = len(rows)
+        return taken
+
+    def to_columns(self):
+        """
+        :return: dict of columns in the format of entries_to_columns
+        """
+        columns = {}
+        for name, dtype in ENTRY_INT_COLUMNS:
+            columns[name] = self.columns[name].view() if self.size else np.zeros(0, dtype=dtype)
+        for name in ENTRY_CATEGORICAL_COLUMNS:
+            columns[name] = self.columns[name].view() if self.size else np.zeros(0, dtype=np.int32)
+            columns['{}_values'.format(name)] = np.array(self.values[name], dtype=np.str_)
+        return columns
+
+
+def concatenate_entry_columns(entries_list):
+    """
+    Concatenate entries given as lists of entry dicts or dicts of columns into a single dict of columns.
+    """
+    merged = EntryColumns()
+    for entries in entries_list:
+        merged.extend(entries)
+    return merged.to_columns()
+
+
+class SegmentedIndex(object):
+    """
+    Exact index made of row segments. Vectors loaded into memory are appended to a heap GrowableArray while
+    memory-mapped slices of vector store shards are referenced in place, consecutive slices of the same shard
+    are merged into a single segment.
+    """
+
+    def __init__(self):
+        self.segments = []
+        self.size = 0
+        self.dimensions = None
+
+    def append(self, vectors, norms=None, reference=False):
+        """
+        :param norms: optional precomputed squared L2 norms of the rows
+        :param reference: reference the (memory-mapped) vectors in place instead of copying them
+        """
+        vectors = np.atleast_2d(vectors)
+        if self.dimensions is None:
+            self.dimensions = vectors.shape[1]
+        elif vectors.shape[1] != self.dimensions:
+            raise ValueError("Cannot add vectors of shape {} to index with {} dimensions".format(vectors.shape,
+                                                                                                self.dimensions))
+        if norms is None:
+            norms = np.einsum('ij,ij->i', vectors, vectors).astype(np.float32)
+        last = self.segments[-1] if self.segments else None
+        if reference or (vectors.dtype == np.float32 and vector_store.is_shard_view(vectors)):
+            union = None
+            if last is not None and not isinstance(last['rows'], GrowableArray):
+                union = vector_store.contiguous_union(last['rows'], vectors)
+            if union is None:
+                self.segments.append({'start': self.size, 'rows': vectors, 'norms': GrowableArray()})
+            else:
+                last['rows'] = union
+        else:
+            if last is None or not isinstance(last['rows'], GrowableArray):
+                self.segments.append({'start': self.size, 'rows': GrowableArray(), 'norms': GrowableArray()})
+            self.segments[-1]['rows'].append(vectors)
+        self.segments[-1]['norms'].append(norms)
+        self.size += norms.shape[0]
+
+    def views(self):
+        for segment in self.segments:
+            rows = segment['rows']
+            yield segment['start'], rows.view() if isinstance(rows, GrowableArray) else rows, segment['norms'].view()
+
+    def search(self, queries, n=12, block_size=65536, mask=None):
+        """
+        :param mask: optional boolean array over all rows, only selected rows are returned
+        """
+        dists, ids = [], []
+        for start, rows, norms in self.views():
+            segment_mask = None if mask is None else mask[start:start + rows.shape[0]]
+            if segment_mask is not None and not segment_mask.any():
+                continue
+            d, i = masked_topk(queries, rows, norms, n, block_size, segment_mask)
+            dists.append(d)
+            ids.append(i + start)
+        if not dists:
+            return np.zeros((queries.shape[0], 0)), np.zeros((queries.shape[0], 0), dtype=np.int64)
+        if len(dists) == 1:
+            return dists[0], ids[0]
+        dists, ids = np.concatenate(dists, axis=1), np.concatenate(ids, axis=1)
+        order = np.argsort(dists, axis=1)[:, :n]
+        rows = np.arange(queries.shape[0])[:, np.newaxis]
+        return dists[rows, order], ids[rows, order]
+
+    @property
+    def shape(self):
+        return self.size, self.dimensions
+
+    @property
+    def nbytes(self):
+        """
+        Bytes of vectors and norms held in memory, memory-mapped slices of vector store shards are excluded.
+        """
+        return sum((s['rows'].nbytes if isinstance(s['rows'], GrowableArray) else 0) + s['norms'].nbytes
+                   for s in self.segments)
+
+    def __len__(self):
+        return self.size
+
+
 class BaseRetriever(object):
+    snapshots = True
+    compaction = True
 
     def __init__(self,name,approximator=None,algorithm="EXACT"):
         self.name = name
@@ -34,108 +478,477 @@ class BaseRetriever(object):
         self.approximator = approximator
         self.net = None
         self.loaded_entries = {}
-        self.index, self.files, self.findex = None, {}, 0
+        self.index, self.files, self.findex = SegmentedIndex(), EntryColumns(), 0
+        self.tombstones, self.deleted = np.zeros(0, dtype=np.bool_), 0
+        self.block_size = 65536
         self.support_batching = False
 
-    def load_index(self,numpy_matrix,entries):
+    def delete(self, keys):
+        """
+        Tombstone the rows of loaded index entries, they are excluded from search results until compact() drops
+        them. Keys which are not loaded are ignored.
+        :return: number of rows tombstoned
+        """
+        deleted = 0
+        for k in keys:
+            if k in self.loaded_entries:
+                r = self.loaded_entries.pop(k)
+                if len(self.tombstones) < len(self.files):
+                    self.tombstones = np.concatenate([self.tombstones,
+                                                      np.zeros(len(self.files) - len(self.tombstones), np.bool_)])
+                deleted += int((~self.tombstones[r.start:r.end + 1]).sum())
+                self.tombstones[r.start:r.end + 1] = True
+        self.deleted += deleted
+        return deleted
+
+    def deleted_fraction(self):
+        return float(self.deleted) / len(self.files) if len(self.files) else 0.0
+
+    def live_mask(self):
+        """
+        :return: boolean mask of rows which are not tombstoned or None if no row is tombstoned
+        """
+        if not self.deleted:
+            return None
+        live = np.ones(len(self.files), dtype=np.bool_)
+        live[:len(self.tombstones)] = ~self.tombstones
+        return live
+
+    def search_mask(self, filters=None):
+        """
+        :return: boolean mask of live rows matching the filters or None if every row is searched
+        """
+        mask = self.live_mask()
+        if filters:
+            mask = self.files.mask(filters) if mask is None else mask & self.files.mask(filters)
+        return mask
+
+    def compact(self):
+        """
+        Physically drop tombstoned rows, the remaining rows are renumbered and ranges of loaded entries remapped.
+        :return: number of rows dropped
+        """
+        compaction = self.start_compaction()
+        if compaction is None:
+            return 0
+        self.build_compaction(compaction)
+        return self.finish_compaction(compaction)
+
+    def start_compaction(self):
+        """
+        Capture the tombstoned rows and the vectors the compacted index is built from. build_compaction only uses
+        the captured state, hence the retriever can be searched, loaded and tombstoned while it runs.
+        :return: state passed to build_compaction and finish_compaction or None if no row is tombstoned
+        """
+        live = self.live_mask()
+        if live is None:
+            return None
+        compaction = {'live': live}
+        compaction.update(self.capture_index(np.flatnonzero(live), live))
+        return compaction
+
+    def build_compaction(self, compaction):
+        compaction['index'] = self.build_index(compaction)
+
+    def finish_compaction(self, compaction):
+        """
+        Swap in the compacted index, rows loaded since start_compaction are appended to it and rows tombstoned
+        since are tombstoned again in the new numbering.
+        :return: number of rows dropped
+        """
+        live = np.ones(len(self.files), dtype=np.bool_)
+        live[:len(compaction['live'])] = compaction['live']
+        keep = np.flatnonzero(live)
+        self.install_index(compaction, len(compaction['live']), live)
+        tombstones = np.zeros(len(live), dtype=np.bool_)
+        tombstones[:len(self.tombstones)] = self.tombstones
+        renumbered = np.cumsum(live) - 1
+        self.files = self.files.take(keep)
+        self.loaded_entries = {k: IndexRange(start=int(renumbered[r.start]), end=int(renumbered[r.end]))
+                               for k, r in self.loaded_entries.items()}
+        self.findex = len(keep)
+        self.tombstones, self.deleted = tombstones[keep], int(tombstones[keep].sum())
+        if not self.deleted:
+            self.tombstones = np.zeros(0, dtype=np.bool_)
+        return len(live) - len(keep)
+
+    def capture_index(self, keep, live):
+        return {'views': list(self.index.views())}
+
+    def build_index(self, compaction):
+        index = SegmentedIndex()
+        for start, rows, norms in compaction['views']:
+            segment = compaction['live'][start:start + rows.shape[0]]
+            if segment.all():
+                index.append(rows, norms=norms, reference=True)
+            elif segment.any():
+                index.append(np.asarray(rows)[segment], norms=norms[segment])
+        return index
+
+    def install_index(self, compaction, start, live):
+        """
+        :param start: number of rows when the compaction started, rows after it are appended to the new index
+        :param live: mask of the rows which are kept among all current rows
+        """
+        index = compaction['index']
+        for segment_start, rows, norms in self.index.views():
+            if segment_start + rows.shape[0] > start:
+                offset = max(start - segment_start, 0)
+                index.append(rows[offset:], norms=norms[offset:], reference=True)
+        self.index = index
+
+    def load_index(self,numpy_matrix,entries,key=None):
         temp_index = [numpy_matrix, ]
-        for i, e in enumerate(entries):
-            self.files[self.findex] = e
-            self.findex += 1
-        if self.index is None:
-            self.index = np.atleast_2d(np.concatenate(temp_index).squeeze())
-            logging.info(self.index.shape)
+        if isinstance(numpy_matrix, np.memmap):
+            # memory-mapped vectors are referenced instead of copied so that processes share the page cache
+            vectors = numpy_matrix.reshape((-1, numpy_matrix.shape[-1]))
         else:
-            self.index = np.concatenate([self.index, np.atleast_2d(np.concatenate(temp_index).squeeze())])
-            logging.info(self.index.shape)
+            vectors = np.atleast_2d(np.concatenate(temp_index).squeeze())
+        # vectors of another shape are rejected before the entries are added
+        self.index.append(vectors)
+        self.findex += self.files.extend(entries)
+        logging.info(self.index.shape)
+
+    def persist(self, force=False):
+        pass
 
-    def nearest(self, vector=None, n=12):
-        dist = None
+    def close(self):
+        pass
+
+    def resident_bytes(self):
+        """
+        Approximate memory held by the retriever: vectors and norms in memory, entry metadata and tombstones.
+        """
+        return self.index.nbytes + self.files.nbytes + self.tombstones.nbytes
+
+    def snapshot_arrays(self):
+        """
+        State of the retriever as arrays for write_snapshot: entry metadata, ranges of loaded entries and the index.
+        """
+        arrays = {'entry_{}'.format(k): v for k, v in self.files.to_columns().items()}
+        keys = sorted(self.loaded_entries)
+        arrays['loaded_keys'] = np.array(keys, dtype=np.int64)
+        arrays['loaded_ranges'] = np.array([tuple(self.loaded_entries[k]) for k in keys],
+                                           dtype=np.int64).reshape((-1, 2))
+        if self.deleted:
+            arrays['tombstones'] = ~self.live_mask()
+        arrays.update(self.snapshot_index())
+        return arrays
+
+    def snapshot_index(self):
+        arrays = {}
+        for i, (_, rows, norms) in enumerate(self.index.views()):
+            arrays['rows_{}'.format(i)] = rows
+            arrays['norms_{}'.format(i)] = norms
+        return arrays
+
+    def restore_snapshot(self, arrays):
+        """
+        Restore state from arrays returned by load_snapshot, memory-mapped vectors are referenced in place.
+        """
+        self.findex += self.files.extend({k[len('entry_'):]: v for k, v in arrays.items() if k.startswith('entry_')})
+        for k, (start, end) in zip(arrays['loaded_keys'], arrays['loaded_ranges']):
+            self.loaded_entries[int(k)] = IndexRange(start=int(start), end=int(end))
+        if 'tombstones' in arrays:
+            self.tombstones = np.array(arrays['tombstones'], dtype=np.bool_)
+            self.deleted = int(self.tombstones.sum())
+        self.restore_index(arrays)
+
+    def restore_index(self, arrays):
+        i = 0
+        while 'rows_{}'.format(i) in arrays:
+            self.index.append(arrays['rows_{}'.format(i)], norms=arrays['norms_{}'.format(i)], reference=True)
+            i += 1
+
+    def ranked_results(self, dist, ids):
+        """
+        Convert a row of distances and ids into list of result dicts, negative ids are padding used by FAISS and
+        infinite distances rows excluded by filters.
+        """
         results = []
-        if self.approximator:
-            vector = np.atleast_2d(self.approximator.approximate(vector))
-        if self.index is not None:
-            try:
-                dist = spatial.distance.cdist(vector,self.index)
-            except:
-                raise ValueError("Could not compute distance Vector shape {} and index shape {}".format(vector.shape, self.index.shape))
-        if dist is not None:
-            ranked = np.squeeze(dist.argsort())
-            for i, k in enumerate(ranked[:n]):
-                temp = {'rank':i+1,'algo':self.name,'dist':float(dist[0,k])}
+        for i, k in enumerate(ids):
+            if k >= 0 and np.isfinite(dist[i]):
+                temp = {'rank': len(results) + 1, 'algo': self.name, 'dist': float(dist[i])}
                 temp.update(self.files[k])
                 results.append(temp)
-        return results # Next also return computed query_vector
+        return results
+
+    def nearest(self, vector=None, n=12, filters=None):
+        return self.nearest_batch(np.atleast_2d(vector), n, filters)[0] # Next also return computed query_vector
+
+    def nearest_batch(self, matrix=None, n=12, filters=None):
+        """
+        Answer all queries (one per row of the matrix) with a single pass over the index.
+        :param filters: optional entry metadata filters, see EntryColumns.mask
+        :return: list containing list of results for each query
+        """
+        matrix = np.atleast_2d(matrix)
+        if self.approximator:
+            matrix = np.vstack([np.atleast_2d(self.approximator.approximate(v)) for v in matrix])
+        if len(self.index) == 0:
+            return [[] for _ in range(matrix.shape[0])]
+        if matrix.shape[-1] != self.index.dimensions:
+            raise ValueError("Could not compute distance Vector shape {} and index shape {}".format(matrix.shape, self.index.shape))
+        dist, ranked = self.index.search(matrix, n, self.block_size, self.search_mask(filters))
+        return [self.ranked_results(dist[q], ranked[q]) for q in range(matrix.shape[0])]
 
 
 class LOPQRetriever(BaseRetriever):
+    compaction = False
 
     def __init__(self,name,approximator):
         super(LOPQRetriever, self).__init__(name=name,approximator=approximator,algorithm="LOPQ")
         self.approximate = True
         self.name = name
         self.loaded_entries = {}
-        self.entries = []
+        self.entries = self.files
         self.support_batching = False
         self.approximator = approximator
         self.approximator.load()
-        self.searcher = LOPQSearcher(model=self.approximator.model)
+        self.searcher = LOPQSearcherArray(model=self.approximator.model)
 
-    def load_index(self,numpy_matrix=None,entries=None):
-        codes = []
-        ids = []
+    def load_index(self,numpy_matrix=None,entries=None,key=None):
+        """
+        :param numpy_matrix: dict with 'coarse' and 'fine' code arrays, if None codes are read from the entries as
+        stored by older versions
+        """
+        if not entry_count(entries):
+            return
         last_index = len(self.entries)
-        for i, e in enumerate(entries):
-            codes.append((tuple(e['codes'][0]),tuple(e['codes'][1])))
-            ids.append(i+last_index)
-            self.entries.append(e)
-        self.searcher.add_codes(codes,ids)
+        if numpy_matrix is not None:
+            coarse, fine = numpy_matrix['coarse'], numpy_matrix['fine']
+        else:
+            coarse = np.array([e['codes'][0] for e in entries])
+            fine = np.array([e['codes'][1] for e in entries])
+        # codes are added first so that a failure leaves the entries and the codes in sync
+        self.searcher.add_code_arrays(coarse,fine,np.arange(last_index,last_index + entry_count(entries)))
+        self.entries.extend(entries)
 
-    def nearest(self,vector=None,n=12):
+    def nearest(self,vector=None,n=12,filters=None):
         results = []
         pca_vec = self.approximator.get_pca_vector(vector)
-        results_indexes, visited = self.searcher.search(pca_vec,quota=n)
-        for r in results_indexes:
-            results.append(self.entries[r.id])
+        mask = self.search_mask(filters)
+        if mask is not None:
+            def search(queries, k):
+                found, found_dists, _, _, _ = self.searcher.search_arrays(queries[0], quota=k)
+                padding = k - len(found)
+                return np.atleast_2d(np.pad(found_dists, (0, padding), 'constant', constant_values=np.inf)), \
+                    np.atleast_2d(np.pad(found, (0, padding), 'constant', constant_values=-1).astype(np.int64))
+            dists, ids = overfetch_topk(search, np.atleast_2d(pca_vec), n, mask, len(self.entries))
+            dists, ids = dists[0][ids[0] >= 0], ids[0][ids[0] >= 0]
+        else:
+            ids, dists, _, _, visited = self.searcher.search_arrays(pca_vec,quota=n)
+        for i, k in enumerate(ids):
+            temp = {'rank': i + 1, 'algo': self.name, 'dist': float(dists[i])}
+            temp.update(self.entries[k])
+            results.append(temp)
         return results
 
+    def nearest_batch(self,matrix=None,n=12,filters=None):
+        # the multi-index is traversed one query at a time
+        return [self.nearest(vector=v,n=n,filters=filters) for v in np.atleast_2d(matrix)]
+
+    def snapshot_index(self):
+        coarse, fine, ids = self.searcher.get_code_arrays()
+        return {'coarse': coarse, 'fine': fine, 'ids': ids}
+
+    def restore_index(self, arrays):
+        self.searcher.add_code_arrays(arrays['coarse'], arrays['fine'], arrays['ids'])
+
 
-class FaissApproximateRetriever(BaseRetriever):
+class PersistedIndexMixin(object):
+    """
+    Persists a FAISS index under index_dirname along with a manifest of the (key, count) of index files loaded into
+    it, on restart the entries of keys listed in the manifest must be loaded in order and only their metadata is
+    loaded. The directory is locked so that only one process on a host writes to it, others keep the index in memory.
+    Since the index itself is persisted these retrievers are not snapshotted.
+    """
+    snapshots = False
+    persist_interval = 0
 
-    def __init__(self,name, approximator):
+    def open_persisted(self):
+        """
+        :return: the persisted index or None
+        """
+        self.persisted_entries = []
+        self.persisted_pending = []
+        self.lock_file = None
+        self.unsaved = False
+        self.persisted_ts = 0
+        if not self.index_dirname:
+            return None
+        if not os.path.isdir(self.index_dirname):
+            os.makedirs(self.index_dirname)
+        self.populated_path = str(os.path.join(self.index_dirname, 'populated.index'))
+        self.manifest_path = os.path.join(self.index_dirname, 'manifest.json')
+        self.lock_file = open(os.path.join(self.index_dirname, 'index.lock'), 'a')
+        try:
+            fcntl.flock(self.lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            logging.warning("{} is used by another process, keeping index in memory".format(self.index_dirname))
+            self.lock_file.close()
+            self.lock_file = None
+            self.index_dirname = None
+            return None
+        if os.path.isfile(self.manifest_path) and os.path.isfile(self.populated_path):
+            manifest = json.load(open(self.manifest_path))
+            index = faiss.read_index(self.populated_path)
+            if index.ntotal == manifest['ntotal']:
+                self.persisted_entries = [tuple(k) for k in manifest['entries']]
+                self.persisted_pending = [k for k, _ in self.persisted_entries]
+                logging.info("Opened persisted index {} with {} vectors".format(self.populated_path, index.ntotal))
+                return index
+            logging.warning("Persisted index {} does not match its manifest, rebuilding".format(self.populated_path))
+            self.remove_persisted()
+        return None
+
+    def persisted_paths(self):
+        return [self.manifest_path, self.populated_path]
+
+    def remove_persisted(self):
+        for path in self.persisted_paths():
+            if os.path.isfile(path):
+                os.remove(path)
+        self.persisted_entries = []
+        self.persisted_pending = []
+
+    def release_persisted(self):
+        """
+        Hand the directory over to a retriever rebuilt in it, the files are removed (memory-mapped inverted lists
+        remain readable) and this retriever keeps its index in memory from then on.
+        """
+        self.remove_persisted()
+        self.close()
+        self.index_dirname = None
+
+    def load_persisted_entries(self, entries, key):
+        """
+        :return: True if the vectors of key are already in the persisted index and only the entries were loaded
+        """
+        if self.persisted_pending and key in self.persisted_pending:
+            if key != self.persisted_pending[0]:
+                raise ValueError("{} loaded out of order, expected {}".format(key, self.persisted_pending[0]))
+            self.persisted_pending.pop(0)
+            self.findex += self.files.extend(entries)
+            return True
+        return False
+
+    def persist(self, force=False):
+        """
+        Write the index and manifest if index files were added since the last write, called once per refresh.
+        Indexes rewritten whole (HNSW) are written at most every persist_interval seconds unless forced.
+        """
+        if self.unsaved and (force or time.time() - self.persisted_ts >= self.persist_interval):
+            self.write_persisted()
+            self.unsaved = False
+            self.persisted_ts = time.time()
+
+    def write_persisted(self):
+        """
+        The index is written first, a manifest with a different ntotal (interrupted write) causes a rebuild.
+        """
+        if not self.index_dirname or self.faiss_index is None:
+            return
+        faiss.write_index(self.faiss_index, self.populated_path + '.tmp')
+        os.rename(self.populated_path + '.tmp', self.populated_path)
+        with open(self.manifest_path + '.tmp', 'w') as fh:
+            json.dump({'ntotal': self.faiss_index.ntotal, 'entries': self.persisted_entries}, fh)
+        os.rename(self.manifest_path + '.tmp', self.manifest_path)
+
+    def close(self):
+        if self.lock_file is not None:
+            fcntl.flock(self.lock_file, fcntl.LOCK_UN)
+            self.lock_file.close()
+            self.lock_file = None
+
+
+class FaissApproximateRetriever(PersistedIndexMixin, BaseRetriever):
+    # ids stored in the inverted lists are row numbers which cannot be renumbered in place
+    compaction = False
+
+    def __init__(self,name, approximator, index_dirname=None):
+        """
+        :param index_dirname: if specified, inverted lists of all loaded index files are merged into a single
+        memory-mapped .ivfdata file in this directory that is reused across restarts instead of being kept in RAM.
+        """
         super(FaissApproximateRetriever, self).__init__(name=name, approximator=approximator, algorithm="FAISS")
         self.index_path = str(approximator.index_path).replace('//','/')
-        self.ivfs = []
-        self.ivf_vector = faiss.InvertedListsPtrVector()
         self.uuid = str(uuid.uuid4()).replace('-','_')
-        self.faiss_index = None
+        self.index_dirname = index_dirname
+        self.ivfdata_path = str(os.path.join(index_dirname, 'merged.ivfdata')) if index_dirname else None
+        self.faiss_index = self.open_persisted()
+
+    def persisted_paths(self):
+        return super(FaissApproximateRetriever, self).persisted_paths() + [self.ivfdata_path]
+
+    def resident_bytes(self):
+        """
+        Codes of in-memory inverted lists are counted, on-disk inverted lists are memory-mapped.
+        """
+        size = super(FaissApproximateRetriever, self).resident_bytes()
+        if self.faiss_index is not None and not self.index_dirname:
+            size += self.faiss_index.ntotal * faiss.extract_index_ivf(self.faiss_index).code_size
+        return size
 
-    def load_index(self,computed_index_path,entries):
-        if len(entries):
+    def load_index(self,computed_index_path,entries,key=None):
+        """
+        :param key: identifies the index file (e.g. IndexEntries pk)
+        """
+        if entry_count(entries):
+            if self.load_persisted_entries(entries, key):
+                return
             computed_index_path = str(computed_index_path).replace('//', '/')
             logging.info("Adding {}".format(computed_index_path))
-            for i, e in enumerate(entries):
-                self.files[self.findex] = e
-                self.findex += 1
-            if self.faiss_index is None:
-                self.faiss_index = faiss.read_index(computed_index_path)
+            index = faiss.read_index(computed_index_path)
+            if self.index_dirname:
+                self.append_ondisk(index, key)
+            elif self.faiss_index is None:
+                self.faiss_index = index
             else:
-                index = faiss.read_index(computed_index_path)
                 self.faiss_index.merge_from(index,self.faiss_index.ntotal)
+            self.findex += self.files.extend(entries)
             logging.info("Index size {}".format(self.faiss_index.ntotal))
 
-    def nearest(self, vector=None, n=12, nprobe=16):
-        self.faiss_index.nprobe = nprobe
+    def append_ondisk(self, index, key):
+        """
+        Copy the inverted lists of index into the on-disk inverted lists with ids offset by the current size, the
+        index header (which holds the list sizes) and the manifest are written by the next persist().
+        """
+        if self.faiss_index is None:
+            source_ivf = faiss.extract_index_ivf(index)
+            self.faiss_index = faiss.read_index(self.index_path)
+            invlists = faiss.OnDiskInvertedLists(source_ivf.nlist, source_ivf.code_size, self.ivfdata_path)
+            faiss.extract_index_ivf(self.faiss_index).replace_invlists(invlists, True)
+            invlists.this.disown()
+        source = faiss.extract_index_ivf(index).invlists
+        target_ivf = faiss.extract_index_ivf(self.faiss_index)
+        offset = self.faiss_index.ntotal
+        for list_no in range(source.nlist):
+            n = source.list_size(list_no)
+            if n:
+                ids = faiss.rev_swig_ptr(source.get_ids(list_no), n).astype(np.int64) + offset
+                codes = faiss.rev_swig_ptr(source.get_codes(list_no), n * source.code_size).copy()
+                target_ivf.invlists.add_entries(list_no, n, faiss.swig_ptr(ids), faiss.swig_ptr(codes))
+        target_ivf.ntotal += index.ntotal
+        self.faiss_index.ntotal = target_ivf.ntotal
+        self.persisted_entries.append((key, index.ntotal))
+        self.unsaved = True
+
+    def nearest(self, vector=None, n=12, nprobe=16, filters=None):
         vector = np.atleast_2d(vector)
         if vector.shape[-1] != self.faiss_index.d:
             vector = vector.T
-        results = []
-        dist, ids = self.faiss_index.search(vector, n)
-        for i, k in enumerate(ids[0]):
-            temp = {'rank': i + 1, 'algo': self.name, 'dist': float(dist[0, i])}
-            temp.update(self.files[k])
-            results.append(temp)
-        return results
+        return self.nearest_batch(vector, n, nprobe, filters)[0]
+
+    def nearest_batch(self, matrix=None, n=12, nprobe=16, filters=None):
+        self.faiss_index.nprobe = nprobe
+        matrix = np.ascontiguousarray(np.atleast_2d(matrix), dtype=np.float32)
+        mask = self.search_mask(filters)
+        if mask is not None:
+            dist, ids = overfetch_topk(self.faiss_index.search, matrix, n, mask, self.faiss_index.ntotal)
+        else:
+            dist, ids = self.faiss_index.search(matrix, n)
+        return [self.ranked_results(dist[q], ids[q]) for q in range(matrix.shape[0])]
 
 
 class FaissFlatRetriever(BaseRetriever):
@@ -144,27 +957,178 @@ class FaissFlatRetriever(BaseRetriever):
         super(FaissFlatRetriever, self).__init__(name=name, algorithm="FAISS_{}".format(metric))
         self.name=name
         self.components = components
+        self.metric = metric
         self.algorithm="FAISS_{}".format(metric)
         self.faiss_index = faiss.index_factory(components, metric)
 
-    def load_index(self,numpy_matrix,entries):
-        if len(entries):
+    def load_index(self,numpy_matrix,entries,key=None):
+        if entry_count(entries):
             logging.info("Adding {}".format(numpy_matrix.shape))
             numpy_matrix = np.atleast_2d(numpy_matrix.squeeze())
-            for i, e in enumerate(entries):
-                self.files[self.findex] = e
-                self.findex += 1
+            self.findex += self.files.extend(entries)
             self.faiss_index.add(numpy_matrix)
             logging.info("Index size {}".format(self.faiss_index.ntotal))
 
-    def nearest(self, vector=None, n=12):
+    def resident_bytes(self):
+        return super(FaissFlatRetriever, self).resident_bytes() + self.faiss_index.ntotal * self.components * 4
+
+    def nearest(self, vector=None, n=12, filters=None):
         vector = np.atleast_2d(vector)
         if vector.shape[-1] != self.components:
             vector = vector.T
-        results = []
-        dist, ids = self.faiss_index.search(vector, n)
-        for i, k in enumerate(ids[0]):
-            temp = {'rank': i + 1, 'algo': self.name, 'dist': float(dist[0, i])}
-            temp.update(self.files[k])
-            results.append(temp)
-        return results
\ No newline at end of file
+        return self.nearest_batch(vector, n, filters)[0]
+
+    def nearest_batch(self, matrix=None, n=12, filters=None):
+        matrix = np.ascontiguousarray(np.atleast_2d(matrix), dtype=np.float32)
+        mask = self.search_mask(filters)
+        if mask is not None and self.faiss_index.ntotal:
+            # exact search over the stored vectors (a zero-copy view) restricted to live rows matching the filters
+            dist, ids = masked_topk(matrix, self.stored_vectors(), None, n, self.block_size, mask)
+            dist = dist ** 2  # IndexFlatL2 reports squared distances
+        else:
+            dist, ids = self.faiss_index.search(matrix, n)
+        return [self.ranked_results(dist[q], ids[q]) for q in range(matrix.shape[0])]
+
+    def stored_vectors(self):
+        """
+        Zero-copy view of the vectors of the index, it is invalidated when vectors are added.
+        """
+        if not self.faiss_index.ntotal:
+            return np.zeros((0, self.components), dtype=np.float32)
+        rows = faiss.rev_swig_ptr(self.faiss_index.xb.data(), self.faiss_index.ntotal * self.components)
+        return rows.reshape((-1, self.components))
+
+    def capture_index(self, keep, live):
+        # live vectors are copied since the storage of the index is reallocated when vectors are added
+        return {'vectors': self.stored_vectors()[keep]}
+
+    def build_index(self, compaction):
+        index = faiss.index_factory(self.components, self.metric)
+        if compaction['vectors'].shape[0]:
+            index.add(compaction['vectors'])
+        return index
+
+    def install_index(self, compaction, start, live):
+        index = compaction['index']
+        if self.faiss_index.ntotal > start:
+            index.add(np.ascontiguousarray(self.stored_vectors()[start:]))
+        self.faiss_index = index
+
+    def snapshot_index(self):
+        return {'rows_0': faiss.vector_to_array(self.faiss_index.xb).reshape((-1, self.components))}
+
+    def restore_index(self, arrays):
+        if arrays['rows_0'].shape[0]:
+            self.faiss_index.add(np.ascontiguousarray(arrays['rows_0'], dtype=np.float32))
+
+
+class HNSWRetriever(PersistedIndexMixin, BaseRetriever):
+    """
+    Graph based approximate retriever using FAISS IndexHNSWFlat, it requires no training and vectors are added
+    incrementally. The graph is persisted under index_dirname by persist() and reopened on restart.
+    """
+
+    def __init__(self, name, components, M=32, ef_construction=40, ef_search=64, index_dirname=None,
+                 persist_interval=0):
+        """
+        :param persist_interval: minimum seconds between writes of the graph, which is rewritten whole
+        """
+        super(HNSWRetriever, self).__init__(name=name, algorithm="HNSW")
+        self.persist_interval = persist_interval
+        self.components = components
+        self.M = M
+        self.ef_construction = ef_construction
+        self.ef_search = ef_search
+        self.index_dirname = index_dirname
+        self.faiss_index = self.open_persisted()
+        if self.faiss_index is None:
+            self.faiss_index = self.create_index()
+
+    def create_index(self):
+        index = faiss.IndexHNSWFlat(self.components, self.M)
+        index.hnsw.efConstruction = self.ef_construction
+        return index
+
+    def load_index(self,numpy_matrix,entries,key=None):
+        count = entry_count(entries)
+        if count:
+            if self.load_persisted_entries(entries, key):
+                return
+            vectors = np.ascontiguousarray(np.atleast_2d(numpy_matrix).reshape((-1, self.components)),
+                                           dtype=np.float32)
+            self.faiss_index.add(vectors)
+            self.findex += self.files.extend(entries)
+            self.persisted_entries.append((key, count))
+            self.unsaved = True
+            logging.info("Index size {}".format(self.faiss_index.ntotal))
+
+    def resident_bytes(self):
+        """
+        Flat storage of the vectors plus about 2 * M neighbor ids per vector in the base layer of the graph.
+        """
+        return super(HNSWRetriever, self).resident_bytes() + \
+            self.faiss_index.ntotal * (self.components * 4 + 2 * self.M * 4)
+
+    def stored_vectors(self):
+        """
+        Zero-copy view of the flat storage of the graph, it is invalidated when vectors are added.
+        """
+        storage = faiss.downcast_index(self.faiss_index.storage)
+        if not storage.ntotal:
+            return np.zeros((0, self.components), dtype=np.float32)
+        return faiss.rev_swig_ptr(storage.xb.data(), storage.ntotal * self.components).reshape((-1, self.components))
+
+    def capture_index(self, keep, live):
+        # live vectors are copied since the storage of the graph is reallocated when vectors are added
+        return {'vectors': self.stored_vectors()[keep]}
+
+    def build_index(self, compaction):
+        """
+        Vectors cannot be removed from the graph, a new graph is built from the live vectors of the flat storage.
+        """
+        index = self.create_index()
+        if compaction['vectors'].shape[0]:
+            index.add(compaction['vectors'])
+        return index
+
+    def install_index(self, compaction, start, live):
+        index = compaction['index']
+        if self.faiss_index.ntotal > start:
+            index.add(np.ascontiguousarray(self.stored_vectors()[start:]))
+        self.faiss_index = index
+        persisted_entries, start = [], 0
+        for key, count in self.persisted_entries:
+            if live[start]:
+                persisted_entries.append((key, count))
+            start += count
+        self.persisted_entries = persisted_entries
+        self.unsaved = True
+
+    def nearest(self, vector=None, n=12, ef_search=None, filters=None):
+        vector = np.atleast_2d(vector)
+        if vector.shape[-1] != self.components:
+            vector = vector.T
+        return self.nearest_batch(vector, n, ef_search, filters)[0]
+
+    def nearest_batch(self, matrix=None, n=12, ef_search=None, filters=None):
+        """
+        :param ef_search: size of the dynamic candidate list, higher values trade latency for recall
+        """
+        def search(queries, k):
+            self.faiss_index.hnsw.efSearch = max(ef_search if ef_search else self.ef_search, k)
+            return self.faiss_index.search(queries, k)
+
+        def exact(queries, k, mask):
+            dist, ids = masked_topk(queries, self.stored_vectors(), None, k, self.block_size, mask)
+            return dist ** 2, ids  # the graph reports squared distances
+        matrix = np.ascontiguousarray(np.atleast_2d(matrix), dtype=np.float32)
+        mask = self.search_mask(filters)
+        if mask is None:
+            dist, ids = search(matrix, n)
+            return [self.ranked_results(np.sqrt(dist[q]), ids[q]) for q in range(matrix.shape[0])]
+        if mask.sum() <= FILTER_EXACT_MAX_ROWS:
+            # the graph is poorly connected within a small selection, the flat storage is searched exactly instead
+            dist, ids = masked_topk(matrix, self.stored_vectors(), None, n, self.block_size, mask)
+            return [self.ranked_results(dist[q], ids[q]) for q in range(matrix.shape[0])]
+        dist, ids = overfetch_topk(search, matrix, n, mask, self.faiss_index.ntotal, exact)
+        return [self.ranked_results(np.sqrt(dist[q]), ids[q]) for q in range(matrix.shape[0])]
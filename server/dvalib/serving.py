@@ -0,0 +1,93 @@
+import logging, threading, time
+from Queue import Queue, Empty
+
+
+class BatchRequest(object):
+
+    def __init__(self, items):
+        self.items = items
+        self.results = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class MicroBatcher(object):
+    """
+    Combines calls submitted concurrently by several threads (e.g. query tasks of a threaded model worker) into
+    batches: items are collected for up to max_wait seconds after the first pending request or until max_batch_size
+    items are pending, run with a single apply_batch call on a background thread and the results are scattered back
+    to the submitting threads. A single request larger than max_batch_size is run as one batch.
+    """
+
+    def __init__(self, apply_batch, max_batch_size=16, max_wait=0.01, name="model"):
+        self.apply_batch = apply_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.name = name
+        self.requests = Queue()
+        self.held = None
+        self.batches = 0
+        self.items = 0
+        self.thread = threading.Thread(target=self.run, name="{} micro-batcher".format(name))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def submit(self, items):
+        """
+        :param items: list of inputs of apply_batch
+        :return: list of results of apply_batch for these items, exceptions raised by apply_batch are re-raised
+        """
+        request = BatchRequest(list(items))
+        if not request.items:
+            return []
+        self.requests.put(request)
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.results
+
+    def collect(self):
+        if self.held is None:
+            batch = [self.requests.get()]
+        else:
+            batch, self.held = [self.held], None
+        size = len(batch[0].items)
+        deadline = time.time() + self.max_wait
+        while size < self.max_batch_size:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            try:
+                request = self.requests.get(timeout=remaining)
+            except Empty:
+                break
+            if size + len(request.items) > self.max_batch_size:
+                # run in the next batch rather than exceed max_batch_size
+                self.held = request
+                break
+            batch.append(request)
+            size += len(request.items)
+        return batch
+
+    def run(self):
+        while True:
+            batch = self.collect()
+            items = [item for request in batch for item in request.items]
+            try:
+                results = self.apply_batch(items)
+                if len(results) != len(items):
+                    raise ValueError("{} returned {} results for {} items".format(self.name, len(results),
+                                                                                   len(items)))
+            except Exception as e:
+                logging.exception("{} failed on a batch of {} requests".format(self.name, len(batch)))
+                for request in batch:
+                    request.error = e
+                    request.done.set()
+                continue
+            start = 0
+            for request in batch:
+                request.results = results[start:start + len(request.items)]
+                start += len(request.items)
+                request.done.set()
+            self.batches += 1
+            self.items += len(items)
@@ -0,0 +1,132 @@
+import os
+import json
+import fcntl
+import logging
+import numpy as np
+
+_open_shards = {}
+
+
+class ShardedVectorStore(object):
+    """
+    Append-only store that consolidates many small per-event feature matrices into a few large shard files.
+    Shards are raw row-major float32 files, readers memory-map them so that several processes on the same
+    host share the page cache instead of each holding a private heap copy of the vectors.
+    """
+
+    def __init__(self, dirname, shard_rows=1000000, dtype=np.float32):
+        self.dirname = dirname
+        self.shard_rows = shard_rows
+        self.dtype = np.dtype(dtype)
+        self.meta_path = os.path.join(dirname, 'store.json')
+        self.lock_path = os.path.join(dirname, 'store.lock')
+        self.lock_file = None
+        if not os.path.isdir(dirname):
+            try:
+                os.makedirs(dirname)
+            except OSError:
+                pass
+
+    def __enter__(self):
+        self.lock_file = open(self.lock_path, 'a')
+        fcntl.flock(self.lock_file, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        fcntl.flock(self.lock_file, fcntl.LOCK_UN)
+        self.lock_file.close()
+        self.lock_file = None
+
+    def shard_name(self, shard_index):
+        return "{:06d}.f32".format(shard_index)
+
+    def read_meta(self):
+        if os.path.isfile(self.meta_path):
+            with open(self.meta_path) as fh:
+                return json.load(fh)
+        return {'shard_index': 0, 'rows': 0, 'dimensions': None}
+
+    def write_meta(self, meta):
+        temp_path = "{}.tmp".format(self.meta_path)
+        with open(temp_path, 'w') as fh:
+            json.dump(meta, fh)
+        os.rename(temp_path, self.meta_path)
+
+    def append(self, vectors):
+        """
+        Append a matrix to the current shard, an entry is never split across two shards.
+        Must be called inside "with store:" so that concurrent writers on the same host are serialized.
+        :return: dict with shard file name, row offset, row count and dimensions
+        """
+        if self.lock_file is None:
+            raise ValueError("ShardedVectorStore.append must be called while holding the store lock")
+        vectors = np.ascontiguousarray(np.atleast_2d(vectors), dtype=self.dtype)
+        meta = self.read_meta()
+        if meta['dimensions'] is None:
+            meta['dimensions'] = vectors.shape[1]
+        elif meta['dimensions'] != vectors.shape[1]:
+            raise ValueError("Cannot append vectors with {} dimensions to store with {}".format(vectors.shape[1],
+                                                                                               meta['dimensions']))
+        if meta['rows'] and meta['rows'] + vectors.shape[0] > self.shard_rows:
+            meta['shard_index'] += 1
+            meta['rows'] = 0
+        shard_path = os.path.join(self.dirname, self.shard_name(meta['shard_index']))
+        with open(shard_path, 'ab') as fh:
+            # truncate rows left behind by an interrupted append
+            fh.truncate(meta['rows'] * meta['dimensions'] * self.dtype.itemsize)
+            fh.seek(0, os.SEEK_END)
+            fh.write(vectors.tobytes())
+        location = {'shard': self.shard_name(meta['shard_index']), 'offset': meta['rows'],
+                    'count': vectors.shape[0], 'dimensions': meta['dimensions']}
+        meta['rows'] += vectors.shape[0]
+        self.write_meta(meta)
+        return location
+
+
+def load_shard_slice(shard_path, offset, count, dimensions, dtype=np.float32):
+    """
+    Return a zero-copy read-only view of rows [offset, offset + count) of a shard. The shard is mapped once per
+    process and remapped only when it has grown past the previously mapped length.
+    """
+    dtype = np.dtype(dtype)
+    shard = _open_shards.get(shard_path, None)
+    if shard is None or shard.shape[0] < offset + count:
+        rows = os.path.getsize(shard_path) // (dimensions * dtype.itemsize)
+        if rows < offset + count:
+            raise ValueError("Shard {} has {} rows, {} required".format(shard_path, rows, offset + count))
+        shard = np.memmap(shard_path, dtype=dtype, mode='r', shape=(rows, dimensions))
+        _open_shards[shard_path] = shard
+        logging.info("Mapped shard {} with {} rows".format(shard_path, rows))
+    return shard[offset:offset + count]
+
+
+def shard_of(view):
+    """
+    Return the mapped shard the view belongs to, or None if it is not a view of a vector store shard.
+    """
+    if isinstance(view, np.memmap):
+        for shard in _open_shards.itervalues():
+            if np.may_share_memory(view, shard):
+                return shard
+    return None
+
+
+def is_shard_view(view):
+    return shard_of(view) is not None
+
+
+def contiguous_union(first, second):
+    """
+    If second starts exactly where first ends within the same mapped shard return a single view spanning both,
+    this lets a retriever keep consecutive entries of a shard as one segment. Otherwise returns None.
+    """
+    shard = shard_of(first)
+    if shard is None or shard_of(second) is not shard:
+        return None
+    row_bytes = shard.strides[0]
+    start = first.__array_interface__['data'][0] - shard.__array_interface__['data'][0]
+    end = second.__array_interface__['data'][0] - shard.__array_interface__['data'][0]
+    if start % row_bytes == 0 and end == start + first.shape[0] * row_bytes:
+        start_row = start // row_bytes
+        return shard[start_row:start_row + first.shape[0] + second.shape[0]]
+    return None
@@ -12,7 +12,14 @@ if __name__ == '__main__':
             block_on_manager = True
     for k in os.environ:
         if k.startswith('LAUNCH_BY_NAME_'):
-            qtype, model_name = k.split('_')[-2:]
+            parts = k.split('_')
+            shard = None
+            if len(parts) > 5 and parts[-3] == 'retriever':
+                # LAUNCH_BY_NAME_retriever_<name>_<shard> launches a shard queue of a sharded retriever, "all"
+                # launches every shard queue, deployments with several containers launch shards separately
+                qtype, model_name, shard = parts[-3:]
+            else:
+                qtype, model_name = parts[-2:]
             env_mode = None
             if qtype == 'indexer':
                 dm = TrainedModel.objects.filter(name=model_name, model_type=TrainedModel.INDEXER).first()
@@ -41,8 +48,14 @@ if __name__ == '__main__':
                 if env_mode:
                     envs[env_mode] = "1"
                 _ = subprocess.Popen(['./startq.py',queue_name], env=envs)
-            else:
+            elif shard is None:
                 _ = subprocess.Popen(['./startq.py', queue_name])
+            elif shard == 'all':
+                shards = int(dm.arguments.get('shards', 1)) if dm.arguments else 1
+                for shard in range(shards):
+                    _ = subprocess.Popen(['./startq.py', '{}_{}'.format(queue_name, shard)])
+            else:
+                _ = subprocess.Popen(['./startq.py', '{}_{}'.format(queue_name, int(shard))])
         elif k.startswith('LAUNCH_Q_') and k != 'LAUNCH_Q_{}'.format(settings.Q_MANAGER):
             if k.strip() == 'LAUNCH_Q_qextract':
                 queue_name = k.split('_')[-1]
@@ -6,8 +6,14 @@ if __name__ == "__main__":
     os.environ.setdefault("DJANGO_SETTINGS_MODULE", "dva.settings")
     django.setup()
     from django_celery_beat.models import PeriodicTask,IntervalSchedule
+    from django.conf import settings
     di,created = IntervalSchedule.objects.get_or_create(every=os.environ.get('REFRESH_MINUTES',3),period=IntervalSchedule.MINUTES)
     _ = PeriodicTask.objects.get_or_create(name="monitoring",task="monitor_system",interval=di,queue='qscheduler')
+    if settings.INDEX_COMPACTION_MIN_ENTRIES:
+        ci,created = IntervalSchedule.objects.get_or_create(every=settings.INDEX_COMPACTION_INTERVAL_MINUTES,
+                                                            period=IntervalSchedule.MINUTES)
+        _ = PeriodicTask.objects.get_or_create(name="index_compaction",task="schedule_index_compaction",interval=ci,
+                                               queue='qscheduler')
     p = subprocess.Popen(['./startq.py','qscheduler'])
     if os.path.isfile('celerybeat.pid'):
         # Remove stale celerybeat pidfile which happens in dev mode
@@ -53,6 +53,10 @@ if __name__ == "__main__":
         command = 'celery -A dva worker -l info {} -c {} -Q {} -n {}.%h {}'.format(mute, max(int(conc), 4),
                                                                                    queue_name, queue_name,
                                                                                    log_output(queue_name, settings))
+    elif settings.MODEL_SERVING_THREADS > 1 and queue_name.startswith(('q_indexer_', 'q_detector_', 'q_analyzer_')):
+        # concurrent query tasks share the models, their calls are batched by ModelServer
+        command = 'celery -A dva worker -l info {} -P dva.celery:ThreadTaskPool -c {} -Q {} -n {}.%h {}'.format(
+            mute, settings.MODEL_SERVING_THREADS, queue_name, queue_name, log_output(queue_name, settings))
     else:
         command = 'celery -A dva worker -l info {} -P solo -c {} -Q {} -n {}.%h {}'.format(mute, 1, queue_name,
                                                                                            queue_name,
@@ -0,0 +1,42 @@
+#!/usr/bin/env python
+"""
+Micro-benchmark comparing the blocked top-k exact search in BaseRetriever.nearest against
+the previous cdist + full argsort path. Defaults to at most 100k vectors of 512 dimensions (~200 MB),
+larger runs e.g. --sizes 10000,100000,1000000 --dimensions 2048 need about 8 GB of memory.
+"""
+import sys, time, argparse
+import numpy as np
+from scipy import spatial
+sys.path.append("../../server/")
+from dvalib import retriever
+
+
+def cdist_argsort_nearest(vector, index, n):
+    dist = spatial.distance.cdist(vector, index)
+    ranked = np.squeeze(dist.argsort())
+    return ranked[:n], dist[0, ranked[:n]]
+
+
+def timed(f, repeats):
+    start = time.time()
+    for _ in range(repeats):
+        output = f()
+    return (time.time() - start) / repeats, output
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--sizes', default="10000,100000", help="comma separated numbers of indexed vectors")
+    parser.add_argument('--dimensions', type=int, default=512)
+    args = parser.parse_args()
+    dimensions, n, repeats = args.dimensions, 20, 5
+    for size in [int(k) for k in args.sizes.split(',')]:
+        index = np.random.rand(size, dimensions).astype(np.float32)
+        query = np.random.rand(1, dimensions).astype(np.float32)
+        r = retriever.BaseRetriever(name="benchmark")
+        r.load_index(index, [{'index': i} for i in range(size)])
+        old_time, (old_ids, old_dist) = timed(lambda: cdist_argsort_nearest(query, index, n), repeats)
+        new_time, results = timed(lambda: r.nearest(query, n), repeats)
+        new_ids = [k['index'] for k in results]
+        print "{} vectors: cdist+argsort {:.4f}s blocked top-k {:.4f}s speedup {:.1f}x, same top-{} {}".format(
+            size, old_time, new_time, old_time / new_time, n, list(old_ids) == new_ids)
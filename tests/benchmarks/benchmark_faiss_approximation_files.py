@@ -0,0 +1,43 @@
+#!/usr/bin/env python
+"""
+File count and disk size of FAISS approximation output for 1000 synthetic index entries of 20 vectors each,
+comparing one clone_index + .index file per entry against streaming all entries into one index file.
+"""
+import sys, os, glob, time, tempfile, shutil
+import numpy as np
+sys.path.append("../../server/")
+from dvalib import approximator
+import faiss
+
+
+def directory_size(dirname):
+    paths = glob.glob("{}/*.index".format(dirname))
+    return len(paths), sum(os.path.getsize(p) for p in paths)
+
+
+if __name__ == '__main__':
+    entries, rows_per_entry, dimensions = 1000, 20, 128
+    dirname = tempfile.mkdtemp()
+    trained = faiss.index_factory(dimensions, "IVF1024,PQ32")
+    trained.train(np.random.rand(50000, dimensions).astype(np.float32))
+    faiss.write_index(trained, "{}/faiss.index".format(dirname))
+    approx = approximator.FAISSApproximator("benchmark", dirname)
+    batches = [np.random.rand(rows_per_entry, dimensions).astype(np.float32) for _ in range(entries)]
+    per_entry_dir, bulk_dir = "{}/per_entry".format(dirname), "{}/bulk".format(dirname)
+    os.mkdir(per_entry_dir)
+    os.mkdir(bulk_dir)
+    start = time.time()
+    for i, vectors in enumerate(batches):
+        approx.approximate_batch(vectors, "{}/{}.index".format(per_entry_dir, i))
+    per_entry_time = time.time() - start
+    start = time.time()
+    approx.approximate_stream(iter(batches), "{}/task.index".format(bulk_dir))
+    bulk_time = time.time() - start
+    per_entry_files, per_entry_bytes = directory_size(per_entry_dir)
+    bulk_files, bulk_bytes = directory_size(bulk_dir)
+    print "{} index entries ({} vectors)".format(entries, entries * rows_per_entry)
+    print "per entry: {} files {:.1f} MB in {:.2f}s".format(per_entry_files, per_entry_bytes / 1e6, per_entry_time)
+    print "bulk: {} files {:.1f} MB in {:.2f}s".format(bulk_files, bulk_bytes / 1e6, bulk_time)
+    print "reduction: {}x fewer files, {:.1f}x less disk".format(per_entry_files / bulk_files,
+                                                                 float(per_entry_bytes) / bulk_bytes)
+    shutil.rmtree(dirname)
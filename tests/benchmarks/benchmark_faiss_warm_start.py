@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+"""
+Warm-start benchmark for FaissApproximateRetriever with 1000 synthetic per-event IVF-PQ index files, comparing
+read_index + merge_from of every file against building and reopening the merged on-disk inverted lists.
+"""
+import sys, time, tempfile, shutil
+import numpy as np
+sys.path.append("../../server/")
+from dvalib import retriever, approximator
+import faiss
+from fixtures import entries_for
+
+
+def create_index_files(dirname, files, rows_per_file, dimensions):
+    trained = faiss.index_factory(dimensions, "IVF1024,PQ32")
+    trained.train(np.random.rand(50000, dimensions).astype(np.float32))
+    faiss.write_index(trained, "{}/faiss.index".format(dirname))
+    paths = []
+    for i in range(files):
+        index = faiss.clone_index(trained)
+        index.add(np.random.rand(rows_per_file, dimensions).astype(np.float32))
+        paths.append("{}/{}.index".format(dirname, i))
+        faiss.write_index(index, paths[-1])
+    return paths
+
+
+def load(approx, paths, rows_per_file, index_dirname=None):
+    start = time.time()
+    r = retriever.FaissApproximateRetriever(name="benchmark", approximator=approx, index_dirname=index_dirname)
+    for i, path in enumerate(paths):
+        r.load_index(path, entries_for(i, rows_per_file), key=i)
+    elapsed = time.time() - start
+    r.close()
+    return r, elapsed
+
+
+if __name__ == '__main__':
+    files, rows_per_file, dimensions = 1000, 1000, 128
+    dirname = tempfile.mkdtemp()
+    paths = create_index_files(dirname, files, rows_per_file, dimensions)
+    approx = approximator.FAISSApproximator("benchmark", dirname)
+    queries = np.random.rand(10, dimensions).astype(np.float32)
+    merged, merge_time = load(approx, paths, rows_per_file)
+    built, build_time = load(approx, paths, rows_per_file, index_dirname="{}/ondisk".format(dirname))
+    warm, warm_time = load(approx, paths, rows_per_file, index_dirname="{}/ondisk".format(dirname))
+    identical = all([r['frame_primary_key'] for r in a] == [r['frame_primary_key'] for r in b]
+                    for a, b in zip(merged.nearest_batch(queries, 20), warm.nearest_batch(queries, 20)))
+    print "{} index files ({} vectors): read_index + merge_from {:.2f}s, on-disk build {:.2f}s, on-disk warm " \
+          "start {:.2f}s, speedup {:.1f}x, identical results {}".format(files, files * rows_per_file, merge_time,
+                                                                       build_time, warm_time,
+                                                                       merge_time / warm_time, identical)
+    shutil.rmtree(dirname)
@@ -0,0 +1,35 @@
+#!/usr/bin/env python
+"""
+Latency of metadata filtered search (one video out of 100) inside BaseRetriever and HNSWRetriever on 50k
+synthetic 128 dimensional vectors, compared with fetching 50x more results unfiltered and filtering afterwards.
+"""
+import sys, time, tempfile, shutil
+import numpy as np
+sys.path.append("../../server/")
+from dvalib import retriever
+from fixtures import entries_for
+
+
+def timed(f, queries):
+    start = time.time()
+    results = [f(q) for q in queries]
+    return results, (time.time() - start) * 1000.0 / len(queries)
+
+
+if __name__ == '__main__':
+    files, rows_per_file, dimensions, count = 100, 500, 128, 20
+    dirname = tempfile.mkdtemp()
+    queries = np.random.rand(50, dimensions).astype(np.float32)
+    filters = {'video_id': 42}
+    for r in [retriever.BaseRetriever(name="base"),
+              retriever.HNSWRetriever(name="hnsw", components=dimensions, index_dirname=dirname)]:
+        for i in range(files):
+            r.load_index(np.random.rand(rows_per_file, dimensions).astype(np.float32), entries_for(i, rows_per_file),
+                         key=i)
+        filtered, filtered_latency = timed(lambda q: r.nearest(q, count, filters=filters), queries)
+        post, post_latency = timed(lambda q: [k for k in r.nearest(q, count * 50)
+                                              if k['video_primary_key'] == '42'][:count], queries)
+        print "{}: filtered {:.2f}ms ({:.1f} results / query), fetch {} + post filter {:.2f}ms ({:.1f} results / " \
+              "query)".format(r.__class__.__name__, filtered_latency, np.mean([len(k) for k in filtered]),
+                              count * 50, post_latency, np.mean([len(k) for k in post]))
+    shutil.rmtree(dirname)
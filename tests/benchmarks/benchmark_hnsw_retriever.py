@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+"""
+Recall and latency of HNSWRetriever at several efSearch values against the exact FaissFlatRetriever on
+100k synthetic 128 dimensional vectors (e.g. face embeddings).
+"""
+import sys, time, tempfile, shutil
+import numpy as np
+sys.path.append("../../server/")
+from dvalib import retriever
+
+
+def timed_search(r, queries, n, **kwargs):
+    start = time.time()
+    results = [r.nearest(q, n, **kwargs) for q in queries]
+    return results, (time.time() - start) * 1000.0 / len(queries)
+
+
+def recall(expected, results):
+    hits = 0
+    for e, r in zip(expected, results):
+        hits += len(set(k['index'] for k in e) & set(k['index'] for k in r))
+    return float(hits) / sum(len(e) for e in expected)
+
+
+if __name__ == '__main__':
+    vectors, dimensions, count, chunk = 100000, 128, 20, 1000
+    data = np.random.rand(vectors, dimensions).astype(np.float32)
+    queries = np.random.rand(200, dimensions).astype(np.float32)
+    dirname = tempfile.mkdtemp()
+    flat = retriever.FaissFlatRetriever(name="flat", components=dimensions)
+    hnsw = retriever.HNSWRetriever(name="hnsw", components=dimensions, index_dirname=dirname)
+    start = time.time()
+    for i in range(0, vectors, chunk):
+        entries = [{'index': i + k} for k in range(chunk)]
+        flat.load_index(data[i:i + chunk], entries)
+        hnsw.load_index(data[i:i + chunk], entries, key=i)
+    hnsw.persist()
+    print "HNSW build of {} vectors in {:.1f}s (incremental adds of {})".format(vectors, time.time() - start, chunk)
+    expected, flat_latency = timed_search(flat, queries, count)
+    print "FaissFlatRetriever: recall@{} 1.000 latency {:.2f}ms".format(count, flat_latency)
+    for ef_search in [16, 32, 64, 128, 256]:
+        results, latency = timed_search(hnsw, queries, count, ef_search=ef_search)
+        print "HNSWRetriever efSearch={}: recall@{} {:.3f} latency {:.2f}ms".format(ef_search, count,
+                                                                                  recall(expected, results), latency)
+    hnsw.close()
+    start = time.time()
+    reopened = retriever.HNSWRetriever(name="hnsw", components=dimensions, index_dirname=dirname)
+    for i in range(0, vectors, chunk):
+        reopened.load_index(None, [{'index': i + k} for k in range(chunk)], key=i)
+    print "Reopened persisted graph in {:.2f}s, recall@{} {:.3f}".format(
+        time.time() - start, count, recall(expected, timed_search(reopened, queries, count)[0]))
+    reopened.close()
+    shutil.rmtree(dirname)
@@ -0,0 +1,46 @@
+#!/usr/bin/env python
+"""
+Indexing 20k images with a simulated indexer (5ms per batch of 100 images producing 1 x 2048 features each),
+comparing collecting all features and saving them afterwards with streaming batches to a background FeatureWriter.
+The TF input pipeline overlap (prefetch, parallel decode) requires the models and is reported by StageTimings.
+"""
+import sys, time, tempfile, shutil
+import numpy as np
+sys.path.append("../../server/")
+from dvalib.base_indexer import BaseIndexer, StageTimings, FeatureWriter
+
+
+class SimulatedIndexer(BaseIndexer):
+    def __init__(self, dimensions):
+        super(SimulatedIndexer, self).__init__()
+        self.name = "simulated"
+        self.support_batching = True
+        self.dimensions = dimensions
+
+    def apply_batch(self, paths):
+        time.sleep(0.005 * len(paths) / 100.0)
+        return {path: np.random.rand(1, self.dimensions).astype(np.float32) for path in paths}
+
+
+if __name__ == '__main__':
+    count, dimensions = 20000, 2048
+    dirname = tempfile.mkdtemp()
+    paths = ["{}.jpg".format(i) for i in range(count)]
+    indexer = SimulatedIndexer(dimensions)
+    start = time.time()
+    features = indexer.index_paths(paths)
+    with open("{}/collected.npy".format(dirname), 'w') as feats:
+        np.save(feats, np.array(features))
+    collected_time = time.time() - start
+    start = time.time()
+    timings = StageTimings(indexer.name)
+    writer = FeatureWriter("{}/streamed.npy".format(dirname), count, timings)
+    for positions, chunk in indexer.stream_paths(paths, timings):
+        writer.put(positions, chunk)
+    writer.close()
+    streamed_time = time.time() - start
+    print "collect then save {:.2f}s, stream to writer {:.2f}s ({}), identical shapes {}".format(
+        collected_time, streamed_time, timings.summary(),
+        np.load("{}/collected.npy".format(dirname), mmap_mode='r').shape ==
+        np.load("{}/streamed.npy".format(dirname), mmap_mode='r').shape)
+    shutil.rmtree(dirname)
@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+"""
+Load test of query-time model calls: 16 concurrent clients each sending 25 single image requests to a simulated
+model (15ms per forward pass plus 1ms per image, releasing the GIL like TF / torch). Compares the current path,
+one forward pass at a time at batch size 1 as in a solo model worker, with MicroBatcher (max batch 16, 5ms window).
+"""
+import sys, time, threading
+import numpy as np
+sys.path.append("../../server/")
+from dvalib.serving import MicroBatcher
+
+
+def forward(items):
+    time.sleep(0.015 + 0.001 * len(items))
+    return [item * 2 for item in items]
+
+
+def load_test(call, clients, requests_per_client):
+    latencies = []
+    lock = threading.Lock()
+
+    def client(offset):
+        for i in range(requests_per_client):
+            start = time.time()
+            assert call(offset + i) == 2 * (offset + i)
+            with lock:
+                latencies.append(time.time() - start)
+
+    threads = [threading.Thread(target=client, args=(k * requests_per_client,)) for k in range(clients)]
+    start = time.time()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.time() - start
+    return np.percentile(latencies, 50) * 1000.0, np.percentile(latencies, 99) * 1000.0, len(latencies) / elapsed
+
+
+if __name__ == '__main__':
+    clients, requests_per_client = 16, 25
+    model_lock = threading.Lock()
+
+    def solo(item):
+        with model_lock:
+            return forward([item])[0]
+
+    batcher = MicroBatcher(forward, max_batch_size=16, max_wait=0.005, name="simulated")
+    for name, call in [("solo, batch size 1", solo), ("micro-batching", lambda item: batcher.submit([item])[0])]:
+        p50, p99, throughput = load_test(call, clients, requests_per_client)
+        print "{}: p50 {:.1f}ms, p99 {:.1f}ms, {:.1f} requests/s".format(name, p50, p99, throughput)
+    print "mean batch size {:.1f}".format(batcher.items / float(batcher.batches))
@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+"""
+Region-heavy workload: 100 synthetic 1280x720 JPEG frames with 30 regions each. Compares preparing indexer input
+via temporary JPEG crops (crop, encode, write, read, decode as done previously) against in-memory crops (decode
+each frame once, crop as numpy slices as fed to index_images).
+"""
+import sys, time, tempfile, shutil
+import numpy as np
+from PIL import Image
+sys.path.append("../../server/")
+from dvalib.base_indexer import crop_image
+
+
+def create_frames(dirname, frames, width, height):
+    paths = []
+    gradient = np.linspace(0, 255, width, dtype=np.float32)[np.newaxis, :, np.newaxis]
+    for i in range(frames):
+        noise = np.random.randint(0, 64, (height, width, 3))
+        paths.append("{}/{}.jpg".format(dirname, i))
+        Image.fromarray(np.clip(gradient + noise, 0, 255).astype(np.uint8)).save(paths[-1])
+    return paths
+
+
+def temporary_jpegs(paths, regions):
+    temp_root = tempfile.mkdtemp()
+    crops = []
+    for frame_index, path in enumerate(paths):
+        image = Image.open(path)
+        for k, (x, y, w, h) in enumerate(regions[frame_index]):
+            region_path = "{}/{}_{}.jpg".format(temp_root, frame_index, k)
+            image.crop((x, y, x + w, y + h)).save(region_path)
+            crops.append(np.asarray(Image.open(region_path).convert('RGB')))
+    shutil.rmtree(temp_root)
+    return crops
+
+
+def in_memory(paths, regions):
+    crops = []
+    for frame_index, path in enumerate(paths):
+        image = np.asarray(Image.open(path).convert('RGB'))
+        for x, y, w, h in regions[frame_index]:
+            crops.append(crop_image(image, x, y, w, h))
+    return crops
+
+
+if __name__ == '__main__':
+    frames, regions_per_frame, width, height = 100, 30, 1280, 720
+    dirname = tempfile.mkdtemp()
+    paths = create_frames(dirname, frames, width, height)
+    regions = []
+    for _ in range(frames):
+        w, h = np.random.randint(32, 400, regions_per_frame), np.random.randint(32, 400, regions_per_frame)
+        x, y = (np.random.rand(regions_per_frame) * (width - w)).astype(int), \
+            (np.random.rand(regions_per_frame) * (height - h)).astype(int)
+        regions.append(zip(x, y, w, h))
+    count = frames * regions_per_frame
+    results = {}
+    for name, prepare in [("temporary JPEG crops", temporary_jpegs), ("in-memory crops", in_memory)]:
+        start = time.time()
+        results[name] = prepare(paths, regions)
+        elapsed = time.time() - start
+        print "{}: {} regions in {:.2f}s, {:.0f} regions/s".format(name, count, elapsed, count / elapsed)
+    print "identical shapes {}".format(all(a.shape == b.shape for a, b in zip(*results.values())))
+    shutil.rmtree(dirname)
@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+"""
+Latency benchmark for Retrievers.retrieve at count=20/100/1000, comparing the bulk_create of result rows
+against the previous per-result save (and Region lookup for region hits).
+Run after test_ci.py so that the database contains indexed frames and regions.
+"""
+import django, os, sys, time
+sys.path.append("../../server/")
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "dva.settings")
+django.setup()
+import numpy as np
+from dvaapp.models import DVAPQL, TEvent, Retriever, QueryResults, Region
+from dvaapp.operations.retrieval import Retrievers
+
+
+def per_result_save(event, retriever_pk, vector, count):
+    index_retriever, dr = Retrievers.get_retriever(retriever_pk)
+    Retrievers.refresh_index(dr)
+    for rank, r in enumerate(index_retriever.nearest(vector, n=count)):
+        qr = QueryResults()
+        qr.query = event.parent_process
+        qr.retrieval_event_id = event.pk
+        if 'detection_primary_key' in r:
+            dd = Region.objects.get(pk=r['detection_primary_key'])
+            qr.detection = dd
+            qr.frame_id = dd.frame_id
+        else:
+            qr.frame_id = r['frame_primary_key']
+        qr.video_id = r['video_primary_key']
+        qr.algorithm = dr.algorithm
+        qr.rank = r.get('rank', rank)
+        qr.distance = r.get('dist', rank)
+        qr.save()
+
+
+def timed(method, dr, vector, count, repeats=5):
+    timings = []
+    for _ in range(repeats):
+        event = TEvent.objects.create(parent_process=DVAPQL.objects.create(process_type=DVAPQL.QUERY),
+                                      operation='perform_retrieval')
+        start = time.time()
+        method(event, dr.pk, vector, count)
+        timings.append(time.time() - start)
+    return np.median(timings)
+
+
+if __name__ == '__main__':
+    for dr in Retriever.objects.filter(algorithm=Retriever.EXACT, approximator_shasum=None):
+        index_retriever, _ = Retrievers.get_retriever(dr.pk)
+        Retrievers.refresh_index(dr)
+        if len(index_retriever.index) == 0:
+            continue
+        vector = np.random.rand(index_retriever.index.shape[1]).astype(np.float32)
+        for count in [20, 100, 1000]:
+            # warm up the retriever so that only result persistence differs
+            timed(Retrievers.retrieve, dr, vector, count, repeats=1)
+            old_time = timed(per_result_save, dr, vector, count)
+            new_time = timed(Retrievers.retrieve, dr, vector, count)
+            print "retriever {} ({} vectors) count={}: per-result save {:.1f}ms bulk_create {:.1f}ms " \
+                  "speedup {:.1f}x".format(dr.name, len(index_retriever.index), count, old_time * 1000.0,
+                                           new_time * 1000.0, old_time / new_time)
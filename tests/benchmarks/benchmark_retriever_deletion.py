@@ -0,0 +1,46 @@
+#!/usr/bin/env python
+"""
+Deleting 10 of 200 videos (200k synthetic 128 dimensional vectors) from loaded BaseRetriever and FaissFlatRetriever,
+comparing tombstoning plus compaction against rebuilding the retriever from the remaining index files.
+"""
+import sys, time
+import numpy as np
+sys.path.append("../../server/")
+from dvalib import retriever
+from dvalib.indexer import IndexRange
+from fixtures import entries_for
+
+
+def build(cls, kwargs, vectors, keys, rows_per_file):
+    r = cls(name="benchmark", **kwargs)
+    for i in keys:
+        start = r.findex
+        r.load_index(vectors[i], entries_for(i, rows_per_file), key=i)
+        r.loaded_entries[i] = IndexRange(start=start, end=r.findex - 1)
+    return r
+
+
+if __name__ == '__main__':
+    files, rows_per_file, dimensions = 200, 1000, 128
+    vectors = [np.random.rand(rows_per_file, dimensions).astype(np.float32) for _ in range(files)]
+    queries = np.random.rand(10, dimensions).astype(np.float32)
+    deleted = range(0, files, files / 10)
+    for cls, kwargs in [(retriever.BaseRetriever, {}), (retriever.FaissFlatRetriever, {'components': dimensions})]:
+        r = build(cls, kwargs, vectors, range(files), rows_per_file)
+        start = time.time()
+        r.delete(deleted)
+        delete_time = time.time() - start
+        start = time.time()
+        tombstoned = r.nearest_batch(queries, 20)
+        search_time = time.time() - start
+        start = time.time()
+        r.compact()
+        compact_time = time.time() - start
+        start = time.time()
+        rebuilt = build(cls, kwargs, vectors, [i for i in range(files) if i not in deleted], rows_per_file)
+        rebuild_time = time.time() - start
+        identical = all([k['frame_primary_key'] for k in a] == [k['frame_primary_key'] for k in b]
+                        for a, b in zip(tombstoned, rebuilt.nearest_batch(queries, 20)))
+        print "{}: tombstone {:.4f}s, search with tombstones {:.3f}s, compaction {:.2f}s, rebuild {:.2f}s, " \
+              "identical results {}".format(cls.__name__, delete_time, search_time, compact_time, rebuild_time,
+                                            identical)
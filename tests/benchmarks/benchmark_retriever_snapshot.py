@@ -0,0 +1,41 @@
+#!/usr/bin/env python
+"""
+Warm start of BaseRetriever with 1000 synthetic per-event .npy index files of 1000 x 128 vectors, comparing
+loading every file and its entries against restoring a snapshot written by write_snapshot (memory-mapped).
+"""
+import sys, os, time, tempfile, shutil
+import numpy as np
+sys.path.append("../../server/")
+from dvalib import retriever
+from fixtures import entries_for
+
+
+if __name__ == '__main__':
+    files, rows_per_file, dimensions = 1000, 1000, 128
+    dirname = tempfile.mkdtemp()
+    paths = []
+    for i in range(files):
+        paths.append("{}/{}.npy".format(dirname, i))
+        np.save(paths[-1], np.random.rand(rows_per_file, dimensions).astype(np.float32))
+    queries = np.random.rand(10, dimensions).astype(np.float32)
+    start = time.time()
+    built = retriever.BaseRetriever(name="benchmark")
+    for i, path in enumerate(paths):
+        start_index = built.findex
+        built.load_index(np.load(path), entries_for(i, rows_per_file), key=i)
+        built.loaded_entries[i] = retriever.IndexRange(start=start_index, end=built.findex - 1)
+    build_time = time.time() - start
+    start = time.time()
+    retriever.write_snapshot("{}/snapshot.npz".format(dirname), built.snapshot_arrays())
+    write_time = time.time() - start
+    start = time.time()
+    restored = retriever.BaseRetriever(name="benchmark")
+    restored.restore_snapshot(retriever.load_snapshot("{}/snapshot.npz".format(dirname)))
+    restore_time = time.time() - start
+    identical = all([r['frame_primary_key'] for r in a] == [r['frame_primary_key'] for r in b]
+                    for a, b in zip(built.nearest_batch(queries, 20), restored.nearest_batch(queries, 20)))
+    print "{} index files ({} vectors): load files {:.2f}s, write snapshot {:.2f}s ({:.0f} MB), restore snapshot " \
+          "{:.2f}s, speedup {:.1f}x, identical results {}".format(
+        files, files * rows_per_file, build_time, write_time,
+        os.path.getsize("{}/snapshot.npz".format(dirname)) / 1e6, restore_time, build_time / restore_time, identical)
+    shutil.rmtree(dirname)
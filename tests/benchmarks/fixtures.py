@@ -0,0 +1,11 @@
+"""
+Synthetic index entries shared by the retriever benchmarks.
+"""
+
+
+def entries_for(i, rows_per_file):
+    """
+    Entries of the i-th synthetic index file with rows_per_file frames, each file belongs to its own video.
+    """
+    return [{'index': k, 'frame_index': k, 'frame_primary_key': i * rows_per_file + k, 'video_primary_key': str(i),
+             'type': 'F'} for k in range(rows_per_file)]
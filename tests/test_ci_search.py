@@ -13,6 +13,7 @@ if __name__ == '__main__':
         algo = Retriever.FAISS
     else:
         algo = Retriever.EXACT
+    retriever_pk = Retriever.objects.get(name='inception', algorithm=algo, approximator_shasum=None).pk
     query_dict = {
         'process_type': DVAPQL.QUERY,
         'image_data_b64': base64.encodestring(file('queries/query.png').read()),
@@ -24,9 +25,7 @@ if __name__ == '__main__':
                     'target': 'query',
                     'map': [
                         {'operation': 'perform_retrieval',
-                         'arguments': {'count': 15, 'retriever_pk': Retriever.objects.get(name='inception',
-                                                                                          algorithm=algo,
-                                                                                          approximator_shasum=None).pk}
+                         'arguments': {'count': 15, 'retriever_pk': retriever_pk}
                          }
                     ]
                 }
@@ -48,3 +47,18 @@ if __name__ == '__main__':
     qp.launch()
     qp.wait(timeout=400)
     print QueryResults.objects.count()
+    # Search again using the stored vector of the top result, without an image or the indexer
+    stored_query_dict = {
+        'process_type': DVAPQL.QUERY,
+        'map': [
+            {'operation': 'perform_retrieval',
+             'arguments': {'count': 15, 'retriever_pk': retriever_pk, 'target': 'stored_vector',
+                           'frame_pk': QueryResults.objects.filter(query=qp.process).order_by('rank')[0].frame_id}
+             }
+        ]
+    }
+    qp = DVAPQLProcess()
+    qp.create_from_json(stored_query_dict)
+    qp.launch()
+    qp.wait(timeout=400)
+    print QueryResults.objects.filter(query=qp.process).count()
@@ -0,0 +1,30 @@
+#!/usr/bin/env python
+"""
+Snapshot and restore a retriever whose entries span more than 32767 videos, every row must stay attached to its
+video after the warm start.
+"""
+import sys, os, tempfile, shutil
+import numpy as np
+sys.path.append('../server/')
+from dvalib import retriever
+
+if __name__ == '__main__':
+    videos = 40000
+    entries = [{'index': k, 'frame_index': k, 'frame_primary_key': k, 'video_primary_key': str(k), 'type': 'F'}
+               for k in range(videos)]
+    built = retriever.BaseRetriever(name="test")
+    built.load_index(np.random.rand(videos, 8).astype(np.float32), entries, key=1)
+    built.loaded_entries[1] = retriever.IndexRange(start=0, end=built.findex - 1)
+    dirname = tempfile.mkdtemp()
+    try:
+        path = "{}/snapshot.npz".format(dirname)
+        retriever.write_snapshot(path, built.snapshot_arrays())
+        restored = retriever.BaseRetriever(name="test")
+        restored.restore_snapshot(retriever.load_snapshot(path))
+    finally:
+        shutil.rmtree(dirname)
+    assert len(restored.files) == videos
+    for k in [0, 32767, 32768, videos - 1]:
+        assert restored.files[k]['video_primary_key'] == str(k), (k, restored.files[k])
+    assert restored.files.mask({'video_id': 39999}).nonzero()[0].tolist() == [39999]
+    print "restored {} rows of {} videos".format(len(restored.files), videos)
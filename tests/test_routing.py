@@ -0,0 +1,18 @@
+#!/usr/bin/env python
+"""
+Queue routing of model specific tasks, a stored vector retrieval with an explicit indexer must run on the retriever
+(shard) queue and not on the indexer queue.
+"""
+import django, sys, os
+sys.path.append('../server/')
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "dva.settings")
+django.setup()
+from dvaapp.processing import get_model_specific_queue_name
+
+if __name__ == '__main__':
+    args = {'retriever_pk': 3, 'target': 'stored_vector', 'frame_pk': 10, 'stored_indexer_pk': 2, 'count': 20}
+    assert get_model_specific_queue_name('perform_retrieval', args) == 'q_retriever_3'
+    args['shard'] = 1
+    assert get_model_specific_queue_name('perform_retrieval', args) == 'q_retriever_3_1'
+    assert get_model_specific_queue_name('perform_indexing', {'indexer_pk': 2, 'target': 'query'}) == 'q_indexer_2'
+    print "routing ok"